@@ -0,0 +1,112 @@
+/*
+ * Copyright 2017 Rich Lane
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/*
+ * Bash loadable builtin. Load it with "enable -f shellhop.so shellhop" and
+ * bind it with "bind -x" so that it runs inside the shell, reading
+ * READLINE_LINE and setting READLINE_POINT without a subshell or exec.
+ */
+#include <config.h>
+#include <stdio.h>
+#include <string.h>
+
+#include "builtins.h"
+#include "shell.h"
+#include "bashgetopt.h"
+#include "common.h"
+
+#include "shellhop.h"
+
+static int shellhop_builtin(WORD_LIST* list) {
+  /* Like the offsets in READLINE_POINT, the result counts characters */
+  int flags = SHELLHOP_NO_SIGNALS | SHELLHOP_CHARS;
+  int repeat = 0;
+  int opt;
+  reset_internal_getopt();
+  while ((opt = internal_getopt(list, "iSlEHR")) != -1) {
+    switch (opt) {
+    case 'i':
+      flags = (flags & ~SHELLHOP_SMART_CASE) | SHELLHOP_IGNORE_CASE;
+      break;
+    case 'S':
+      flags = (flags & ~SHELLHOP_IGNORE_CASE) | SHELLHOP_SMART_CASE;
+      break;
+    case 'l':
+      flags |= SHELLHOP_LABELS;
+      break;
+    case 'E':
+      flags |= SHELLHOP_REGEX;
+      break;
+    case 'H':
+      flags |= SHELLHOP_HISTORY;
+      break;
+    case 'R':
+      repeat = 1;
+      break;
+    CASE_HELPOPT;
+    default:
+      builtin_usage();
+      return EX_USAGE;
+    }
+  }
+
+  if ((flags & SHELLHOP_LABELS) && (flags & SHELLHOP_REGEX)) {
+    builtin_error("-l can't be used with -E");
+    return EX_USAGE;
+  }
+
+  const char* line = get_string_value("READLINE_LINE");
+  if (line == NULL) {
+    builtin_error("READLINE_LINE is not set; use with bind -x");
+    return EXECUTION_FAILURE;
+  }
+
+  int result = repeat ? shellhop_repeat(line, strlen(line), flags)
+                      : shellhop_interactive(line, strlen(line), flags);
+  if (result < 0) {
+    return EXECUTION_FAILURE;
+  }
+
+  char point[32];
+  snprintf(point, sizeof(point), "%d", result);
+  bind_variable("READLINE_POINT", point, 0);
+  return EXECUTION_SUCCESS;
+}
+
+static char* shellhop_doc[] = {
+  "Incremental search of the current command line.",
+  "",
+  "Search READLINE_LINE interactively and set READLINE_POINT to the",
+  "chosen match. Meant to be bound with bind -x.",
+  "",
+  "Options:",
+  "  -i\tmatch ASCII letters in either case",
+  "  -S\tignore case unless the needle has an uppercase letter",
+  "  -l\tlabel the matches so that one more key jumps to each (not with -E)",
+  "  -E\tsearch for an extended regular expression",
+  "  -H\tremember accepted needles; Ctrl-R recalls the last one",
+  "  -R\tjump to the first match of the last needle remembered",
+  NULL,
+};
+
+struct builtin shellhop_struct = {
+  "shellhop",
+  shellhop_builtin,
+  BUILTIN_ENABLED,
+  shellhop_doc,
+  "shellhop [-i] [-S] [-l] [-E] [-H] [-R]",
+  0,
+};
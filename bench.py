@@ -0,0 +1,173 @@
+# Copyright 2017 Rich Lane
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keystroke latency and output benchmarks for shellhop.
+
+Runs the binary on a pty for a range of line sizes and match densities and
+writes JSON with the p50/p99 time from each key to the end of its frame, the
+bytes drawn per frame and the peak RSS of each run.
+
+    python bench.py [-o FILE] [--sizes 100,10000,...]
+"""
+import argparse
+import fcntl
+import json
+import os
+import platform
+import pty
+import random
+import select
+import struct
+import subprocess
+import sys
+import tempfile
+import termios
+import time
+
+BINARY = './shellhop'
+
+# A frame is complete once no output has arrived for this long
+QUIET = 0.05
+
+# Give up waiting for a frame after this long
+TIMEOUT = 2
+
+SIZES = [100, 10000, 1000000, 4000000]
+
+
+def dense(size):
+    return b'a' * size, b'aaaa'
+
+
+def sparse(size):
+    # Random letters that never spell the needle, which appears four times
+    rng = random.Random(0)
+    letters = bytearray(b'bcdfghjklmnpqrstvwxz')
+    block = bytes(bytearray(rng.choice(letters) for _ in range(min(size, 65536))))
+    quarter = (block * (size // len(block) + 1))[:size // 4 - 6]
+    return (quarter + b'needle') * 4, b'needle'
+
+
+def command_line(size):
+    command = b"git commit -m 'fix build' && make check | tee log; "
+    return (command * (size // len(command) + 1))[:size], b'make'
+
+
+CASES = [
+    ('dense', dense),
+    ('sparse', sparse),
+    ('command', command_line),
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def read_frame(f, deadline):
+    """Read until output goes quiet. Returns (bytes, time of last byte)."""
+    data = b''
+    last = None
+    while True:
+        timeout = QUIET if last is not None else max(0, deadline - time.time())
+        if not select.select([f], [], [], timeout)[0]:
+            return data, last
+        chunk = os.read(f.fileno(), 65536)
+        if not chunk:
+            return data, last
+        data += chunk
+        last = time.time()
+
+
+def run(line, keys, columns):
+    f = tempfile.TemporaryFile()
+    f.write(line)
+    f.flush()
+    f.seek(0)
+
+    master, slave = pty.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', 24, columns, 0, 0))
+
+    def preexec_fn():
+        os.dup2(f.fileno(), 3)
+        fcntl.fcntl(3, fcntl.F_SETFD, 0)
+
+    process = subprocess.Popen(
+        [BINARY, '--fd', '3'],
+        stdin=slave, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        preexec_fn=preexec_fn, close_fds=False)
+    os.close(slave)
+
+    first, _ = read_frame(process.stderr, time.time() + TIMEOUT)
+    latencies = []
+    frame_bytes = []
+    for key in keys:
+        sent = time.time()
+        os.write(master, key)
+        data, last = read_frame(process.stderr, sent + TIMEOUT)
+        if last is not None:
+            latencies.append((last - sent) * 1e6)
+            frame_bytes.append(len(data))
+    os.write(master, b'\r')
+    process.stdout.read()
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = status
+    os.close(master)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = rusage.ru_maxrss * (1 if platform.system() == 'Darwin' else 1024)
+    return {
+        'first_frame_bytes': len(first),
+        'keys': len(keys),
+        'latency_p50_us': percentile(latencies, 50) if latencies else None,
+        'latency_p99_us': percentile(latencies, 99) if latencies else None,
+        'frame_bytes_mean': sum(frame_bytes) / float(len(frame_bytes)) if frame_bytes else 0,
+        'frame_bytes_max': max(frame_bytes) if frame_bytes else 0,
+        'max_rss_bytes': rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='write JSON here instead of stdout')
+    parser.add_argument('--sizes', default=','.join(str(x) for x in SIZES),
+                        help='comma-separated line lengths')
+    parser.add_argument('--columns', type=int, default=80)
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(x) for x in args.sizes.split(',')]:
+        for name, make_line in CASES:
+            line, needle = make_line(size)
+            # Type the needle, cycle through matches, then delete it again
+            keys = [needle[i:i + 1] for i in range(len(needle))]
+            keys += [b'\x0e'] * 5 + [b'\x10'] * 5 + [b'\x7f'] * len(needle)
+            result = run(line, keys, args.columns)
+            result.update(case=name, size=size, needle=needle.decode())
+            results.append(result)
+            sys.stderr.write('%-8s %8d  p50 %8.0f us  p99 %8.0f us  %6.0f B/frame  %6d KiB\n' % (
+                name, size, result['latency_p50_us'] or 0, result['latency_p99_us'] or 0,
+                result['frame_bytes_mean'], result['max_rss_bytes'] // 1024))
+
+    output = json.dumps({'columns': args.columns, 'results': results},
+                        indent=2, separators=(',', ': '), sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
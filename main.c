@@ -0,0 +1,527 @@
+/*
+ * Copyright 2017 Rich Lane
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+#define _POSIX_C_SOURCE 200809L
+#include <errno.h>
+#include <fcntl.h>
+#include <getopt.h>
+#include <limits.h>
+#include <locale.h>
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/types.h>
+#include <unistd.h>
+#include <stdbool.h>
+
+#include "shellhop.h"
+
+static const char* read_line(int fd, size_t* len, size_t* mapped_len);
+static int replay(const char* path, const char* line, size_t line_len, int flags);
+static int query(const char* needle, int delim, int from, int flags, bool first);
+static int serve(int flags);
+
+const char* bash_template =
+  "function _shellhop {\n"
+  "  READLINE_POINT=$(%s --chars%s --fd 3 3<<<\"$READLINE_LINE\");\n"
+  "};\n"
+  "bind '\"\\C-xS0\":beginning-of-line';\n"
+  "bind -x '\"\\C-xS1\":\"_shellhop\"';\n"
+  "bind '\"%s\":\"\\C-xS0\\C-xS1\"';\n";
+
+/* Used instead of bash_template when shellhop.so is next to the binary */
+const char* bash_builtin_template =
+  "enable -f %s.so shellhop;\n"
+  "bind '\"\\C-xS0\":beginning-of-line';\n"
+  "bind -x '\"\\C-xS1\":\"shellhop%s\"';\n"
+  "bind '\"%s\":\"\\C-xS0\\C-xS1\"';\n";
+
+/*
+ * Used with --server. One shellhop process is started as a coprocess and
+ * serves every activation. Job control is off while starting it so that it
+ * stays in the shell's process group and can read the terminal.
+ */
+const char* bash_server_template =
+  "{ set +m; coproc _SHELLHOP { exec %s --server --chars%s; }; set -m; } 2>/dev/null;\n"
+  "function _shellhop {\n"
+  "  if [[ -n ${_SHELLHOP[1]} ]]; then\n"
+  "    printf '%%s\\0%%s\\0' \"$READLINE_POINT\" \"$READLINE_LINE\" >&\"${_SHELLHOP[1]}\";\n"
+  "    read -r READLINE_POINT <&\"${_SHELLHOP[0]}\";\n"
+  "  else\n"
+  "    READLINE_POINT=$(%s --chars%s --fd 3 3<<<\"$READLINE_LINE\");\n"
+  "  fi;\n"
+  "};\n"
+  "bind '\"\\C-xS0\":beginning-of-line';\n"
+  "bind -x '\"\\C-xS1\":\"_shellhop\"';\n"
+  "bind '\"%s\":\"\\C-xS0\\C-xS1\"';\n";
+
+/*
+ * The zsh/shellhop module provides the widget in-process when installed. It
+ * takes the case option from $SHELLHOP_CASE. The first %s after it is the
+ * condition for using the binary instead, which is always true with options
+ * the module lacks.
+ */
+const char* zsh_template =
+  "%s"
+  "if %s; then\n"
+  "  function _shellhop {\n"
+  "    CURSOR=$(%s --chars%s --fd 3 3<<<\"$BUFFER\" </dev/tty);\n"
+  "    zle redisplay;\n"
+  "  };\n"
+  "  zle -N shellhop _shellhop;\n"
+  "fi;\n"
+  "bindkey '%s' shellhop;\n";
+
+const char* zsh_server_template =
+  "%s"
+  "if %s; then\n"
+  "  () {\n"
+  "    setopt local_options no_monitor;\n"
+  "    coproc exec %s --server --chars%s;\n"
+  "    exec {_shellhop_in}<&p;\n"
+  "    exec {_shellhop_out}>&p;\n"
+  "  };\n"
+  "  function _shellhop {\n"
+  "    print -rn -- \"$CURSOR\"$'\\0'\"$BUFFER\"$'\\0' >&$_shellhop_out;\n"
+  "    read -r CURSOR <&$_shellhop_in;\n"
+  "    zle redisplay;\n"
+  "  };\n"
+  "  zle -N shellhop _shellhop;\n"
+  "fi;\n"
+  "bindkey '%s' shellhop;\n";
+
+struct option options[] = {
+  { "help", 0, NULL, 'h' },
+  { "bash", 0, NULL, 'b' },
+  { "zsh", 0, NULL, 'z' },
+  { "key", 1, NULL, 'k' },
+  { "fd", 1, NULL, 'f' },
+  { "replay", 1, NULL, 'r' },
+  { "query", 1, NULL, 'q' },
+  { "null", 0, NULL, '0' },
+  { "first", 0, NULL, '1' },
+  { "from", 1, NULL, 'F' },
+  { "backward", 0, NULL, 'B' },
+  { "server", 0, NULL, 's' },
+  { "ignore-case", 0, NULL, 'i' },
+  { "smart-case", 0, NULL, 'S' },
+  { "chars", 0, NULL, 'c' },
+  { "labels", 0, NULL, 'l' },
+  { "regex", 0, NULL, 'E' },
+  { "history", 0, NULL, 'H' },
+  { "repeat", 0, NULL, 'R' },
+  { NULL },
+};
+
+void usage(const char* name) {
+  fprintf(
+      stderr,
+      "usage: %s [OPTION]... LINE\n"
+      "  or:  %s [OPTION]... --fd=FD\n"
+      "  or:  %s --query=NEEDLE [OPTION]...\n"
+      "  or:  %s --server\n"
+      "\n"
+      "Do an incremental search on the given line and write the index of the first\n"
+      "match to stdout.\n"
+      "\n"
+      "  -b, --bash     output Bash shell commands to stdout\n"
+      "  -z, --zsh      output Zsh shell commands to stdout\n"
+      "  -k, --key=KEY  specify a key for --bash and --zsh\n"
+      "  -i, --ignore-case\n"
+      "                 match ASCII letters in either case\n"
+      "  -S, --smart-case\n"
+      "                 ignore case unless the needle has an uppercase letter\n"
+      "  -l, --labels   once two characters are typed, label the matches on\n"
+      "                 screen; typing a label jumps to its match\n"
+      "  -E, --regex    search for an extended regular expression rather than\n"
+      "                 a string\n"
+      "  -H, --history  remember accepted needles in $SHELLHOP_HISTORY or\n"
+      "                 ~/.shellhop_history; Ctrl-R recalls the last one\n"
+      "      --repeat   write the index of the first match of the last needle\n"
+      "                 remembered, without searching interactively\n"
+      "  -c, --chars    write the number of characters before the match rather\n"
+      "                 than bytes, as shells count them for the cursor\n"
+      "  -f, --fd=FD    read LINE from file descriptor FD, dropping one trailing\n"
+      "                 newline so that a here-string can be used\n"
+      "  -r, --replay=FILE\n"
+      "                 apply the keys in FILE without a terminal, writing frames\n"
+      "                 to stderr and the time taken by each key to stdout; the\n"
+      "                 width is taken from COLUMNS\n"
+      "  -q, --query=NEEDLE\n"
+      "                 read lines from stdin and write a line with the offsets\n"
+      "                 of NEEDLE in each, separated by spaces\n"
+      "  -0, --null     with --query, lines end with NUL rather than newline\n"
+      "      --first    with --query, write only the first offset, or -1\n"
+      "      --from=OFFSET\n"
+      "                 with --query, only find matches from OFFSET on\n"
+      "      --backward with --query, find matches at or before --from (by\n"
+      "                 default the end of the line), nearest first\n"
+      "  -s, --server   read NUL-terminated pairs of cursor and LINE from stdin,\n"
+      "                 search each on the terminal and write the resulting\n"
+      "                 index to stdout; with --bash and --zsh, output commands\n"
+      "                 that run shellhop as a coprocess\n"
+      "  -h, --help     display this help and exit\n",
+      name, name, name, name);
+}
+
+int main(int argc, char** argv) {
+  /* Characters are decoded and measured as the terminal shows them */
+  setlocale(LC_CTYPE, "");
+
+  bool print_bash_source = false;
+  bool print_zsh_source = false;
+  const char* key = "\\C-x\\C-f";
+  int line_fd = -1;
+  const char* replay_path = NULL;
+  const char* needle = NULL;
+  int delim = '\n';
+  bool first = false;
+  int from = -1;
+  int flags = 0;
+  bool server = false;
+  bool repeat = false;
+  const char* case_option = "";
+  const char* zsh_case = "";
+  int opt;
+  while ((opt = getopt_long(argc, argv, "bzhk:f:r:q:0siSclEH", options, NULL)) != -1) {
+    switch (opt) {
+    case 'b':
+      print_bash_source = true;
+      break;
+    case 'z':
+      print_zsh_source = true;
+      break;
+    case 'k':
+      key = optarg;
+      break;
+    case 'f':
+      line_fd = atoi(optarg);
+      break;
+    case 'r':
+      replay_path = optarg;
+      break;
+    case 'q':
+      needle = optarg;
+      break;
+    case '0':
+      delim = '\0';
+      break;
+    case '1':
+      first = true;
+      break;
+    case 'F':
+      from = atoi(optarg);
+      break;
+    case 'B':
+      flags |= SHELLHOP_BACKWARD;
+      break;
+    case 's':
+      server = true;
+      break;
+    case 'i':
+      flags = (flags & ~SHELLHOP_SMART_CASE) | SHELLHOP_IGNORE_CASE;
+      case_option = " -i";
+      zsh_case = "SHELLHOP_CASE=ignore;\n";
+      break;
+    case 'S':
+      flags = (flags & ~SHELLHOP_IGNORE_CASE) | SHELLHOP_SMART_CASE;
+      case_option = " -S";
+      zsh_case = "SHELLHOP_CASE=smart;\n";
+      break;
+    case 'c':
+      flags |= SHELLHOP_CHARS;
+      break;
+    case 'l':
+      flags |= SHELLHOP_LABELS;
+      break;
+    case 'E':
+      flags |= SHELLHOP_REGEX;
+      break;
+    case 'H':
+      flags |= SHELLHOP_HISTORY;
+      break;
+    case 'R':
+      repeat = true;
+      break;
+    case 'h':
+      usage(argv[0]);
+      return 0;
+    default:
+      usage(argv[0]);
+      return 1;
+    }
+  }
+
+  const char* zsh_fallback = "! zmodload zsh/shellhop 2>/dev/null";
+  if (flags & (SHELLHOP_LABELS | SHELLHOP_REGEX | SHELLHOP_HISTORY)) {
+    zsh_fallback = "true";
+  }
+
+  if ((flags & SHELLHOP_LABELS) && (flags & SHELLHOP_REGEX)) {
+    /* A label could be taken for the next character of the regex */
+    fprintf(stderr, "%s: --labels can't be used with --regex\n", argv[0]);
+    return 1;
+  }
+
+  /* Options passed on by the shell commands */
+  char shell_options[16];
+  snprintf(shell_options, sizeof(shell_options), "%s%s%s%s", case_option,
+           flags & SHELLHOP_LABELS ? " -l" : "", flags & SHELLHOP_REGEX ? " -E" : "",
+           flags & SHELLHOP_HISTORY ? " -H" : "");
+
+  if (print_bash_source && server) {
+      printf(bash_server_template, argv[0], shell_options, argv[0], shell_options, key);
+      return 0;
+  } else if (print_bash_source) {
+      char builtin_path[PATH_MAX];
+      snprintf(builtin_path, sizeof(builtin_path), "%s.so", argv[0]);
+      if (access(builtin_path, R_OK) == 0) {
+        printf(bash_builtin_template, argv[0], shell_options, key);
+      } else {
+        printf(bash_template, argv[0], shell_options, key);
+      }
+      return 0;
+  } else if (print_zsh_source && server) {
+      printf(zsh_server_template, zsh_case, zsh_fallback, argv[0], shell_options, key);
+      return 0;
+  } else if (print_zsh_source) {
+      printf(zsh_template, zsh_case, zsh_fallback, argv[0], shell_options, key);
+      return 0;
+  } else if (needle != NULL) {
+    if (from < 0) {
+      from = flags & SHELLHOP_BACKWARD ? INT_MAX : 0;
+    }
+    return query(needle, delim, from, flags, first);
+  } else if (server) {
+    return serve(flags);
+  }
+
+  const char* line;
+  size_t line_len;
+  size_t mapped_len = 0;
+  if (line_fd >= 0) {
+    line = read_line(line_fd, &line_len, &mapped_len);
+    if (line == NULL) {
+      return 1;
+    }
+  } else if (argc - optind > 0) {
+    line = argv[optind];
+    line_len = strlen(line);
+  } else {
+    usage(argv[0]);
+    return 1;
+  }
+
+  int result;
+  if (repeat) {
+    result = shellhop_repeat(line, line_len, flags);
+  } else if (replay_path != NULL) {
+    result = replay(replay_path, line, line_len, flags);
+  } else {
+    result = shellhop_interactive(line, line_len, flags);
+  }
+  if (result < 0) {
+    return 1;
+  }
+
+  printf("%d\n", result);
+  if (mapped_len > 0) {
+    munmap((void*)line, mapped_len);
+  } else if (line_fd >= 0) {
+    free((void*)line);
+  }
+  return 0;
+}
+
+
+/*
+ * Read the whole of fd. Regular files are mapped rather than copied. One
+ * trailing newline is dropped since here-strings always add one.
+ */
+static const char* read_line(int fd, size_t* len, size_t* mapped_len) {
+  struct stat st;
+  if (fstat(fd, &st) < 0) {
+    perror("fstat");
+    return NULL;
+  }
+
+  char* data = NULL;
+  size_t size = 0;
+  if (S_ISREG(st.st_mode) && st.st_size > 0) {
+    data = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    if (data == MAP_FAILED) {
+      perror("mmap");
+      return NULL;
+    }
+    size = st.st_size;
+    *mapped_len = size;
+  } else {
+    size_t cap = BUFSIZ;
+    data = malloc(cap);
+    ssize_t n;
+    while ((n = read(fd, data + size, cap - size)) != 0) {
+      if (n < 0 && errno == EINTR) {
+        continue;
+      } else if (n < 0) {
+        perror("read");
+        free(data);
+        return NULL;
+      }
+      size += n;
+      if (size == cap) {
+        cap *= 2;
+        data = realloc(data, cap);
+      }
+    }
+  }
+
+  if (size > INT_MAX) {
+    fprintf(stderr, "line too long\n");
+    return NULL;
+  }
+  if (size > 0 && data[size - 1] == '\n') {
+    size--;
+  }
+  *len = size;
+  return data;
+}
+
+/* Run shellhop_replay with the keys in path */
+static int replay(const char* path, const char* line, size_t line_len, int flags) {
+  int fd = open(path, O_RDONLY);
+  if (fd < 0) {
+    perror(path);
+    return -1;
+  }
+  size_t keys_len;
+  size_t mapped_len = 0;
+  const char* keys = read_line(fd, &keys_len, &mapped_len);
+  close(fd);
+  if (keys == NULL) {
+    return -1;
+  }
+
+  const char* columns = getenv("COLUMNS");
+  int width = columns != NULL ? atoi(columns) : 0;
+  int result = shellhop_replay(line, line_len, keys, keys_len, width, flags, stdout);
+
+  if (mapped_len > 0) {
+    munmap((void*)keys, mapped_len);
+  } else {
+    free((void*)keys);
+  }
+  return result;
+}
+
+/* Write the offsets of needle in each line of stdin for --query */
+static int query(const char* needle, int delim, int from, int flags, bool first) {
+  char* line = NULL;
+  size_t cap = 0;
+  ssize_t len;
+  size_t needle_len = strlen(needle);
+
+  /* Flush each result so that a coprocess sees it straight away */
+  setvbuf(stdout, NULL, _IOLBF, 0);
+  while ((len = getdelim(&line, &cap, delim, stdin)) > 0) {
+    if (line[len - 1] == delim) {
+      len--;
+    }
+    if (len > INT_MAX) {
+      fprintf(stderr, "line too long\n");
+      free(line);
+      return 1;
+    }
+
+    /* Every match is found at once and those from --from on are written */
+    int* offsets;
+    int count = shellhop_find_all(line, len, needle, needle_len, flags, &offsets);
+    bool backward = flags & SHELLHOP_BACKWARD;
+    const char* sep = "";
+    for (int k = 0; k < count; k++) {
+      int offset = offsets[backward ? count - 1 - k : k];
+      if (backward ? offset > from : offset < from) {
+        continue;
+      }
+      printf("%s%d", sep, offset);
+      sep = " ";
+      if (first) {
+        break;
+      }
+    }
+    if (first && *sep == '\0') {
+      printf("-1");
+    }
+    putchar('\n');
+    free(offsets);
+  }
+  free(line);
+  return 0;
+}
+
+/*
+ * Serve activations for --server. Each request is the cursor and the line,
+ * both NUL-terminated, and gets back the resulting index on a line of its
+ * own: the match accepted, 0 if cancelled as without --server, or the
+ * cursor unchanged if the terminal could not be used.
+ */
+static int serve(int flags) {
+  /* Requests stay on stdin and stdout; the search runs on the terminal */
+  int tty = open("/dev/tty", O_RDWR);
+  if (tty < 0) {
+    perror("/dev/tty");
+    return 1;
+  }
+  FILE* requests = fdopen(dup(STDIN_FILENO), "r");
+  dup2(tty, STDIN_FILENO);
+  dup2(tty, STDERR_FILENO);
+  close(tty);
+
+  /* Ctrl-C at the prompt reaches the shell's whole process group */
+  signal(SIGINT, SIG_IGN);
+  signal(SIGQUIT, SIG_IGN);
+  setvbuf(stdout, NULL, _IOLBF, 0);
+
+  char* cursor = NULL;
+  size_t cursor_cap = 0;
+  char* line = NULL;
+  size_t line_cap = 0;
+  ssize_t len;
+
+  /* One state serves every request, keeping its buffers between them */
+  struct shellhop* s = NULL;
+  while (getdelim(&cursor, &cursor_cap, '\0', requests) > 0 &&
+         (len = getdelim(&line, &line_cap, '\0', requests)) > 0) {
+    if (line[len - 1] != '\0' || len - 1 > INT_MAX) {
+      break;
+    }
+    if (s == NULL) {
+      s = shellhop_new(line, len - 1);
+    } else {
+      shellhop_reset(s, line, len - 1);
+    }
+    int result = shellhop_run(s, flags | SHELLHOP_NO_SIGNALS);
+    printf("%d\n", result >= 0 ? result : atoi(cursor));
+  }
+  if (s != NULL) {
+    shellhop_free(s);
+  }
+  free(cursor);
+  free(line);
+  fclose(requests);
+  return 0;
+}
@@ -0,0 +1,140 @@
+# Copyright 2017 Rich Lane
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Python binding for libshellhop, the shellhop search engine.
+
+    s = Shellhop(b"echo foo bar")
+    s.feed(b"ba")
+    s.cursor  # 9
+
+Build the library with "make libshellhop.so". It's loaded from the directory
+of this file, or from SHELLHOP_LIB if that is set.
+"""
+import ctypes
+import os
+
+CONTINUE = 0
+ACCEPT = 1
+CANCEL = 2
+
+UNDERLINE = 1 << 0
+REVERSE_VIDEO = 1 << 1
+LABEL = 1 << 2
+
+# Flags
+IGNORE_CASE = 1 << 2
+SMART_CASE = 1 << 3
+LABELS = 1 << 5
+REGEX = 1 << 6
+
+_lib = ctypes.CDLL(os.environ.get(
+    'SHELLHOP_LIB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libshellhop.so')))
+
+_lib.shellhop_new.restype = ctypes.c_void_p
+_lib.shellhop_new.argtypes = [ctypes.c_char_p, ctypes.c_size_t]
+_lib.shellhop_set_flags.restype = None
+_lib.shellhop_set_flags.argtypes = [ctypes.c_void_p, ctypes.c_int]
+_lib.shellhop_set_recall.restype = None
+_lib.shellhop_set_recall.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t]
+_lib.shellhop_set_highlight_limit.restype = None
+_lib.shellhop_set_highlight_limit.argtypes = [ctypes.c_void_p, ctypes.c_int]
+_lib.shellhop_free.restype = None
+_lib.shellhop_free.argtypes = [ctypes.c_void_p]
+_lib.shellhop_reset.restype = None
+_lib.shellhop_reset.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t]
+_lib.shellhop_feed.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t]
+_lib.shellhop_cursor.argtypes = [ctypes.c_void_p]
+_lib.shellhop_needle.restype = ctypes.POINTER(ctypes.c_char)
+_lib.shellhop_needle.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+_lib.shellhop_matches.restype = ctypes.POINTER(ctypes.c_int)
+_lib.shellhop_matches.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+_lib.shellhop_current.argtypes = [ctypes.c_void_p]
+_lib.shellhop_char_index.argtypes = [ctypes.c_void_p, ctypes.c_int]
+_lib.shellhop_render.argtypes = [
+    ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p,
+    ctypes.POINTER(ctypes.c_ubyte), ctypes.c_int]
+
+
+class Shellhop(object):
+    """Incremental search state for one line (a byte string)."""
+
+    def __init__(self, line, flags=0):
+        # The engine doesn't copy the line, so keep it alive
+        self._line = line
+        self._s = _lib.shellhop_new(line, len(line))
+        _lib.shellhop_set_flags(self._s, flags)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._s:
+            _lib.shellhop_free(self._s)
+            self._s = None
+
+    def reset(self, line):
+        """Start a new search on line, keeping the flags."""
+        self._line = line
+        _lib.shellhop_reset(self._s, line, len(line))
+
+    def set_recall(self, needle):
+        """Set the needle that Ctrl-R brings back."""
+        _lib.shellhop_set_recall(self._s, needle, len(needle))
+
+    def set_highlight_limit(self, limit):
+        """Underline at most limit spans of matches, 0 for no limit."""
+        _lib.shellhop_set_highlight_limit(self._s, limit)
+
+    def feed(self, keys):
+        """Apply keys and return CONTINUE, ACCEPT or CANCEL."""
+        return _lib.shellhop_feed(self._s, keys, len(keys))
+
+    @property
+    def cursor(self):
+        """Offset of the current match."""
+        return _lib.shellhop_cursor(self._s)
+
+    @property
+    def needle(self):
+        n = ctypes.c_int()
+        p = _lib.shellhop_needle(self._s, ctypes.byref(n))
+        return p[:n.value]
+
+    @property
+    def matches(self):
+        """Sorted offsets of every match of the needle."""
+        n = ctypes.c_int()
+        p = _lib.shellhop_matches(self._s, ctypes.byref(n))
+        return p[:n.value]
+
+    @property
+    def current(self):
+        """Index of the current match in matches."""
+        return _lib.shellhop_current(self._s)
+
+    def char_index(self, offset):
+        """Number of characters before offset, in the locale's encoding."""
+        return _lib.shellhop_char_index(self._s, offset)
+
+    def render(self, width=0):
+        """Return the row of cells as (text, styles) for a terminal of the
+        given width (unlimited if 0)."""
+        size = 0
+        while True:
+            text = ctypes.create_string_buffer(size)
+            styles = (ctypes.c_ubyte * size)()
+            n = _lib.shellhop_render(self._s, width, text, styles, size)
+            if n <= size:
+                return text.raw[:n], list(styles[:n])
+            size = n
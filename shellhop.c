@@ -13,263 +13,2981 @@
  * See the License for the specific language governing permissions and
  * limitations under the License.
  */
-#define _POSIX_C_SOURCE 1
-#include <getopt.h>
+#define _POSIX_C_SOURCE 200809L
+#define _XOPEN_SOURCE 700
+/* macOS hides SIGWINCH and TIOCGWINSZ under _POSIX_C_SOURCE without this */
+#define _DARWIN_C_SOURCE
+#include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <poll.h>
+#include <pthread.h>
 #include <signal.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/ioctl.h>
+#include <sys/mman.h>
+#include <sys/select.h>
+#include <sys/stat.h>
 #include <sys/types.h>
 #include <termios.h>
+#include <time.h>
 #include <unistd.h>
+#include <wchar.h>
 #include <stdbool.h>
 
+#include "shellhop.h"
+
 enum graphics {
   GRAPHICS_NORMAL = 0,
-  GRAPHICS_UNDERLINE = 1 << 0,
-  GRAPHICS_REVERSE_VIDEO = 1 << 1,
+  GRAPHICS_UNDERLINE = SHELLHOP_UNDERLINE,
+  GRAPHICS_REVERSE_VIDEO = SHELLHOP_REVERSE_VIDEO,
+  GRAPHICS_LABEL = SHELLHOP_LABEL,
+};
+
+struct match_set {
+  int *offsets;
+  int count;
+  /* Characters that follow some match, which can't be labels */
+  bool taken[256];
+};
+
+/* Parsed regex, with the pattern it came from */
+enum { AST_EMPTY, AST_SET, AST_CAT, AST_ALT, AST_STAR, AST_PLUS, AST_QUEST, AST_BOL, AST_EOL };
+
+struct re_ast {
+  int op;
+  int left;
+  int right;
+  unsigned char set[32]; /* bytes matched by AST_SET */
+};
+
+/*
+ * NFA nodes. NODE_BEGIN and NODE_END are the anchors where a scan starts
+ * and where it ends, which are ^ and $ for a forward scan.
+ */
+enum { NODE_SET, NODE_SPLIT, NODE_BEGIN, NODE_END, NODE_MATCH };
+
+struct re_node {
+  int op;
+  int out;
+  int out1; /* second branch of NODE_SPLIT */
+  unsigned char set[32];
+};
+
+#define RE_SET_HAS(set, c) ((set)[(c) / 8] & (1 << ((c) % 8)))
+
+/* A DFA state: a sorted set of NFA nodes and its transitions, -1 if unknown */
+struct dstate {
+  int* set;
+  int len;
+  unsigned hash;
+  bool match;        /* a match ends here */
+  bool match_at_end; /* a match ends here if this is the end of the scan */
+};
+
+/*
+ * A DFA built lazily from the NFA, one state at a time as bytes are read.
+ * next[state * class_count + class] is the state after reading a byte of
+ * that class, or -1 if it hasn't been needed yet. States are found by their
+ * NFA sets in an open-addressed table holding index + 1.
+ */
+struct dfa {
+  int start;
+  int initial[2]; /* indexed by whether the start anchor holds */
+  struct dstate* states;
+  int* next;
+  int count;
+  int cap;
+  int* table;
+  int epoch; /* counts the times the cache was emptied */
+};
+
+/*
+ * A compiled needle for SHELLHOP_REGEX. The backward automaton finds where
+ * matches start and the forward one how long the match there is.
+ */
+struct regex {
+  char* pattern;
+  bool fold;
+  int root;
+  struct re_ast* ast;
+  int ast_count;
+  int ast_cap;
+  struct re_node* nodes;
+  int node_count;
+  int node_cap;
+  struct dfa forward;
+  struct dfa backward;
+  unsigned char classes[256];
+  int class_count;
+
+  /* Scratch space for closures, with marks for the nodes visited */
+  unsigned* mark;
+  unsigned generation;
+  int* stack;
+  int* list;
+  int* seeds;
+};
+
+struct re_parser {
+  struct regex* re;
+  const char* pattern;
+  int len;
+  int pos;
+  bool fold;
+  int depth;
+};
+
+/* Cells frame->text[start..start+len) drawn with the same graphics */
+struct run {
+  int start;
+  int len;
+  enum graphics graphics;
+};
+
+/*
+ * One row of terminal cells, starting at the saved cursor position. A cell
+ * is one or more bytes of text: cols[i] is the column of the cell holding
+ * text[i], and width is the number of columns in the row.
+ */
+struct frame {
+  char *text;
+  int *cols;
+  int len;
+  int cap;
+  int width;
+
+  /* Sorted, non-overlapping runs of highlighted cells; the rest are normal */
+  struct run *runs;
+  int run_count;
+  int run_cap;
+};
+
+/* Unchanged cells shorter than this between two changed spans are redrawn */
+#define MERGE_GAP 8
+
+/* Columns kept visible on either side of the current match when scrolling */
+#define SCROLL_MARGIN 8
+
+/* Default for shellhop_set_highlight_limit */
+#define HIGHLIGHT_LIMIT 32
+
+/* Labels are drawn once the needle is this long */
+#define LABEL_NEEDLE_LEN 2
+
+/* Label keys, the easiest to reach first */
+static const char label_keys[] = "asdfghjklqwertyuiopzxcvbnm";
+#define LABEL_MAX (sizeof(label_keys) - 1)
+
+/* States cached by each regex automaton before the cache is emptied */
+#define DFA_MAX_STATES 4096
+#define DFA_TABLE_SIZE (2 * DFA_MAX_STATES)
+
+/*
+ * Needles accepted with SHELLHOP_HISTORY, in a file shared by every shell.
+ * It's mapped and changed in place under an fcntl lock. Needles too long
+ * for an entry aren't kept.
+ */
+#define HISTORY_MAGIC "shellhop"
+#define HISTORY_SIZE 16
+#define HISTORY_NEEDLE_MAX 252
+
+struct history_entry {
+  int len;
+  char needle[HISTORY_NEEDLE_MAX];
+};
+
+struct history_file {
+  char magic[8];
+  unsigned int count; /* needles ever added; the newest is entries[(count - 1) % HISTORY_SIZE] */
+  unsigned int reserved;
+  struct history_entry entries[HISTORY_SIZE];
+};
+
+struct history {
+  int fd;
+  struct history_file* file;
+};
+
+/* Searches on lines at least this long run on a worker thread */
+#define WORKER_THRESHOLD (64 * 1024)
+
+/* Milliseconds a search may take before it is shown as running */
+#define SEARCHING_DELAY 20
+
+/* Iterations of a search between checks for cancellation */
+#define CANCEL_INTERVAL 65536
+
+/*
+ * Applies keys to the search state on a separate thread so that input is
+ * read and echoed while a long search runs. A search is cancelled when newer
+ * keys arrive and restarted with all of them.
+ */
+struct worker {
+  pthread_t thread;
+  struct shellhop* s;
+  pthread_mutex_t lock;
+  pthread_cond_t cond;
+
+  /* Guarded by lock */
+  char* keys; /* waiting to be applied */
+  size_t len;
+  size_t cap;
+  bool busy;  /* applying keys; the search state belongs to the worker */
+  bool cancel;
+  bool quit;
+  int status; /* SHELLHOP_ACCEPT once Enter has been applied */
+
+  /* Written when the worker becomes idle */
+  int wake[2];
+};
+
+/* Terminal output, buffered in memory and written once per frame */
+static FILE* out;
+static char* out_buf;
+static size_t out_len;
+
+/*
+ * Phases of the main loop recorded when SHELLHOP_TRACE names a file, which
+ * is written in Chrome's trace event format on exit. Events are preallocated
+ * so that recording never allocates, and dumping is async-signal-safe so
+ * that it can happen on SIGINT too.
+ */
+#define TRACE_MAX_EVENTS 65536
+
+struct trace_event {
+  const char* name;
+  int tid;         /* 1 for the main thread, 2 for the worker */
+  long long start; /* microseconds since tracing started */
+  long long dur;
+  long long arg;   /* bytes or keys handled */
 };
 
-static void change_graphics(enum graphics new, enum graphics *old_ptr);
-static const char* backwards_strstr(const char* haystack, const char* needle, int offset);
-static void set_raw_mode(void);
+static struct trace_event* trace_events;
+static int trace_count;
+static int trace_dropped;
+static int trace_fd = -1;
+static double trace_start;
+static pthread_mutex_t trace_lock = PTHREAD_MUTEX_INITIALIZER;
+
+/* Counted whether or not tracing */
+static long long trace_syscalls;
+static long long trace_bytes;
+
+/* Terminal and SIGINT state to restore when finished */
+static struct termios orig_termios;
+static struct sigaction old_sigint;
+
+/* Set by SIGWINCH */
+static volatile sig_atomic_t window_changed;
+
+/* Signal mask used while blocked waiting for input */
+static sigset_t wait_mask;
+
+static const char prompt[] = "(shellhop): ";
+static const char searching_prompt[] = "(searching) "; /* same width */
+
+static const char ellipsis[] = "...";
+#define ELLIPSIS_LEN ((int)sizeof(ellipsis) - 1)
+
+static void build_frame(struct shellhop* s, int width, struct frame* frame);
+static void frame_append(struct frame* frame, const char* text, int len);
+static void frame_append_line(struct frame* frame, const struct shellhop* s,
+                              int start, int end);
+static int next_cell(const struct frame* frame, int i);
+static void frame_highlight(struct frame* frame, int start, int end, enum graphics graphics);
+static void frame_mark(struct frame* frame, int i, enum graphics graphics);
+static void assign_labels(struct shellhop* s, int start, int end);
+static int token_kind(char c);
+static int* add_span(int* spans, int* count, int start, int end);
+static void highlight_span(struct frame* frame, int col, int start, int end,
+                           int cur_start, int cur_end, int* pos);
+static enum graphics cell_graphics(const struct frame* frame, int i, int* run);
+static bool same_cell(const struct frame* old, const struct frame* new, int i,
+                      int* old_run, int* new_run);
+static int view_len(int start, int line_len, int avail);
+static int scroll_view(int start, int line_len, int avail, int match, int match_len);
+static void draw_frame(const struct frame* old, const struct frame* new);
+static void move_cursor(int* x, int col);
+static void change_graphics(enum graphics new, enum graphics *old_ptr);
+static bool narrow(struct shellhop* s, const struct match_set* from, int pos,
+                   char c, struct match_set* to);
+static int lower_bound(const struct match_set* set, int offset);
+static bool find_all(struct shellhop* s, const char* needle, int needle_len,
+                     struct match_set* to);
+static bool cancelled(struct shellhop* s, int i);
+static struct regex* regex_for(struct shellhop* s, int n);
+static void regex_free(struct regex* re);
+static bool regex_find_all(struct shellhop* s, int needle_len, struct match_set* to);
+static int regex_match_end(struct shellhop* s, int i, int limit);
+static int match_end_of(struct shellhop* s, int i, int limit);
+static int re_parse(struct regex* re, const char* pattern, int n, bool fold);
+static int re_parse_alt(struct re_parser* p);
+static int re_parse_cat(struct re_parser* p);
+static int re_parse_atom(struct re_parser* p);
+static bool re_parse_class(struct re_parser* p, unsigned char* set);
+static void re_escape(unsigned char* set, char c);
+static void re_set_add(unsigned char* set, char first, char last);
+static void re_set_fold(unsigned char* set);
+static int re_ast(struct regex* re, int op, int left, int right);
+static int re_node(struct regex* re, int op, int out, int out1);
+static int re_compile(struct regex* re, int ast, int next, bool backward);
+static int re_closure(struct regex* re, const int* seeds, int n, bool at_begin, bool at_end);
+static bool re_has_match(const struct regex* re, const int* list, int len);
+static void dfa_clear(struct dfa* dfa);
+static int dfa_initial(struct regex* re, struct dfa* dfa, bool at_begin);
+static int dfa_step(struct regex* re, struct dfa* dfa, int state, unsigned char c);
+static int dfa_state(struct regex* re, struct dfa* dfa, int len);
+static void re_classes(struct regex* re);
+static bool folds_case(const struct shellhop* s, const char* needle, int needle_len);
+static char fold(char c);
+static int* borders(const char* needle, int needle_len);
+static void decode(struct shellhop* s);
+static void index_rows(struct shellhop* s);
+static int row_of(const struct shellhop* s, int i);
+static bool char_start(const struct shellhop* s, int i);
+static int column(const struct shellhop* s, int i);
+static int cell_floor(const struct shellhop* s, int i);
+static int cell_ceil(const struct shellhop* s, int i);
+static int offset_at_column(const struct shellhop* s, int col);
+static bool is_command(char c);
+static int feed_keys(struct shellhop* s, const char* keys, size_t len, size_t* used);
+static void reserve(struct shellhop* s, int n);
+static void follow(struct shellhop* s);
+static void find_taken(struct shellhop* s, struct match_set* set);
+static bool append(struct shellhop* s, char c);
+static int extend(struct shellhop* s, const char* chars, int n);
+static bool recall(struct shellhop* s);
+static void highlight_limit_from_env(struct shellhop* s);
+static bool history_open(struct history* h);
+static void history_close(struct history* h);
+static bool history_lock(const struct history* h, short type);
+static int history_last(const struct history* h, char* needle);
+static void history_add(struct history* h, const char* needle, int len);
+static struct worker* worker_start(struct shellhop* s);
+static void worker_stop(struct worker* w);
+static void* worker_main(void* arg);
+static int worker_feed(struct worker* w, const char* keys, size_t len);
+static int worker_poll(struct worker* w, int timeout, bool* busy);
+static void show_searching(const struct frame* prev, struct frame* frame);
+static double now_us(void);
+static void flush_output(void);
+static void trace_open(void);
+static void trace_record(const char* name, int tid, double start, long long arg);
+static void trace_dump(void);
+static void append_str(char* buf, int* len, const char* str);
+static void append_int(char* buf, int* len, long long v);
+static bool input_pending(int fd);
+static bool wait_input(int fd, int wake_fd);
+static int terminal_width(void);
+static void sigwinch(int signum);
+static bool set_raw_mode(int flags);
+static void restore_termios(void);
+static void signal_write(int fd, const char* str);
+
+static const char* beginning_of_line = "\e[G";
+static const char* save_cursor = "\e[s";
+static const char* restore_cursor = "\e[u";
+static const char* hide_cursor = "\e[?25l";
+static const char* show_cursor = "\e[?25h";
+static const char* normal = "\e[0m";
+static const char* clear = "\e[J";
+
+struct shellhop {
+  const char* line;
+  int line_len;
+  char* needle;
+  int needle_len;
+  int needle_cap;
+
+  /*
+   * With SHELLHOP_IGNORE_CASE or SHELLHOP_SMART_CASE, a copy of line with
+   * ASCII letters lowercased, which is searched for a needle folded the
+   * same way
+   */
+  int flags;
+  char* folded;
+  char* folded_needle;
+
+  /*
+   * For lines with multibyte characters in the current locale, chars[i] is
+   * the index of the character holding byte i and cols[i] the column of its
+   * cell, with an entry for the end of the line. Characters of zero width
+   * share the cell before them. NULL when every byte is one column.
+   */
+  int* chars;
+  int* cols;
+
+  /*
+   * For buffers holding several lines, rows[r] is the offset where line r
+   * starts. NULL when there is only one.
+   */
+  int* rows;
+  int row_count;
+
+  /*
+   * With SHELLHOP_LABELS, tokens[i] is set where a word or a run of
+   * punctuation starts. Labels go to matches there before any others.
+   */
+  char* tokens;
+
+  /*
+   * Matches labelled by the last render and their labels, which are valid
+   * for the next key only
+   */
+  int labelled[LABEL_MAX];
+  char labels[LABEL_MAX];
+  int label_count;
+
+  /*
+   * matches[n] holds the sorted offsets of the first n characters of the
+   * needle. Appending a character narrows the top set and backspace pops it.
+   * A count of -1 marks a set that hasn't been computed yet.
+   */
+  struct match_set* matches;
+
+  /* With SHELLHOP_REGEX, regexes[n] is compiled from the first n characters */
+  struct regex** regexes;
+
+  /*
+   * The needle Ctrl-R brings back and, unless their count is -1, its
+   * matches, found before the first key
+   */
+  char* recall;
+  int recall_len;
+  struct match_set recalled;
+
+  /* Offset of the current match and its index in matches[needle_len] */
+  int result;
+  int current;
+
+  /* First offset of the line shown by the last render */
+  int view_start;
+
+  /* Most underlined spans drawn by a render, or 0 for no limit */
+  int highlight_limit;
+
+  /* Set when searches run on a worker thread that may cancel them */
+  struct worker* worker;
+
+  /* Frames drawn by shellhop_run, kept for the next search */
+  struct frame frames[2];
+};
+
+struct shellhop* shellhop_new(const char* line, size_t line_len) {
+  struct shellhop* s = calloc(1, sizeof(*s));
+  s->line = line;
+  s->line_len = line_len;
+  s->needle_cap = 16;
+  s->needle = calloc(s->needle_cap, 1);
+  s->folded_needle = calloc(s->needle_cap, 1);
+  s->matches = calloc(s->needle_cap, sizeof(s->matches[0]));
+  s->regexes = calloc(s->needle_cap, sizeof(s->regexes[0]));
+  s->recalled.count = -1;
+  s->highlight_limit = HIGHLIGHT_LIMIT;
+  decode(s);
+  index_rows(s);
+  return s;
+}
+
+void shellhop_reset(struct shellhop* s, const char* line, size_t line_len) {
+  for (int i = 0; i < s->needle_cap; i++) {
+    s->matches[i].count = 0;
+    regex_free(s->regexes[i]);
+    s->regexes[i] = NULL;
+  }
+  memset(s->needle, 0, s->needle_cap);
+  s->needle_len = 0;
+
+  /* The tables of the old line are rebuilt for the new one */
+  free(s->folded);
+  free(s->chars);
+  free(s->cols);
+  free(s->rows);
+  free(s->tokens);
+  s->folded = NULL;
+  s->chars = NULL;
+  s->cols = NULL;
+  s->rows = NULL;
+  s->tokens = NULL;
+  s->line = line;
+  s->line_len = line_len;
+  decode(s);
+  index_rows(s);
+  shellhop_set_flags(s, s->flags);
+
+  free(s->recall);
+  s->recall = NULL;
+  s->recall_len = 0;
+  s->recalled.count = -1;
+  s->label_count = 0;
+  s->result = 0;
+  s->current = 0;
+  s->view_start = 0;
+}
+
+void shellhop_free(struct shellhop* s) {
+  for (int i = 0; i < s->needle_cap; i++) {
+    free(s->matches[i].offsets);
+    regex_free(s->regexes[i]);
+  }
+  for (int i = 0; i < 2; i++) {
+    free(s->frames[i].text);
+    free(s->frames[i].cols);
+    free(s->frames[i].runs);
+  }
+  free(s->matches);
+  free(s->regexes);
+  free(s->needle);
+  free(s->folded);
+  free(s->folded_needle);
+  free(s->chars);
+  free(s->cols);
+  free(s->rows);
+  free(s->tokens);
+  free(s->recall);
+  free(s->recalled.offsets);
+  free(s);
+}
+
+void shellhop_set_flags(struct shellhop* s, int flags) {
+  /* Any letter may be the next character of a regex, so it can't be a label */
+  if (flags & SHELLHOP_REGEX) {
+    flags &= ~SHELLHOP_LABELS;
+  }
+  s->flags = flags;
+  if ((flags & (SHELLHOP_IGNORE_CASE | SHELLHOP_SMART_CASE)) && s->folded == NULL) {
+    s->folded = malloc(s->line_len > 0 ? s->line_len : 1);
+    for (int i = 0; i < s->line_len; i++) {
+      s->folded[i] = fold(s->line[i]);
+    }
+  }
+  if ((flags & SHELLHOP_LABELS) && s->tokens == NULL) {
+    s->tokens = malloc(s->line_len > 0 ? s->line_len : 1);
+    for (int i = 0; i < s->line_len; i++) {
+      int kind = token_kind(s->line[i]);
+      s->tokens[i] = kind != 0 && (i == 0 || token_kind(s->line[i - 1]) != kind);
+    }
+  }
+}
+
+void shellhop_set_recall(struct shellhop* s, const char* needle, size_t len) {
+  free(s->recall);
+  s->recall = malloc(len > 0 ? len : 1);
+  memcpy(s->recall, needle, len);
+  s->recall_len = len;
+  s->recalled.count = -1;
+
+  /* On long lines the search is left to the worker, when Ctrl-R is typed */
+  if (len == 0 || s->needle_len > 0 || s->line_len >= WORKER_THRESHOLD) {
+    return;
+  }
+  reserve(s, len);
+  memcpy(s->needle, needle, len);
+  if (!(s->flags & SHELLHOP_REGEX) || regex_for(s, len) != NULL) {
+    if (!find_all(s, s->needle, len, &s->recalled)) {
+      s->recalled.count = -1;
+    }
+  }
+  memset(s->needle, 0, len);
+}
+
+void shellhop_set_highlight_limit(struct shellhop* s, int limit) {
+  s->highlight_limit = limit > 0 ? limit : 0;
+}
+
+int shellhop_feed(struct shellhop* s, const char* keys, size_t len) {
+  size_t used;
+  return feed_keys(s, keys, len, &used);
+}
+
+/*
+ * Apply keys as described for shellhop_feed. A cancelled search stops early
+ * with the keys before it applied, and *used is set to how many there were.
+ */
+static int feed_keys(struct shellhop* s, const char* keys, size_t len, size_t* used) {
+  for (size_t k = 0; k < len; k++) {
+    char c = keys[k];
+    const struct match_set* cur = &s->matches[s->needle_len];
+    int label_count = s->label_count;
+    s->label_count = 0;
+    *used = k + 1;
+    if (c == '\r') {
+      return SHELLHOP_ACCEPT;
+    } else if (c == '\e' || c == ('c' & 0x1f)) {
+      return SHELLHOP_CANCEL;
+    } else if (c == 127 /* DEL */) {
+      if (s->needle_len > 0) {
+        struct match_set* prev = &s->matches[s->needle_len - 1];
+        if (prev->count < 0 && !find_all(s, s->needle, s->needle_len - 1, prev)) {
+          prev->count = -1;
+          *used = k;
+          return SHELLHOP_CONTINUE;
+        }
+        s->needle[--s->needle_len] = '\0';
+        follow(s);
+      }
+    } else if (c == ('n' & 0x1f) /* ctrl-N */) {
+      /* A regex may have no matches */
+      if (cur->count > 0) {
+        s->current = (s->current + 1) % cur->count;
+        s->result = cur->offsets[s->current];
+      } else if (s->needle_len == 0 && s->line_len > 0) {
+        do {
+          s->result = (s->result + 1) % s->line_len;
+        } while (!char_start(s, s->result));
+      }
+    } else if (c == ('p' & 0x1f) /* ctrl-P */) {
+      if (cur->count > 0) {
+        s->current = (s->current + cur->count - 1) % cur->count;
+        s->result = cur->offsets[s->current];
+      } else if (s->needle_len == 0 && s->line_len > 0) {
+        do {
+          s->result = (s->result + s->line_len - 1) % s->line_len;
+        } while (!char_start(s, s->result));
+      }
+    } else if (c == ('r' & 0x1f) /* ctrl-R */) {
+      if (s->needle_len == 0 && !recall(s)) {
+        *used = k;
+        return SHELLHOP_CONTINUE;
+      }
+    } else if (memchr(s->labels, c, label_count) != NULL) {
+      s->result = s->labelled[(char*)memchr(s->labels, c, label_count) - s->labels];
+      s->current = lower_bound(cur, s->result);
+      return SHELLHOP_ACCEPT;
+    } else {
+      /* Apply a run of typed characters at once */
+      size_t n = 1;
+      while (k + n < len && !is_command(keys[k + n])) {
+        n++;
+      }
+      int done = extend(s, keys + k, n);
+      if (done < n) {
+        *used = k + done;
+        return SHELLHOP_CONTINUE;
+      }
+      k += n - 1;
+    }
+  }
+  *used = len;
+  return SHELLHOP_CONTINUE;
+}
+
+int shellhop_cursor(const struct shellhop* s) {
+  return s->result;
+}
+
+const char* shellhop_needle(const struct shellhop* s, int* len) {
+  *len = s->needle_len;
+  return s->needle;
+}
+
+const int* shellhop_matches(const struct shellhop* s, int* count) {
+  *count = s->needle_len > 0 ? s->matches[s->needle_len].count : 0;
+  return s->matches[s->needle_len].offsets;
+}
+
+int shellhop_current(const struct shellhop* s) {
+  return s->current;
+}
+
+int shellhop_char_index(const struct shellhop* s, int offset) {
+  return s->chars != NULL ? s->chars[offset] : offset;
+}
+
+/* Make room for n more needle characters */
+static void reserve(struct shellhop* s, int n) {
+  while (s->needle_len + n >= s->needle_cap) {
+    s->needle = realloc(s->needle, s->needle_cap * 2);
+    s->folded_needle = realloc(s->folded_needle, s->needle_cap * 2);
+    s->matches = realloc(s->matches, s->needle_cap * 2 * sizeof(s->matches[0]));
+    memset(s->needle + s->needle_cap, 0, s->needle_cap);
+    s->regexes = realloc(s->regexes, s->needle_cap * 2 * sizeof(s->regexes[0]));
+    memset(s->matches + s->needle_cap, 0, s->needle_cap * sizeof(s->matches[0]));
+    memset(s->regexes + s->needle_cap, 0, s->needle_cap * sizeof(s->regexes[0]));
+    s->needle_cap *= 2;
+  }
+}
+
+/* Move to the first match at or after the current one */
+static void follow(struct shellhop* s) {
+  struct match_set* cur = &s->matches[s->needle_len];
+  s->current = lower_bound(cur, s->result);
+  if (s->current == cur->count) {
+    s->current = 0;
+  }
+  if (cur->count > 0) {
+    s->result = cur->offsets[s->current];
+  }
+  if ((s->flags & SHELLHOP_LABELS) && s->needle_len >= LABEL_NEEDLE_LEN) {
+    find_taken(s, cur);
+  }
+}
+
+/*
+ * Note the characters that could extend the needle at any of its matches, on
+ * screen or not. Done once per needle rather than per frame, as there may be
+ * many matches.
+ */
+static void find_taken(struct shellhop* s, struct match_set* set) {
+  const char* line = folds_case(s, s->needle, s->needle_len) ? s->folded : s->line;
+  memset(set->taken, 0, sizeof(set->taken));
+  for (int j = 0; j < set->count; j++) {
+    int next = match_end_of(s, set->offsets[j], s->line_len);
+    if (next < s->line_len) {
+      set->taken[(unsigned char)line[next]] = true;
+    }
+  }
+}
+
+/*
+ * Extend the needle by c if that leaves at least one match. Returns false if
+ * the search was cancelled.
+ */
+static bool append(struct shellhop* s, char c) {
+  reserve(s, 1);
+  int len = s->needle_len;
+  struct match_set* next = &s->matches[len + 1];
+
+  /*
+   * With smart case the first uppercase letter makes the search case
+   * sensitive, and the matches so far have to be checked again.
+   */
+  s->needle[len] = c;
+  bool ok;
+  if (s->flags & SHELLHOP_REGEX) {
+    /*
+     * A longer pattern can match where a shorter one didn't, so each is
+     * searched afresh. It is kept even without matches, as typing more may
+     * bring some back, but not if it doesn't parse.
+     */
+    if (regex_for(s, len + 1) == NULL) {
+      s->needle[len] = '\0';
+      return true;
+    }
+    ok = find_all(s, s->needle, len + 1, next);
+  } else {
+    ok = folds_case(s, s->needle, len) == folds_case(s, s->needle, len + 1)
+             ? narrow(s, &s->matches[len], len, c, next)
+             : find_all(s, s->needle, len + 1, next);
+  }
+  if (ok && (next->count > 0 || (s->flags & SHELLHOP_REGEX))) {
+    s->needle_len++;
+    follow(s);
+  } else {
+    s->needle[len] = '\0';
+  }
+  return ok;
+}
+
+/*
+ * Extend the needle by several characters, e.g. from a paste. Narrowing one
+ * character at a time costs a pass over each intermediate match set, which
+ * is quadratic for lines like "aaaa..." so the whole needle is searched for
+ * in one pass instead and the intermediate sets are left to be computed if
+ * backspace reaches them. If it doesn't match, the characters are appended
+ * one at a time so that those that don't match are skipped as usual.
+ * Returns the number of characters applied before any cancellation.
+ */
+static int extend(struct shellhop* s, const char* chars, int n) {
+  if (n == 1) {
+    return append(s, chars[0]);
+  }
+  reserve(s, n);
+  int len = s->needle_len + n;
+  memcpy(s->needle + s->needle_len, chars, n);
+  struct match_set* top = &s->matches[len];
+  bool found;
+  if (s->flags & SHELLHOP_REGEX) {
+    found = regex_for(s, len) != NULL && find_all(s, s->needle, len, top);
+  } else {
+    found = find_all(s, s->needle, len, top) && top->count > 0;
+  }
+  if (found) {
+    for (int i = s->needle_len + 1; i < len; i++) {
+      s->matches[i].count = -1;
+    }
+    s->needle_len = len;
+    follow(s);
+    return n;
+  }
+  memset(s->needle + s->needle_len, 0, n);
+  if (cancelled(s, 0)) {
+    return 0;
+  }
+  for (int i = 0; i < n; i++) {
+    if (!append(s, chars[i])) {
+      return i;
+    }
+  }
+  return n;
+}
+
+/*
+ * Replace the empty needle with the recalled one if it matches, or for a
+ * regex if it parses. Returns false if the search was cancelled.
+ */
+static bool recall(struct shellhop* s) {
+  int n = s->recall_len;
+  if (n == 0) {
+    return true;
+  }
+  reserve(s, n);
+  memcpy(s->needle, s->recall, n);
+  struct match_set* top = &s->matches[n];
+  bool regex = s->flags & SHELLHOP_REGEX;
+  bool found = !regex || regex_for(s, n) != NULL;
+  if (found && s->recalled.count >= 0) {
+    int count = s->recalled.count;
+    top->offsets = realloc(top->offsets, (count > 0 ? count : 1) * sizeof(top->offsets[0]));
+    memcpy(top->offsets, s->recalled.offsets, count * sizeof(top->offsets[0]));
+    top->count = count;
+  } else if (found && !find_all(s, s->needle, n, top)) {
+    memset(s->needle, 0, n);
+    return false;
+  }
+  if (!found || (!regex && top->count == 0)) {
+    memset(s->needle, 0, n);
+    return true;
+  }
+  for (int i = 1; i < n; i++) {
+    s->matches[i].count = -1;
+  }
+  s->needle_len = n;
+  follow(s);
+  return true;
+}
+
+int shellhop_render(struct shellhop* s, int width, char* text,
+                    unsigned char* styles, int size) {
+  struct frame frame = { NULL };
+  build_frame(s, width, &frame);
+  for (int i = 0, run = 0; i < frame.len && i < size; i++) {
+    text[i] = frame.text[i];
+    styles[i] = cell_graphics(&frame, i, &run);
+  }
+  free(frame.text);
+  free(frame.cols);
+  free(frame.runs);
+  return frame.len;
+}
+
+int shellhop_replay(const char* line, size_t line_len, const char* keys,
+                    size_t keys_len, int width, int flags, FILE* report) {
+  struct frame frames[2] = { { NULL }, { NULL } };
+  struct frame* prev_frame = NULL;
+  struct frame* frame = &frames[0];
+
+  /* Frames are drawn to memory first to count the bytes in each */
+  char* buf = NULL;
+  size_t size = 0;
+  size_t written = 0;
+  out = open_memstream(&buf, &size);
+  fputs(beginning_of_line, out);
+  fputs(save_cursor, out);
+  fputs(hide_cursor, out);
+
+  struct shellhop* s = shellhop_new(line, line_len);
+  shellhop_set_flags(s, flags);
+  highlight_limit_from_env(s);
+  int status = SHELLHOP_CONTINUE;
+  double total_search = 0;
+  double total_render = 0;
+  fprintf(report, "key\tsearch_us\trender_us\tbytes\n");
+  for (size_t k = 0; k <= keys_len && status == SHELLHOP_CONTINUE; k++) {
+    /* The first row is the initial frame, before any key */
+    double start = now_us();
+    if (k > 0) {
+      status = shellhop_feed(s, &keys[k - 1], 1);
+    }
+    double searched = now_us();
+    if (status == SHELLHOP_CONTINUE) {
+      build_frame(s, width, frame);
+      draw_frame(prev_frame, frame);
+      prev_frame = frame;
+      frame = &frames[frame == &frames[0]];
+    } else {
+      fputs(restore_cursor, out);
+      fputs(clear, out);
+      fputs(show_cursor, out);
+    }
+    fflush(out);
+    double rendered = now_us();
+
+    size_t bytes = size - written;
+    fwrite(buf + written, 1, bytes, stderr);
+    written = size;
+    total_search += searched - start;
+    total_render += rendered - searched;
+    if (k == 0) {
+      fprintf(report, "start");
+    } else {
+      fprintf(report, "0x%02x", (unsigned char)keys[k - 1]);
+    }
+    fprintf(report, "\t%.1f\t%.1f\t%zu\n", searched - start, rendered - searched, bytes);
+  }
+  fprintf(report, "total\t%.1f\t%.1f\t%zu\n", total_search, total_render, written);
+  fclose(out);
+  free(buf);
+
+  for (int i = 0; i < 2; i++) {
+    free(frames[i].text);
+    free(frames[i].cols);
+    free(frames[i].runs);
+  }
+  int result = status == SHELLHOP_ACCEPT ? s->result : status == SHELLHOP_CANCEL ? 0 : -1;
+  if (result > 0 && (flags & SHELLHOP_CHARS)) {
+    result = shellhop_char_index(s, result);
+  }
+  shellhop_free(s);
+  return result;
+}
+
+static struct worker* worker_start(struct shellhop* s) {
+  struct worker* w = calloc(1, sizeof(*w));
+  w->s = s;
+  pthread_mutex_init(&w->lock, NULL);
+  pthread_cond_init(&w->cond, NULL);
+  if (pipe(w->wake) < 0) {
+    free(w);
+    return NULL;
+  }
+  fcntl(w->wake[0], F_SETFL, O_NONBLOCK);
+  fcntl(w->wake[1], F_SETFL, O_NONBLOCK);
+
+  /* Signals are handled by the main thread */
+  sigset_t all;
+  sigset_t mask;
+  sigfillset(&all);
+  pthread_sigmask(SIG_SETMASK, &all, &mask);
+  int err = pthread_create(&w->thread, NULL, worker_main, w);
+  pthread_sigmask(SIG_SETMASK, &mask, NULL);
+  if (err != 0) {
+    close(w->wake[0]);
+    close(w->wake[1]);
+    free(w);
+    return NULL;
+  }
+  s->worker = w;
+  return w;
+}
+
+static void worker_stop(struct worker* w) {
+  pthread_mutex_lock(&w->lock);
+  w->quit = true;
+  w->cancel = true;
+  pthread_cond_signal(&w->cond);
+  pthread_mutex_unlock(&w->lock);
+  pthread_join(w->thread, NULL);
+  w->s->worker = NULL;
+  pthread_mutex_destroy(&w->lock);
+  pthread_cond_destroy(&w->cond);
+  close(w->wake[0]);
+  close(w->wake[1]);
+  free(w->keys);
+  free(w);
+}
+
+static void* worker_main(void* arg) {
+  struct worker* w = arg;
+  char* keys = NULL;
+  size_t cap = 0;
+  pthread_mutex_lock(&w->lock);
+  while (!w->quit) {
+    if (w->len == 0 || w->status != SHELLHOP_CONTINUE) {
+      pthread_cond_wait(&w->cond, &w->lock);
+      continue;
+    }
+
+    /* Take every waiting key */
+    size_t len = w->len;
+    if (len > cap) {
+      cap = len;
+      keys = realloc(keys, cap);
+    }
+    memcpy(keys, w->keys, len);
+    w->len = 0;
+    w->cancel = false;
+    pthread_mutex_unlock(&w->lock);
+
+    size_t used;
+    double start = now_us();
+    int status = feed_keys(w->s, keys, len, &used);
+    trace_record("search", 2, start, used);
+
+    pthread_mutex_lock(&w->lock);
+    w->status = status;
+    if (status == SHELLHOP_CONTINUE && used < len) {
+      /* Cancelled; put back the keys that weren't applied, before newer ones */
+      size_t rest = len - used;
+      if (w->len + rest > w->cap) {
+        w->cap = (w->len + rest) * 2;
+        w->keys = realloc(w->keys, w->cap);
+      }
+      memmove(w->keys + rest, w->keys, w->len);
+      memcpy(w->keys, keys + used, rest);
+      w->len += rest;
+    }
+    if (w->len == 0 || status != SHELLHOP_CONTINUE) {
+      w->busy = false;
+      /* Nonblocking; a full pipe already wakes the main thread */
+      ssize_t n = write(w->wake[1], "", 1);
+      (void)n;
+    }
+  }
+  pthread_mutex_unlock(&w->lock);
+  free(keys);
+  return NULL;
+}
+
+/*
+ * Queue keys for the worker, cancelling its current search. Escape and
+ * Ctrl-C cancel shellhop at once rather than waiting for the search.
+ */
+static int worker_feed(struct worker* w, const char* keys, size_t len) {
+  for (size_t k = 0; k < len; k++) {
+    if (keys[k] == '\r') {
+      break;
+    } else if (keys[k] == '\e' || keys[k] == ('c' & 0x1f)) {
+      return SHELLHOP_CANCEL;
+    }
+  }
+  pthread_mutex_lock(&w->lock);
+  if (w->len + len > w->cap) {
+    w->cap = (w->len + len) * 2;
+    w->keys = realloc(w->keys, w->cap);
+  }
+  memcpy(w->keys + w->len, keys, len);
+  w->len += len;
+  w->busy = true;
+  w->cancel = true;
+  pthread_cond_signal(&w->cond);
+  pthread_mutex_unlock(&w->lock);
+  return SHELLHOP_CONTINUE;
+}
+
+/*
+ * Status of the applied keys, and whether the worker is still busy after
+ * giving it up to timeout milliseconds to finish.
+ */
+static int worker_poll(struct worker* w, int timeout, bool* busy) {
+  pthread_mutex_lock(&w->lock);
+  *busy = w->busy;
+  pthread_mutex_unlock(&w->lock);
+  if (*busy) {
+    struct pollfd pfd = { .fd = w->wake[0], .events = POLLIN };
+    poll(&pfd, 1, timeout);
+  }
+
+  char buf[64];
+  while (read(w->wake[0], buf, sizeof(buf)) > 0) {
+  }
+  pthread_mutex_lock(&w->lock);
+  *busy = w->busy;
+  int status = w->status;
+  pthread_mutex_unlock(&w->lock);
+  return status;
+}
+
+/* Copy the last complete frame, marking that a search is running */
+static void show_searching(const struct frame* prev, struct frame* frame) {
+  frame->len = 0;
+  frame->width = 0;
+  frame_append(frame, prev->text, prev->len);
+  memcpy(frame->cols, prev->cols, prev->len * sizeof(prev->cols[0]));
+  frame->width = prev->width;
+  memcpy(frame->text, searching_prompt, strlen(searching_prompt));
+  frame->run_count = 0;
+  for (int i = 0; i < prev->run_count; i++) {
+    const struct run* r = &prev->runs[i];
+    frame_highlight(frame, r->start, r->start + r->len, r->graphics);
+  }
+}
+
+int shellhop_interactive(const char* line, size_t line_len, int flags) {
+  struct shellhop* s = shellhop_new(line, line_len);
+  int result = shellhop_run(s, flags);
+  shellhop_free(s);
+  return result;
+}
+
+int shellhop_run(struct shellhop* s, int flags) {
+  struct frame* frames = s->frames;
+  struct frame* prev_frame = NULL;
+  struct frame* frame = &frames[0];
+
+  bool raw = isatty(STDIN_FILENO);
+  if (raw && !set_raw_mode(flags)) {
+    return -1;
+  }
+
+  /*
+   * SIGWINCH stays blocked except while waiting for input, so a resize
+   * can't slip in between checking window_changed and blocking.
+   */
+  struct sigaction sa = { .sa_handler = sigwinch };
+  struct sigaction old_sa;
+  sigaction(SIGWINCH, &sa, &old_sa);
+  sigset_t winch_mask;
+  sigset_t old_mask;
+  sigemptyset(&winch_mask);
+  sigaddset(&winch_mask, SIGWINCH);
+  sigprocmask(SIG_BLOCK, &winch_mask, &old_mask);
+  wait_mask = old_mask;
+  sigdelset(&wait_mask, SIGWINCH);
+  window_changed = 0;
+  int width = terminal_width();
+
+  out = open_memstream(&out_buf, &out_len);
+  trace_open();
+
+  shellhop_set_flags(s, flags);
+  highlight_limit_from_env(s);
+  struct history history = { -1, NULL };
+  if ((flags & SHELLHOP_HISTORY) && history_open(&history)) {
+    char last[HISTORY_NEEDLE_MAX];
+    shellhop_set_recall(s, last, history_last(&history, last));
+  }
+  struct worker* worker = NULL;
+  if (s->line_len >= WORKER_THRESHOLD) {
+    worker = worker_start(s);
+  }
+  int status = SHELLHOP_CONTINUE;
+
+  /*
+   * Keys typed before raw mode was set are applied before the first frame.
+   * Enter was read as a newline then.
+   */
+  bool typeahead = raw && input_pending(STDIN_FILENO);
+  bool typeahead_icrnl = typeahead && (orig_termios.c_iflag & ICRNL);
+
+  fputs(beginning_of_line, out);
+  fputs(save_cursor, out);
+  fputs(hide_cursor, out);
+
+  while (status == SHELLHOP_CONTINUE) {
+    if (window_changed) {
+      window_changed = 0;
+      width = terminal_width();
+      prev_frame = NULL;
+    }
+
+    bool searching = false;
+    if (worker != NULL) {
+      status = worker_poll(worker, SEARCHING_DELAY, &searching);
+      if (status != SHELLHOP_CONTINUE) {
+        break;
+      }
+    }
+
+    /*
+     * Draw frame. During a search the last complete frame stays up, marked
+     * as searching, or nothing is drawn if the window was just resized.
+     * Nor is anything drawn before typeahead is applied.
+     */
+    bool draw = !typeahead && (!searching || prev_frame != NULL);
+    typeahead = false;
+    double start = now_us();
+    if (draw && !searching) {
+      build_frame(s, width, frame);
+      trace_record("build", 1, start, frame->len);
+    } else if (draw) {
+      show_searching(prev_frame, frame);
+    }
+    if (draw) {
+      start = now_us();
+      draw_frame(prev_frame, frame);
+      fflush(out);
+      trace_record("draw", 1, start, out_len);
+      flush_output();
+      prev_frame = frame;
+      frame = &frames[frame == &frames[0]];
+    }
+
+    /*
+     * Read input. Everything already pending on the terminal is applied
+     * before the next frame is drawn.
+     */
+    do {
+      char input[BUFSIZ];
+      if (!wait_input(STDIN_FILENO, worker != NULL ? worker->wake[0] : -1)) {
+        continue;
+      } else if (!input_pending(STDIN_FILENO)) {
+        /* Woken by the worker finishing a search */
+        break;
+      }
+      double start = now_us();
+      ssize_t n = read(STDIN_FILENO, input, sizeof(input));
+      trace_syscalls++;
+      trace_record("read", 1, start, n);
+      if (n < 0 && errno == EINTR) {
+        continue;
+      } else if (n <= 0) {
+        status = -1;
+        break;
+      }
+      if (typeahead_icrnl) {
+        typeahead_icrnl = false;
+        for (char* p = memchr(input, '\n', n); p != NULL; p = memchr(p, '\n', input + n - p)) {
+          *p = '\r';
+        }
+      }
+      start = now_us();
+      if (worker != NULL) {
+        status = worker_feed(worker, input, n);
+      } else {
+        status = shellhop_feed(s, input, n);
+        trace_record("search", 1, start, n);
+      }
+    } while (status == SHELLHOP_CONTINUE && input_pending(STDIN_FILENO));
+  }
+
+  if (worker != NULL) {
+    worker_stop(worker);
+  }
+
+  fputs(restore_cursor, out);
+  fputs(clear, out);
+  fputs(show_cursor, out);
+  flush_output();
+  fclose(out);
+  free(out_buf);
+  out_buf = NULL;
+  if (trace_fd >= 0) {
+    trace_dump();
+    close(trace_fd);
+    trace_fd = -1;
+    free(trace_events);
+    trace_events = NULL;
+  }
+
+  if (raw) {
+    restore_termios();
+    sigaction(SIGINT, &old_sigint, NULL);
+  }
+  sigprocmask(SIG_SETMASK, &old_mask, NULL);
+  sigaction(SIGWINCH, &old_sa, NULL);
+
+  if (status == SHELLHOP_ACCEPT && history.file != NULL) {
+    history_add(&history, s->needle, s->needle_len);
+  }
+  history_close(&history);
+
+  int result = status == SHELLHOP_ACCEPT ? s->result : status == SHELLHOP_CANCEL ? 0 : -1;
+  if (result > 0 && (flags & SHELLHOP_CHARS)) {
+    result = shellhop_char_index(s, result);
+  }
+  return result;
+}
+
+int shellhop_repeat(const char* line, size_t line_len, int flags) {
+  struct history history;
+  if (!history_open(&history)) {
+    return -1;
+  }
+  char needle[HISTORY_NEEDLE_MAX];
+  int len = history_last(&history, needle);
+  history_close(&history);
+
+  struct shellhop* s = shellhop_new(line, line_len);
+  shellhop_set_flags(s, flags);
+  s->recall = malloc(len > 0 ? len : 1);
+  memcpy(s->recall, needle, len);
+  s->recall_len = len;
+  recall(s);
+  int result = -1;
+  if (s->needle_len > 0 && s->matches[s->needle_len].count > 0) {
+    result = s->result;
+    if (flags & SHELLHOP_CHARS) {
+      result = shellhop_char_index(s, result);
+    }
+  }
+  shellhop_free(s);
+  return result;
+}
+
+/* Build the frame, showing only the part of the line that fits */
+static void build_frame(struct shellhop* s, int width, struct frame* frame) {
+  int prompt_len = strlen(prompt);
+  int needle_len = s->needle_len;
+  int result = s->result;
+  const struct match_set* cur = &s->matches[needle_len];
+  char counter[64] = "";
+  if (needle_len > 0) {
+    snprintf(counter, sizeof(counter), " [%d/%d]", cur->count > 0 ? s->current + 1 : 0,
+             cur->count);
+  }
+
+  /* Of a multi-line buffer, only the row holding the current match is shown */
+  int row = row_of(s, result);
+  int row_start = s->rows ? s->rows[row] : 0;
+  int row_end = row + 1 < s->row_count ? s->rows[row + 1] - 1 : s->line_len;
+  if (s->rows) {
+    int len = strlen(counter);
+    snprintf(counter + len, sizeof(counter) - len, " [line %d/%d]", row + 1, s->row_count);
+  }
+  int counter_len = strlen(counter);
+  if (s->view_start < row_start || s->view_start > row_end) {
+    s->view_start = row_start;
+  }
+
+  /* The view is placed in columns, then mapped back to whole cells */
+  int base = column(s, row_start);
+  int line_width = column(s, row_end) - base;
+  int avail = line_width;
+  if (width > 0) {
+    avail = width - 1 - prompt_len - counter_len;
+  }
+  /* A match wider than the view only needs measuring as far as it fits */
+  int fits = offset_at_column(s, column(s, result) + avail);
+  int match_end = cell_ceil(s, match_end_of(s, result, fits < row_end ? fits : row_end));
+  if (match_end > row_end) {
+    match_end = row_end;
+  }
+  int match_col = column(s, result) - base;
+  int match_width = column(s, match_end) - base - match_col;
+  int view_start = offset_at_column(s, base + scroll_view(column(s, s->view_start) - base,
+                                                          line_width, avail, match_col,
+                                                          match_width));
+  int start_col = column(s, view_start) - base;
+  int end_col = base + start_col + view_len(start_col, line_width, avail);
+  int view_end = offset_at_column(s, end_col);
+  if (column(s, view_end) > end_col) {
+    /* The last cell doesn't fit */
+    view_end = cell_floor(s, view_end - 1);
+  }
+  s->view_start = view_start;
+  s->label_count = 0;
+  if ((s->flags & SHELLHOP_LABELS) && needle_len >= LABEL_NEEDLE_LEN) {
+    assign_labels(s, view_start, view_end);
+  }
+
+  frame->len = 0;
+  frame->width = 0;
+  frame_append(frame, prompt, prompt_len);
+  if (view_start > row_start) {
+    frame_append(frame, ellipsis, ELLIPSIS_LEN);
+  }
+  int line_col = frame->len - view_start;
+  frame_append_line(frame, s, view_start, view_end);
+  if (view_end < row_end) {
+    frame_append(frame, ellipsis, ELLIPSIS_LEN);
+  }
+  frame_append(frame, counter, counter_len);
+
+  /*
+   * Highlight visible matches. Overlapping or adjacent matches other than
+   * the current one are merged into a single underlined span, which is then
+   * split where it crosses the current match.
+   */
+  frame->run_count = 0;
+  if (needle_len == 0) {
+    return;
+  }
+  int cur_start = result > view_start ? cell_floor(s, result) : view_start;
+  int cur_end = cell_ceil(s, match_end_of(s, result, view_end));
+  if (cur_end > view_end) {
+    cur_end = view_end;
+  }
+  int* spans = NULL;
+  int span_count = 0;
+  int span_start = 0;
+  int span_end = 0;
+  /* Regex matches starting before the view are left out */
+  int first = lower_bound(cur, s->flags & SHELLHOP_REGEX ? view_start
+                                                         : view_start - needle_len + 1);
+  for (int j = first; j < cur->count && cur->offsets[j] < view_end; j++) {
+    int i = cur->offsets[j];
+    if (i == result) {
+      continue;
+    } else if (i <= span_end && span_end > span_start) {
+      int end = cell_ceil(s, match_end_of(s, i, view_end));
+      span_end = end > span_end ? end : span_end;
+      continue;
+    }
+    spans = add_span(spans, &span_count, span_start, span_end);
+    span_start = i > view_start ? cell_floor(s, i) : view_start;
+    span_end = cell_ceil(s, match_end_of(s, i, view_end));
+  }
+  if (span_end > view_end) {
+    span_end = view_end;
+  }
+  spans = add_span(spans, &span_count, span_start, span_end);
+
+  /*
+   * Each span costs a pair of escape sequences, so when matches are dense
+   * only those nearest the current match are underlined. That bounds the
+   * size of a frame whatever the line, and Ctrl-N/Ctrl-P still step
+   * through every match.
+   */
+  int lo = 0;
+  int hi = span_count;
+  int limit = s->highlight_limit;
+  if (limit > 0 && span_count > limit) {
+    int before = 0;
+    while (before < span_count && spans[before * 2 + 1] <= cur_start) {
+      before++;
+    }
+    lo = before - limit / 2;
+    lo = lo < 0 ? 0 : lo > span_count - limit ? span_count - limit : lo;
+    hi = lo + limit;
+  }
+  int pos = view_start;
+  for (int k = lo; k < hi; k++) {
+    highlight_span(frame, line_col, spans[k * 2], spans[k * 2 + 1], cur_start, cur_end,
+                   &pos);
+  }
+  free(spans);
+  if (pos < cur_start) {
+    pos = cur_start;
+  }
+  frame_highlight(frame, line_col + pos, line_col + cur_end, GRAPHICS_REVERSE_VIDEO);
+
+  /* Labels are drawn over the first character of their matches */
+  for (int j = 0; j < s->label_count; j++) {
+    frame->text[line_col + s->labelled[j]] = s->labels[j];
+    frame_mark(frame, line_col + s->labelled[j], GRAPHICS_LABEL);
+  }
+}
+
+/*
+ * Label the matches starting between start and end, other than the current
+ * one. A label is never a character that could extend the needle at any
+ * match, as noted by find_taken, so typing it can't be mistaken for narrowing
+ * the search.
+ * Matches at token starts are labelled first, nearest the current match
+ * first. Only matches starting with an ASCII character are labelled, so that
+ * the label fits in its cell.
+ */
+static void assign_labels(struct shellhop* s, int start, int end) {
+  const struct match_set* cur = &s->matches[s->needle_len];
+  int first = lower_bound(cur, start);
+  int last = lower_bound(cur, end);
+  char keys[LABEL_MAX];
+  int key_count = 0;
+  for (int k = 0; k < LABEL_MAX; k++) {
+    if (!cur->taken[(unsigned char)label_keys[k]]) {
+      keys[key_count++] = label_keys[k];
+    }
+  }
+
+  for (int pass = 0; pass < 2; pass++) {
+    for (int d = 1; s->label_count < key_count; d++) {
+      int before = s->current - d;
+      int after = s->current + d;
+      if (before < first && after >= last) {
+        break;
+      }
+      int candidates[2] = { after, before };
+      for (int k = 0; k < 2 && s->label_count < key_count; k++) {
+        int j = candidates[k];
+        if (j < first || j >= last) {
+          continue;
+        }
+        int i = cur->offsets[j];
+        if ((s->line[i] & 0x80) || s->tokens[i] != (pass == 0)) {
+          continue;
+        }
+        s->labelled[s->label_count] = i;
+        s->labels[s->label_count] = keys[s->label_count];
+        s->label_count++;
+      }
+    }
+  }
+}
+
+/* 0 for whitespace, 1 for word characters and 2 for anything else */
+static int token_kind(char c) {
+  if (c == ' ' || c == '\t' || c == '\n') {
+    return 0;
+  } else if ((c >= 'a' && c <= 'z') || (c >= 'A' && c <= 'Z') || (c >= '0' && c <= '9') ||
+             c == '_' || (c & 0x80)) {
+    return 1;
+  }
+  return 2;
+}
+
+/* Append [start, end) to an array of start and end pairs unless it's empty */
+static int* add_span(int* spans, int* count, int start, int end) {
+  if (end <= start) {
+    return spans;
+  }
+  if ((*count & (*count - 1)) == 0) {
+    spans = realloc(spans, (*count > 0 ? *count * 2 : 1) * 2 * sizeof(spans[0]));
+  }
+  spans[*count * 2] = start;
+  spans[*count * 2 + 1] = end;
+  (*count)++;
+  return spans;
+}
+
+/*
+ * Add runs for the underlined line offsets [start, end), reversing the part
+ * within the current match [cur_start, cur_end). Any part of the current
+ * match between *pos and start is added first. *pos is left at end.
+ */
+static void highlight_span(struct frame* frame, int col, int start, int end,
+                           int cur_start, int cur_end, int* pos) {
+  if (end <= start) {
+    return;
+  }
+  int before = *pos > cur_start ? *pos : cur_start;
+  frame_highlight(frame, col + before, col + (start < cur_end ? start : cur_end),
+                  GRAPHICS_REVERSE_VIDEO);
+  int cuts[4] = { start, cur_start, cur_end, end };
+  for (int k = 1; k < 3; k++) {
+    cuts[k] = cuts[k] < start ? start : cuts[k] > end ? end : cuts[k];
+  }
+  for (int k = 0; k < 3; k++) {
+    enum graphics g = GRAPHICS_UNDERLINE;
+    if (cuts[k] >= cur_start && cuts[k] < cur_end) {
+      g |= GRAPHICS_REVERSE_VIDEO;
+    }
+    frame_highlight(frame, col + cuts[k], col + cuts[k + 1], g);
+  }
+  *pos = end;
+}
+
+/* Append single-column cells with normal graphics */
+static void frame_append(struct frame* frame, const char* text, int len) {
+  if (frame->len + len > frame->cap) {
+    frame->cap = (frame->len + len) * 2;
+    frame->text = realloc(frame->text, frame->cap);
+    frame->cols = realloc(frame->cols, frame->cap * sizeof(frame->cols[0]));
+  }
+  memcpy(frame->text + frame->len, text, len);
+  for (int i = 0; i < len; i++) {
+    frame->cols[frame->len + i] = frame->width + i;
+  }
+  frame->len += len;
+  frame->width += len;
+}
+
+/* Append the cells of line offsets [start, end), which must be whole cells */
+static void frame_append_line(struct frame* frame, const struct shellhop* s,
+                              int start, int end) {
+  int pos = frame->len;
+  int base = frame->width - column(s, start);
+  frame_append(frame, s->line + start, end - start);
+  if (s->cols != NULL) {
+    for (int i = start; i < end; i++) {
+      frame->cols[pos + i - start] = base + s->cols[i];
+    }
+    frame->width = base + s->cols[end];
+  }
+}
+
+/* Offset of the cell after the one holding frame->text[i] */
+static int next_cell(const struct frame* frame, int i) {
+  int col = frame->cols[i];
+  while (++i < frame->len && frame->cols[i] == col) {
+  }
+  return i;
+}
+
+/*
+ * Draw cells [start, end) with graphics. Runs must be added in order; one
+ * that continues the previous run with the same graphics extends it.
+ */
+static void frame_highlight(struct frame* frame, int start, int end, enum graphics graphics) {
+  if (end <= start) {
+    return;
+  }
+  struct run* last = frame->run_count > 0 ? &frame->runs[frame->run_count - 1] : NULL;
+  if (last != NULL && last->start + last->len == start && last->graphics == graphics) {
+    last->len += end - start;
+    return;
+  }
+  if (frame->run_count == frame->run_cap) {
+    frame->run_cap = frame->run_cap ? frame->run_cap * 2 : 16;
+    frame->runs = realloc(frame->runs, frame->run_cap * sizeof(frame->runs[0]));
+  }
+  frame->runs[frame->run_count++] = (struct run){ start, end - start, graphics };
+}
+
+/* Add graphics to the single-byte cell i, after the runs are complete */
+static void frame_mark(struct frame* frame, int i, enum graphics graphics) {
+  int r = 0;
+  while (r < frame->run_count && frame->runs[r].start + frame->runs[r].len <= i) {
+    r++;
+  }
+  struct run cell = { i, 1, graphics };
+  if (r < frame->run_count && frame->runs[r].start <= i) {
+    cell.graphics |= frame->runs[r].graphics;
+  }
+
+  /* Split the run holding the cell around it, or insert it between two */
+  if (frame->run_count + 2 > frame->run_cap) {
+    frame->run_cap = frame->run_count * 2 + 2;
+    frame->runs = realloc(frame->runs, frame->run_cap * sizeof(frame->runs[0]));
+  }
+  struct run before = { 0, 0, GRAPHICS_NORMAL };
+  struct run after = { 0, 0, GRAPHICS_NORMAL };
+  int replaced = 0;
+  if (r < frame->run_count && frame->runs[r].start <= i) {
+    struct run old = frame->runs[r];
+    before = (struct run){ old.start, i - old.start, old.graphics };
+    after = (struct run){ i + 1, old.start + old.len - i - 1, old.graphics };
+    replaced = 1;
+  }
+  struct run parts[3];
+  int n = 0;
+  if (before.len > 0) {
+    parts[n++] = before;
+  }
+  parts[n++] = cell;
+  if (after.len > 0) {
+    parts[n++] = after;
+  }
+  memmove(&frame->runs[r + n], &frame->runs[r + replaced],
+          (frame->run_count - r - replaced) * sizeof(frame->runs[0]));
+  memcpy(&frame->runs[r], parts, n * sizeof(parts[0]));
+  frame->run_count += n - replaced;
+}
+
+/* Graphics of cell i, advancing *run past the runs that end before it */
+static enum graphics cell_graphics(const struct frame* frame, int i, int* run) {
+  while (*run < frame->run_count &&
+         frame->runs[*run].start + frame->runs[*run].len <= i) {
+    (*run)++;
+  }
+  if (*run < frame->run_count && frame->runs[*run].start <= i) {
+    return frame->runs[*run].graphics;
+  }
+  return GRAPHICS_NORMAL;
+}
+
+/*
+ * Whether the cell at offset i is the same in both frames, in the same
+ * column; cells are visited in order
+ */
+static bool same_cell(const struct frame* old, const struct frame* new, int i,
+                      int* old_run, int* new_run) {
+  if (old == NULL || i >= old->len || old->cols[i] != new->cols[i] ||
+      (i > 0 && old->cols[i - 1] == old->cols[i])) {
+    return false;
+  }
+  int end = next_cell(new, i);
+  return end <= old->len && next_cell(old, i) == end &&
+         memcmp(old->text + i, new->text + i, end - i) == 0 &&
+         cell_graphics(old, i, old_run) == cell_graphics(new, i, new_run);
+}
+
+/*
+ * Number of columns of the line shown when the view starts at column
+ * "start" and "avail" columns are available, leaving room for the ellipses.
+ */
+static int view_len(int start, int line_len, int avail) {
+  if (line_len <= avail) {
+    return line_len;
+  }
+  int len = avail - (start > 0 ? ELLIPSIS_LEN : 0);
+  if (line_len - start > len) {
+    len -= ELLIPSIS_LEN;
+  }
+  if (len < 1) {
+    len = 1;
+  }
+  return len < line_len - start ? len : line_len - start;
+}
+
+/*
+ * Return a view start close to "start" that shows the match with some
+ * context. The view only scrolls when the match would be off screen, so
+ * moving between nearby matches does not repaint the whole line.
+ */
+static int scroll_view(int start, int line_len, int avail, int match, int match_len) {
+  if (line_len <= avail) {
+    return 0;
+  }
+  int margin = avail / 4 < SCROLL_MARGIN ? avail / 4 : SCROLL_MARGIN;
+  int end = match + match_len + margin;
+  if (end > line_len) {
+    end = line_len;
+  }
+  if (match - margin < start) {
+    start = match - margin;
+  } else if (start + view_len(start, line_len, avail) < end) {
+    if (end == line_len) {
+      start = line_len - (avail - ELLIPSIS_LEN);
+    } else {
+      start = end - (avail - 2 * ELLIPSIS_LEN);
+    }
+    if (start > match) {
+      /* The match is wider than the view; show its beginning */
+      start = match;
+    }
+  }
+  int max_start = line_len - (avail - ELLIPSIS_LEN);
+  if (start > max_start) {
+    start = max_start;
+  }
+  return start > 0 ? start : 0;
+}
+
+/*
+ * Write the cells of "new" that differ from "old". Passing a NULL "old"
+ * redraws everything and clears the rest of the screen.
+ */
+static void draw_frame(const struct frame* old, const struct frame* new) {
+  enum graphics cur_graphics = GRAPHICS_NORMAL;
+  int x = -1;
+  int i = 0;
+  int old_run = 0;
+  int new_run = 0;
+  while (i < new->len) {
+    if (same_cell(old, new, i, &old_run, &new_run)) {
+      i = next_cell(new, i);
+      continue;
+    }
+
+    /* Extend the span over short runs of unchanged cells */
+    int end = next_cell(new, i);
+    int old_ahead = old_run;
+    int new_ahead = new_run;
+    for (int j = end, gap = 0; j < new->len && gap < MERGE_GAP; j = next_cell(new, j)) {
+      if (same_cell(old, new, j, &old_ahead, &new_ahead)) {
+        gap++;
+      } else {
+        gap = 0;
+        end = next_cell(new, j);
+      }
+    }
+
+    move_cursor(&x, new->cols[i]);
+    for (; i < end; i++) {
+      change_graphics(cell_graphics(new, i, &new_run), &cur_graphics);
+      fputc(new->text[i], out);
+    }
+    x = end < new->len ? new->cols[end] : new->width;
+  }
+  change_graphics(GRAPHICS_NORMAL, &cur_graphics);
+
+  if (old == NULL || new->width < old->width) {
+    move_cursor(&x, new->width);
+    fputs(clear, out);
+  }
+}
+
+/* Move the cursor from column *x (-1 if unknown) to col */
+static void move_cursor(int* x, int col) {
+  if (*x < 0 || col < *x) {
+    fputs(restore_cursor, out);
+    *x = 0;
+  }
+  if (col - *x == 1) {
+    fputs("\e[C", out);
+  } else if (col > *x) {
+    fprintf(out, "\e[%dC", col - *x);
+  }
+  *x = col;
+}
+
+/* Emit a single SGR sequence switching only the attributes that differ */
+static void change_graphics(enum graphics new, enum graphics *old_ptr) {
+  static const struct {
+    enum graphics flag;
+    const char* on;
+    const char* off;
+  } attrs[] = {
+    { GRAPHICS_UNDERLINE, "4", "24" },
+    { GRAPHICS_REVERSE_VIDEO, "7", "27" },
+    { GRAPHICS_LABEL, "1", "22" },
+  };
+
+  enum graphics old = *old_ptr;
+  *old_ptr = new;
+  if (old == new) {
+    return;
+  } else if (new == GRAPHICS_NORMAL) {
+    fputs(normal, out);
+    return;
+  }
+
+  const char* sep = "\e[";
+  for (int i = 0; i < sizeof(attrs) / sizeof(attrs[0]); i++) {
+    if ((old ^ new) & attrs[i].flag) {
+      fputs(sep, out);
+      fputs(new & attrs[i].flag ? attrs[i].on : attrs[i].off, out);
+      sep = ";";
+    }
+  }
+  fputc('m', out);
+}
+
+/*
+ * Compute into "to" the offsets of "from" that are followed by c at position
+ * pos. An empty needle (pos == 0) implicitly matches everywhere, so the line
+ * itself is scanned.
+ */
+static bool narrow(struct shellhop* s, const struct match_set* from, int pos,
+                   char c, struct match_set* to) {
+  const char* line = s->line;
+  if (folds_case(s, s->needle, pos)) {
+    line = s->folded;
+    c = fold(c);
+  }
+  int line_len = s->line_len;
+  int max = pos == 0 ? line_len : from->count;
+  to->offsets = realloc(to->offsets, (max > 0 ? max : 1) * sizeof(to->offsets[0]));
+  to->count = 0;
+  if (pos == 0) {
+    const char* p = line;
+    const char* end = line + line_len;
+    while ((p = memchr(p, c, end - p)) != NULL) {
+      if (!char_start(s, p - line)) {
+        p++;
+        continue;
+      }
+      to->offsets[to->count++] = p++ - line;
+      if (cancelled(s, to->count)) {
+        return false;
+      }
+    }
+  } else {
+    for (int j = 0; j < from->count; j++) {
+      int i = from->offsets[j];
+      if (i + pos < line_len && line[i + pos] == c) {
+        to->offsets[to->count++] = i;
+      }
+      if (cancelled(s, j + 1)) {
+        return false;
+      }
+    }
+  }
+  return true;
+}
+
+/*
+ * Find every occurrence of needle in line, overlapping ones included, in a
+ * single pass (Knuth-Morris-Pratt). While no part of the needle is matched,
+ * memchr skips to the next occurrence of its first character. Returns false
+ * if the search was cancelled.
+ */
+static bool find_all(struct shellhop* s, const char* needle, int needle_len,
+                     struct match_set* to) {
+  if (s->flags & SHELLHOP_REGEX) {
+    return regex_find_all(s, needle_len, to);
+  }
+  const char* line = s->line;
+  int line_len = s->line_len;
+  int max = line_len - needle_len + 1;
+  to->offsets = realloc(to->offsets, (max > 0 ? max : 1) * sizeof(to->offsets[0]));
+  to->count = 0;
+  if (needle_len == 0 || max <= 0) {
+    return true;
+  }
+
+  if (folds_case(s, needle, needle_len)) {
+    line = s->folded;
+    for (int i = 0; i < needle_len; i++) {
+      s->folded_needle[i] = fold(needle[i]);
+    }
+    needle = s->folded_needle;
+  }
+
+  int* border = borders(needle, needle_len);
+  for (int i = 0, k = 0, n = 1; i < line_len; i++, n++) {
+    if (cancelled(s, n)) {
+      free(border);
+      return false;
+    }
+    if (k == 0) {
+      const char* p = memchr(line + i, needle[0], line_len - i);
+      if (p == NULL) {
+        break;
+      }
+      i = p - line;
+    }
+    while (k > 0 && line[i] != needle[k]) {
+      k = border[k - 1];
+    }
+    if (line[i] == needle[k]) {
+      k++;
+    }
+    if (k == needle_len) {
+      if (char_start(s, i - needle_len + 1)) {
+        to->offsets[to->count++] = i - needle_len + 1;
+      }
+      k = border[k - 1];
+    }
+  }
+  free(border);
+  return true;
+}
+
+/*
+ * Whether needle is matched ignoring case: always with SHELLHOP_IGNORE_CASE,
+ * and with SHELLHOP_SMART_CASE until it contains an uppercase letter.
+ */
+static bool folds_case(const struct shellhop* s, const char* needle, int needle_len) {
+  if (s->flags & SHELLHOP_SMART_CASE) {
+    for (int i = 0; i < needle_len; i++) {
+      if (needle[i] >= 'A' && needle[i] <= 'Z') {
+        return false;
+      }
+    }
+    return true;
+  }
+  return s->flags & SHELLHOP_IGNORE_CASE;
+}
+
+/* Lowercase ASCII letters, whatever the locale */
+static char fold(char c) {
+  return c >= 'A' && c <= 'Z' ? c - 'A' + 'a' : c;
+}
+
+/*
+ * Build the character and column tables if the line has multibyte
+ * characters. Bytes that don't decode are a character of their own, one
+ * column wide, as are characters that can't be printed.
+ */
+static void decode(struct shellhop* s) {
+  const char* line = s->line;
+  int line_len = s->line_len;
+  if (MB_CUR_MAX == 1) {
+    return;
+  }
+  int i = 0;
+  while (i < line_len && !(line[i] & 0x80)) {
+    i++;
+  }
+  if (i == line_len) {
+    return;
+  }
+
+  s->chars = malloc((line_len + 1) * sizeof(s->chars[0]));
+  s->cols = malloc((line_len + 1) * sizeof(s->cols[0]));
+  mbstate_t mbs;
+  memset(&mbs, 0, sizeof(mbs));
+  int index = 0;
+  int cell = 0;
+  int col = 0;
+  for (i = 0; i < line_len;) {
+    wchar_t wc;
+    size_t n = mbrtowc(&wc, line + i, line_len - i, &mbs);
+    int width = 1;
+    if (n == (size_t)-1 || n == (size_t)-2 || n == 0) {
+      n = 1;
+      memset(&mbs, 0, sizeof(mbs));
+    } else if ((width = wcwidth(wc)) < 0) {
+      width = 1;
+    }
+    if (width > 0 || i == 0) {
+      cell = col;
+      col += width;
+    }
+    for (int k = 0; k < n; k++) {
+      s->chars[i + k] = index;
+      s->cols[i + k] = cell;
+    }
+    index++;
+    i += n;
+  }
+  s->chars[line_len] = index;
+  s->cols[line_len] = col;
+}
+
+static void index_rows(struct shellhop* s) {
+  s->row_count = 1;
+  const char* p = s->line;
+  const char* end = s->line + s->line_len;
+  while ((p = memchr(p, '\n', end - p)) != NULL) {
+    s->row_count++;
+    p++;
+  }
+  if (s->row_count == 1) {
+    return;
+  }
+  s->rows = malloc(s->row_count * sizeof(s->rows[0]));
+  s->rows[0] = 0;
+  int r = 1;
+  for (int i = 0; i < s->line_len; i++) {
+    if (s->line[i] == '\n') {
+      s->rows[r++] = i + 1;
+    }
+  }
+}
+
+/* Index of the row holding offset i */
+static int row_of(const struct shellhop* s, int i) {
+  int lo = 0;
+  int hi = s->row_count - 1;
+  while (lo < hi) {
+    int mid = hi - (hi - lo) / 2;
+    if (s->rows[mid] <= i) {
+      lo = mid;
+    } else {
+      hi = mid - 1;
+    }
+  }
+  return lo;
+}
+
+/* Whether a character starts at offset i */
+static bool char_start(const struct shellhop* s, int i) {
+  return s->chars == NULL || i <= 0 || i >= s->line_len || s->chars[i] != s->chars[i - 1];
+}
 
-static const char* beginning_of_line = "\e[G";
-static const char* save_cursor = "\e[s";
-static const char* restore_cursor = "\e[u";
-static const char* hide_cursor = "\e[?25l";
-static const char* show_cursor = "\e[?25h";
-static const char* reverse_video = "\e[7m";
-static const char* underline = "\e[4m";
-static const char* normal = "\e[0m";
-static const char* clear = "\e[J";
+/* Column of the cell holding offset i */
+static int column(const struct shellhop* s, int i) {
+  return s->cols != NULL ? s->cols[i] : i;
+}
 
-const char* bash_template =
-  "function _shellhop {\n"
-  "  READLINE_POINT=$(%s \"$READLINE_LINE\");\n"
-  "};\n"
-  "bind '\"\\C-xS0\":beginning-of-line';\n"
-  "bind -x '\"\\C-xS1\":\"_shellhop\"';\n"
-  "bind '\"%s\":\"\\C-xS0\\C-xS1\"';\n";
-
-const char* zsh_template =
-  "function _shellhop {\n"
-  "  CURSOR=$(%s \"$BUFFER\" </dev/tty);\n"
-  "  zle redisplay;\n"
-  "};\n"
-  "zle -N shellhop _shellhop;\n"
-  "bindkey '%s' shellhop;\n";
-
-struct option options[] = {
-  { "help", 0, NULL, 'h' },
-  { "bash", 0, NULL, 'b' },
-  { "zsh", 0, NULL, 'z' },
-  { "key", 1, NULL, 'k' },
-  { NULL },
-};
+/* Start of the cell holding offset i */
+static int cell_floor(const struct shellhop* s, int i) {
+  while (s->cols != NULL && i > 0 && s->cols[i - 1] == s->cols[i]) {
+    i--;
+  }
+  return i;
+}
 
-void usage(const char* name) {
-  fprintf(
-      stderr,
-      "usage: %s [OPTION]... LINE\n"
-      "\n"
-      "Do an incremental search on the given line and write the index of the first\n"
-      "match to stdout.\n"
-      "\n"
-      "  -b, --bash     output Bash shell commands to stdout\n"
-      "  -z, --zsh      output Zsh shell commands to stdout\n"
-      "  -k, --key=KEY  specify a key for --bash and --zsh\n"
-      "  -h, --help     display this help and exit\n",
-      name);
-}
-
-int main(int argc, char** argv) {
-  bool print_bash_source = false;
-  bool print_zsh_source = false;
-  const char* key = "\\C-x\\C-f";
-  int opt;
-  while ((opt = getopt_long(argc, argv, "bzhk:", options, NULL)) != -1) {
-    switch (opt) {
-    case 'b':
-      print_bash_source = true;
-      break;
-    case 'z':
-      print_zsh_source = true;
-      break;
-    case 'k':
-      key = optarg;
-      break;
-    case 'h':
-      usage(argv[0]);
-      return 0;
-    default:
-      usage(argv[0]);
-      return 1;
+/* Start of the first cell at or after offset i */
+static int cell_ceil(const struct shellhop* s, int i) {
+  while (s->cols != NULL && i > 0 && i < s->line_len && s->cols[i - 1] == s->cols[i]) {
+    i++;
+  }
+  return i;
+}
+
+/* Start of the first cell at or after column col */
+static int offset_at_column(const struct shellhop* s, int col) {
+  if (s->cols == NULL) {
+    return col;
+  }
+  int lo = 0;
+  int hi = s->line_len;
+  while (lo < hi) {
+    int mid = lo + (hi - lo) / 2;
+    if (s->cols[mid] < col) {
+      lo = mid + 1;
+    } else {
+      hi = mid;
     }
   }
+  return cell_ceil(s, lo);
+}
 
-  if (print_bash_source) {
-      printf(bash_template, argv[0], key);
-      return 0;
-  } else if (print_zsh_source) {
-      printf(zsh_template, argv[0], key);
-      return 0;
+/*
+ * The KMP failure function: border[i] is the length of the longest proper
+ * border of the first i+1 characters of needle
+ */
+static int* borders(const char* needle, int needle_len) {
+  int* border = malloc(needle_len * sizeof(border[0]));
+  border[0] = 0;
+  for (int i = 1, k = 0; i < needle_len; i++) {
+    while (k > 0 && needle[i] != needle[k]) {
+      k = border[k - 1];
+    }
+    if (needle[i] == needle[k]) {
+      k++;
+    }
+    border[i] = k;
   }
+  return border;
+}
 
-  if (argc - optind <= 0) {
-    usage(argv[0]);
-    return 1;
+int shellhop_find(const char* line, size_t line_len, const char* needle,
+                  size_t needle_len, int from, int flags, int* offsets, int max) {
+  struct match_set all = { NULL, 0 };
+  all.count = shellhop_find_all(line, line_len, needle, needle_len, flags, &all.offsets);
+  int count = 0;
+  if (!(flags & SHELLHOP_BACKWARD)) {
+    for (int j = lower_bound(&all, from); j < all.count && count < max; j++) {
+      offsets[count++] = all.offsets[j];
+    }
+  } else {
+    int j = from < INT_MAX ? lower_bound(&all, from + 1) : all.count;
+    while (--j >= 0 && count < max) {
+      offsets[count++] = all.offsets[j];
+    }
+  }
+  free(all.offsets);
+  return count;
+}
+
+int shellhop_find_all(const char* line, size_t line_len, const char* needle,
+                      size_t needle_len, int flags, int** offsets) {
+  struct shellhop* s = shellhop_new(line, line_len);
+  shellhop_set_flags(s, flags & (SHELLHOP_REGEX | SHELLHOP_IGNORE_CASE | SHELLHOP_SMART_CASE));
+  reserve(s, needle_len);
+  memcpy(s->needle, needle, needle_len);
+  struct match_set* all = &s->matches[needle_len];
+  int count = 0;
+  *offsets = NULL;
+  if (needle_len > 0 && (!(flags & SHELLHOP_REGEX) || regex_for(s, needle_len) != NULL) &&
+      find_all(s, s->needle, needle_len, all)) {
+    count = all->count;
+    *offsets = all->offsets;
+    all->offsets = NULL;
   }
+  shellhop_free(s);
+  return count;
+}
 
-  const char* line = argv[optind];
-  size_t line_len = strlen(line);
-  enum graphics *graphics = calloc(line_len, sizeof(graphics[0]));
-
-  if (isatty(STDIN_FILENO)) {
-    set_raw_mode();
-  }
-
-  static char buf[BUFSIZ];
-  setbuf(stderr, buf);
-
-  char needle[BUFSIZ] = "";
-  int needle_len = 0;
-  int result = 0;
-
-  fputs(beginning_of_line, stderr);
-  fputs(save_cursor, stderr);
-  fputs(hide_cursor, stderr);
-
-  while (1) {
-    /* Search for needle */
-    int reverse_video_remain = 0;
-    int underline_remain = 0;
-    bool first = true;
-    for (int j = 0; j < line_len; j++) {
-      int i = (result + j) % line_len;
-      graphics[i] = GRAPHICS_NORMAL;
-      if (needle_len > 0 && !strncmp(line + i, needle, needle_len)) {
-        if (first) {
-          first = false;
-          result = i;
-          reverse_video_remain = needle_len;
-        } else {
-          underline_remain = needle_len;
-        }
-      }
-      if (underline_remain > 0) {
-        --underline_remain;
-        graphics[i] |= GRAPHICS_UNDERLINE;
-      }
-      if (reverse_video_remain > 0) {
-        --reverse_video_remain;
-        graphics[i] |= GRAPHICS_REVERSE_VIDEO;
-      }
+/*
+ * Parse the first n characters of pattern into re->ast, returning the root
+ * or -1 on a syntax error. Groups and classes still open at the end are
+ * closed and a trailing backslash is dropped, so that each prefix of a
+ * pattern being typed can be searched.
+ */
+static int re_parse(struct regex* re, const char* pattern, int n, bool fold) {
+  struct re_parser p = { re, pattern, n, 0, fold, 0 };
+  int root = re_parse_alt(&p);
+  if (root < 0 || p.pos < n) {
+    return -1;
+  }
+  return root;
+}
+
+/* alt := cat ('|' cat)* */
+static int re_parse_alt(struct re_parser* p) {
+  int left = re_parse_cat(p);
+  while (left >= 0 && p->pos < p->len && p->pattern[p->pos] == '|') {
+    p->pos++;
+    int right = re_parse_cat(p);
+    if (right < 0) {
+      return -1;
+    }
+    left = re_ast(p->re, AST_ALT, left, right);
+  }
+  return left;
+}
+
+/* cat := (atom ('*' | '+' | '?')*)* */
+static int re_parse_cat(struct re_parser* p) {
+  int left = re_ast(p->re, AST_EMPTY, -1, -1);
+  while (p->pos < p->len && p->pattern[p->pos] != '|' &&
+         (p->pattern[p->pos] != ')' || p->depth == 0)) {
+    char c = p->pattern[p->pos];
+    if (c == '*' || c == '+' || c == '?' || c == ')') {
+      /* Nothing to repeat, or an unmatched parenthesis */
+      return -1;
     }
+    int atom = re_parse_atom(p);
+    if (atom < 0) {
+      return -1;
+    }
+    while (p->pos < p->len && strchr("*+?", p->pattern[p->pos]) != NULL) {
+      char q = p->pattern[p->pos++];
+      atom = re_ast(p->re, q == '*' ? AST_STAR : q == '+' ? AST_PLUS : AST_QUEST, atom, -1);
+    }
+    left = re_ast(p->re, AST_CAT, left, atom);
+  }
+  return left;
+}
 
-    /* Draw prompt */
-    fputs(restore_cursor, stderr);
-    fprintf(stderr, "(shellhop): ");
-    enum graphics cur_graphics = GRAPHICS_NORMAL;
-    for (int i = 0; i < line_len; i++) {
-      change_graphics(graphics[i], &cur_graphics);
-      fputc(line[i], stderr);
+static int re_parse_atom(struct re_parser* p) {
+  char c = p->pattern[p->pos++];
+  if (c == '(') {
+    p->depth++;
+    int inner = re_parse_alt(p);
+    p->depth--;
+    if (inner >= 0 && p->pos < p->len) {
+      p->pos++; /* ')' */
     }
-    change_graphics(GRAPHICS_NORMAL, &cur_graphics);
-    fputs(clear, stderr);
-    fflush(stderr);
+    return inner;
+  } else if (c == '^' || c == '$') {
+    return re_ast(p->re, c == '^' ? AST_BOL : AST_EOL, -1, -1);
+  }
+
+  int node = re_ast(p->re, AST_SET, -1, -1);
+  unsigned char* set = p->re->ast[node].set;
+  if (c == '[') {
+    /* Folded by re_parse_class, before any negation */
+    return re_parse_class(p, set) ? node : -1;
+  } else if (c == '.') {
+    memset(set, 0xff, 32);
+    set['\n' / 8] &= ~(1 << ('\n' % 8));
+  } else if (c == '\\') {
+    if (p->pos == p->len) {
+      p->re->ast[node].op = AST_EMPTY;
+      return node;
+    }
+    re_escape(set, p->pattern[p->pos++]);
+  } else {
+    re_set_add(set, c, c);
+  }
+  if (p->fold) {
+    re_set_fold(set);
+  }
+  return node;
+}
 
-    /* Read input */
-    int c = getchar();
-    if (c < 0) {
-      return 1;
-    } else if (c == '\r') {
+/* The rest of a bracket expression, after the '[' */
+static bool re_parse_class(struct re_parser* p, unsigned char* set) {
+  bool negate = p->pos < p->len && p->pattern[p->pos] == '^';
+  if (negate) {
+    p->pos++;
+  }
+  for (bool first = true; p->pos < p->len; first = false) {
+    char c = p->pattern[p->pos++];
+    if (c == ']' && !first) {
       break;
-    } else if (c == 127 /* DEL */) {
-      if (needle_len > 0) {
-        needle[--needle_len] = '\0';
-      }
-    } else if (c == ('n' & 0x1f) /* ctrl-N */) {
-      const char* next = strstr(line + result + 1, needle);
-      if (next == NULL) {
-        next = strstr(line, needle);
-      }
-      if (next != NULL) {
-        result = next - line;
-      }
-    } else if (c == ('p' & 0x1f) /* ctrl-P */) {
-      const char* prev = NULL;
-      if (result > 0) {
-        prev = backwards_strstr(line, needle, result - 1);
-      }
-      if (prev == NULL) {
-        prev = backwards_strstr(line, needle, line_len - 1);
+    } else if (c == '\\' && p->pos < p->len) {
+      re_escape(set, p->pattern[p->pos++]);
+    } else if (p->pos + 1 < p->len && p->pattern[p->pos] == '-' &&
+               p->pattern[p->pos + 1] != ']') {
+      char last = p->pattern[p->pos + 1];
+      if ((unsigned char)last < (unsigned char)c) {
+        return false;
       }
-      if (prev != NULL) {
-        result = prev - line;
-      }
-    } else if (c == '\e') {
-      result = 0;
+      re_set_add(set, c, last);
+      p->pos += 2;
+    } else {
+      re_set_add(set, c, c);
+    }
+  }
+  if (p->fold) {
+    re_set_fold(set);
+  }
+  if (negate) {
+    for (int i = 0; i < 32; i++) {
+      set[i] = ~set[i];
+    }
+  }
+  return true;
+}
+
+/* Add the bytes matched by the escape \c */
+static void re_escape(unsigned char* set, char c) {
+  unsigned char class[32] = { 0 };
+  char lower = c | 0x20;
+  if (lower == 'd') {
+    re_set_add(class, '0', '9');
+  } else if (lower == 'w') {
+    re_set_add(class, '0', '9');
+    re_set_add(class, 'a', 'z');
+    re_set_add(class, 'A', 'Z');
+    re_set_add(class, '_', '_');
+  } else if (lower == 's') {
+    re_set_add(class, '\t', '\r');
+    re_set_add(class, ' ', ' ');
+  } else {
+    re_set_add(set, c, c);
+    return;
+  }
+  bool negate = c != lower;
+  for (int i = 0; i < 32; i++) {
+    set[i] |= negate ? ~class[i] : class[i];
+  }
+}
+
+static void re_set_add(unsigned char* set, char first, char last) {
+  for (int c = (unsigned char)first; c <= (unsigned char)last; c++) {
+    set[c / 8] |= 1 << (c % 8);
+  }
+}
+
+/* Make a set of bytes match ASCII letters in either case */
+static void re_set_fold(unsigned char* set) {
+  for (int c = 'a'; c <= 'z'; c++) {
+    int upper = c - 'a' + 'A';
+    if (RE_SET_HAS(set, c) || RE_SET_HAS(set, upper)) {
+      set[c / 8] |= 1 << (c % 8);
+      set[upper / 8] |= 1 << (upper % 8);
+    }
+  }
+}
+
+static int re_ast(struct regex* re, int op, int left, int right) {
+  if (re->ast_count == re->ast_cap) {
+    re->ast_cap = re->ast_cap ? re->ast_cap * 2 : 16;
+    re->ast = realloc(re->ast, re->ast_cap * sizeof(re->ast[0]));
+  }
+  struct re_ast* a = &re->ast[re->ast_count];
+  memset(a, 0, sizeof(*a));
+  a->op = op;
+  a->left = left;
+  a->right = right;
+  return re->ast_count++;
+}
+
+static int re_node(struct regex* re, int op, int out, int out1) {
+  if (re->node_count == re->node_cap) {
+    re->node_cap = re->node_cap ? re->node_cap * 2 : 16;
+    re->nodes = realloc(re->nodes, re->node_cap * sizeof(re->nodes[0]));
+  }
+  struct re_node* node = &re->nodes[re->node_count];
+  memset(node, 0, sizeof(*node));
+  node->op = op;
+  node->out = out;
+  node->out1 = out1;
+  return re->node_count++;
+}
+
+/*
+ * Build the NFA nodes for ast that lead on to next, returning the first.
+ * Backward, the nodes match the reverse of the pattern, so concatenations
+ * are swapped and ^ and $ trade places: each is checked where the scan
+ * begins or where it ends.
+ */
+static int re_compile(struct regex* re, int ast, int next, bool backward) {
+  struct re_ast a = re->ast[ast];
+  int node, left, right;
+  switch (a.op) {
+  case AST_EMPTY:
+    return next;
+  case AST_SET:
+    node = re_node(re, NODE_SET, next, -1);
+    memcpy(re->nodes[node].set, re->ast[ast].set, 32);
+    return node;
+  case AST_CAT:
+    if (backward) {
+      return re_compile(re, a.right, re_compile(re, a.left, next, backward), backward);
+    }
+    return re_compile(re, a.left, re_compile(re, a.right, next, backward), backward);
+  case AST_ALT:
+    left = re_compile(re, a.left, next, backward);
+    right = re_compile(re, a.right, next, backward);
+    return re_node(re, NODE_SPLIT, left, right);
+  case AST_STAR:
+  case AST_QUEST:
+    node = re_node(re, NODE_SPLIT, -1, next);
+    left = re_compile(re, a.left, a.op == AST_STAR ? node : next, backward);
+    re->nodes[node].out = left;
+    return node;
+  case AST_PLUS:
+    node = re_node(re, NODE_SPLIT, -1, next);
+    left = re_compile(re, a.left, node, backward);
+    re->nodes[node].out = left;
+    return left;
+  default: /* AST_BOL, AST_EOL */
+    return re_node(re, (a.op == AST_BOL) != backward ? NODE_BEGIN : NODE_END, next, -1);
+  }
+}
+
+/*
+ * The regex for the first n characters of the needle, compiled when first
+ * needed and kept for as long as the needle keeps that prefix. NULL if the
+ * prefix isn't a valid pattern.
+ */
+static struct regex* regex_for(struct shellhop* s, int n) {
+  bool fold = folds_case(s, s->needle, n);
+  struct regex* re = s->regexes[n];
+  if (re != NULL && re->fold == fold && !memcmp(re->pattern, s->needle, n)) {
+    return re->root >= 0 ? re : NULL;
+  }
+  regex_free(re);
+  re = calloc(1, sizeof(*re));
+  s->regexes[n] = re;
+  re->pattern = malloc(n > 0 ? n : 1);
+  memcpy(re->pattern, s->needle, n);
+  re->fold = fold;
+  re->root = re_parse(re, s->needle, n, fold);
+  if (re->root < 0) {
+    return NULL;
+  }
+
+  /* Backward, any bytes may come after a match; see regex_find_all */
+  int match = re_node(re, NODE_MATCH, -1, -1);
+  int loop = re_node(re, NODE_SPLIT, -1, -1);
+  int any = re_node(re, NODE_SET, loop, -1);
+  memset(re->nodes[any].set, 0xff, 32);
+  int start = re_compile(re, re->root, match, true);
+  re->nodes[loop].out = any;
+  re->nodes[loop].out1 = start;
+  re->backward.start = loop;
+  re->forward.start = re_compile(re, re->root, match, false);
+  re->forward.initial[0] = re->forward.initial[1] = -1;
+  re->backward.initial[0] = re->backward.initial[1] = -1;
+  re->mark = calloc(re->node_count, sizeof(re->mark[0]));
+  re->stack = malloc(re->node_count * sizeof(re->stack[0]));
+  re->list = malloc(re->node_count * sizeof(re->list[0]));
+  re->seeds = malloc(re->node_count * sizeof(re->seeds[0]));
+  re_classes(re);
+  return re;
+}
+
+static void regex_free(struct regex* re) {
+  if (re == NULL) {
+    return;
+  }
+  dfa_clear(&re->forward);
+  dfa_clear(&re->backward);
+  free(re->forward.states);
+  free(re->backward.states);
+  free(re->forward.next);
+  free(re->backward.next);
+  free(re->forward.table);
+  free(re->backward.table);
+  free(re->seeds);
+  free(re->mark);
+  free(re->stack);
+  free(re->list);
+  free(re->nodes);
+  free(re->ast);
+  free(re->pattern);
+  free(re);
+}
+
+/*
+ * Compute into "to" the offsets where a match of the regex for the first
+ * needle_len characters of the needle starts, in one pass over the line from
+ * its end. The backward automaton matches any bytes followed by the reversed
+ * pattern, so it is in a matching state at offset i exactly when a match
+ * starts there.
+ */
+static bool regex_find_all(struct shellhop* s, int needle_len, struct match_set* to) {
+  struct regex* re = regex_for(s, needle_len);
+  to->offsets = realloc(to->offsets, (s->line_len + 1) * sizeof(to->offsets[0]));
+  to->count = 0;
+  if (needle_len == 0 || re == NULL) {
+    return true;
+  }
+
+  struct dfa* dfa = &re->backward;
+  int state = dfa_initial(re, dfa, true);
+  for (int i = s->line_len, n = 1;; i--, n++) {
+    if (cancelled(s, n)) {
+      return false;
+    }
+    struct dstate* st = &dfa->states[state];
+    if ((st->match || (i == 0 && st->match_at_end)) && char_start(s, i)) {
+      to->offsets[to->count++] = i;
+    }
+    if (i == 0) {
       break;
-    } else if (needle_len + 1 < sizeof(needle)) {
-      needle[needle_len++] = c;
-      if (!strstr(line, needle)) {
-        needle[--needle_len] = '\0';
+    }
+    state = dfa_step(re, dfa, state, (unsigned char)s->line[i - 1]);
+  }
+
+  /* Found from the end; the sets are kept in increasing order */
+  for (int i = 0, j = to->count - 1; i < j; i++, j--) {
+    int tmp = to->offsets[i];
+    to->offsets[i] = to->offsets[j];
+    to->offsets[j] = tmp;
+  }
+  return true;
+}
+
+/*
+ * End of the match of the needle at i. A regex match is followed no further
+ * than limit.
+ */
+static int match_end_of(struct shellhop* s, int i, int limit) {
+  if (s->flags & SHELLHOP_REGEX) {
+    return regex_match_end(s, i, limit);
+  }
+  return i + s->needle_len;
+}
+
+/* End of the longest match of the regex for the needle starting at i */
+static int regex_match_end(struct shellhop* s, int i, int limit) {
+  struct regex* re = regex_for(s, s->needle_len);
+  if (re == NULL) {
+    return i;
+  }
+  struct dfa* dfa = &re->forward;
+  int state = dfa_initial(re, dfa, i == 0);
+  int end = dfa->states[state].match ? i : -1;
+  int j = i;
+  for (; j < limit && dfa->states[state].len > 0; j++) {
+    state = dfa_step(re, dfa, state, (unsigned char)s->line[j]);
+    if (dfa->states[state].match) {
+      end = j + 1;
+    }
+  }
+  if (j == s->line_len && dfa->states[state].match_at_end) {
+    end = j;
+  }
+  return end >= i ? end : i;
+}
+
+/* Forget every state, when the cache is full */
+static void dfa_clear(struct dfa* dfa) {
+  for (int i = 0; i < dfa->count; i++) {
+    free(dfa->states[i].set);
+  }
+  dfa->count = 0;
+  dfa->initial[0] = dfa->initial[1] = -1;
+  if (dfa->table != NULL) {
+    memset(dfa->table, 0, DFA_TABLE_SIZE * sizeof(dfa->table[0]));
+  }
+}
+
+/* The state before any byte is read, with ^ (or $ backward) satisfied or not */
+static int dfa_initial(struct regex* re, struct dfa* dfa, bool at_begin) {
+  if (dfa->initial[at_begin] < 0) {
+    int seed = dfa->start;
+    int len = re_closure(re, &seed, 1, at_begin, false);
+    int state = dfa_state(re, dfa, len);
+    dfa->initial[at_begin] = state;
+  }
+  return dfa->initial[at_begin];
+}
+
+/* The state after reading c in state, computed on first use */
+static int dfa_step(struct regex* re, struct dfa* dfa, int state, unsigned char c) {
+  int next = dfa->next[state * re->class_count + re->classes[c]];
+  if (next >= 0) {
+    return next;
+  }
+  const struct dstate* st = &dfa->states[state];
+  int n = 0;
+  for (int i = 0; i < st->len; i++) {
+    const struct re_node* node = &re->nodes[st->set[i]];
+    if (node->op == NODE_SET && RE_SET_HAS(node->set, c)) {
+      re->seeds[n++] = node->out;
+    }
+  }
+  int len = re_closure(re, re->seeds, n, false, false);
+
+  /* Adding a state can empty the cache, taking this transition with it */
+  int epoch = dfa->epoch;
+  next = dfa_state(re, dfa, len);
+  if (dfa->epoch == epoch) {
+    dfa->next[state * re->class_count + re->classes[c]] = next;
+  }
+  return next;
+}
+
+/*
+ * Find or add the state for the NFA nodes in re->list. Only the nodes that
+ * read a byte or end a match are kept, sorted.
+ */
+static int dfa_state(struct regex* re, struct dfa* dfa, int len) {
+  int* list = re->list;
+  for (int i = 1; i < len; i++) {
+    for (int j = i; j > 0 && list[j - 1] > list[j]; j--) {
+      int tmp = list[j];
+      list[j] = list[j - 1];
+      list[j - 1] = tmp;
+    }
+  }
+  unsigned hash = 2166136261u;
+  for (int i = 0; i < len; i++) {
+    hash = (hash ^ list[i]) * 16777619u;
+  }
+
+  if (dfa->table == NULL) {
+    dfa->table = calloc(DFA_TABLE_SIZE, sizeof(dfa->table[0]));
+  }
+  unsigned slot = hash & (DFA_TABLE_SIZE - 1);
+  for (; dfa->table[slot] != 0; slot = (slot + 1) & (DFA_TABLE_SIZE - 1)) {
+    const struct dstate* st = &dfa->states[dfa->table[slot] - 1];
+    if (st->hash == hash && st->len == len && !memcmp(st->set, list, len * sizeof(int))) {
+      return dfa->table[slot] - 1;
+    }
+  }
+
+  if (dfa->count == DFA_MAX_STATES) {
+    dfa_clear(dfa);
+    dfa->epoch++;
+    slot = hash & (DFA_TABLE_SIZE - 1);
+  }
+  if (dfa->count == dfa->cap) {
+    dfa->cap = dfa->cap ? dfa->cap * 2 : 8;
+    dfa->states = realloc(dfa->states, dfa->cap * sizeof(dfa->states[0]));
+    dfa->next = realloc(dfa->next, dfa->cap * re->class_count * sizeof(dfa->next[0]));
+  }
+  int index = dfa->count++;
+  dfa->table[slot] = index + 1;
+  struct dstate* st = &dfa->states[index];
+  st->set = malloc((len > 0 ? len : 1) * sizeof(int));
+  memcpy(st->set, list, len * sizeof(int));
+  st->len = len;
+  st->hash = hash;
+  for (int i = 0; i < re->class_count; i++) {
+    dfa->next[index * re->class_count + i] = -1;
+  }
+
+  /* $ (or ^ backward) is satisfied only once the scan reaches the end */
+  st->match = re_has_match(re, st->set, len);
+  st->match_at_end = re_has_match(re, re->list, re_closure(re, st->set, len, false, true));
+  return index;
+}
+
+/*
+ * Number the bytes so that two share a class only if every node reads both
+ * or neither of them. The automata move on classes rather than bytes.
+ */
+static void re_classes(struct regex* re) {
+  memset(re->classes, 0, sizeof(re->classes));
+  re->class_count = 1;
+  for (int n = 0; n < re->node_count; n++) {
+    if (re->nodes[n].op != NODE_SET) {
+      continue;
+    }
+    /* Split each class into the bytes in the set and those out of it */
+    int split[256][2];
+    memset(split, -1, sizeof(split));
+    int count = 0;
+    for (int c = 0; c < 256; c++) {
+      int* id = &split[re->classes[c]][RE_SET_HAS(re->nodes[n].set, c) != 0];
+      if (*id < 0) {
+        *id = count++;
+      }
+      re->classes[c] = *id;
+    }
+    re->class_count = count;
+  }
+}
+
+static bool re_has_match(const struct regex* re, const int* list, int len) {
+  for (int i = 0; i < len; i++) {
+    if (re->nodes[list[i]].op == NODE_MATCH) {
+      return true;
+    }
+  }
+  return false;
+}
+
+/*
+ * Collect into re->list the nodes reachable from seeds without reading a
+ * byte, passing ^ (or $ backward) only if at_begin and $ (or ^) only if
+ * at_end. Returns how many.
+ */
+static int re_closure(struct regex* re, const int* seeds, int n, bool at_begin, bool at_end) {
+  re->generation++;
+  int len = 0;
+  int top = 0;
+  for (int i = 0; i < n; i++) {
+    if (re->mark[seeds[i]] != re->generation) {
+      re->mark[seeds[i]] = re->generation;
+      re->stack[top++] = seeds[i];
+    }
+  }
+  while (top > 0) {
+    int id = re->stack[--top];
+    const struct re_node* node = &re->nodes[id];
+    int outs[2] = { -1, -1 };
+    if (node->op == NODE_SPLIT) {
+      outs[0] = node->out;
+      outs[1] = node->out1;
+    } else if (node->op == NODE_BEGIN) {
+      outs[0] = at_begin ? node->out : -1;
+    } else if (node->op == NODE_END && at_end) {
+      outs[0] = node->out;
+    } else {
+      re->list[len++] = id;
+    }
+    for (int k = 0; k < 2; k++) {
+      if (outs[k] >= 0 && re->mark[outs[k]] != re->generation) {
+        re->mark[outs[k]] = re->generation;
+        re->stack[top++] = outs[k];
       }
     }
   }
+  return len;
+}
+
+/*
+ * Whether the worker thread has newer keys to apply. Searches call this on
+ * each iteration i but only check every CANCEL_INTERVAL iterations.
+ */
+static bool cancelled(struct shellhop* s, int i) {
+  if (s->worker == NULL || i % CANCEL_INTERVAL != 0) {
+    return false;
+  }
+  pthread_mutex_lock(&s->worker->lock);
+  bool cancel = s->worker->cancel;
+  pthread_mutex_unlock(&s->worker->lock);
+  return cancel;
+}
 
-  fputs(restore_cursor, stderr);
-  fputs(clear, stderr);
-  fputs(show_cursor, stderr);
-  fflush(stderr);
+/* Keys handled by shellhop_feed instead of being added to the needle */
+static bool is_command(char c) {
+  return c == '\r' || c == '\e' || c == ('c' & 0x1f) || c == 127 ||
+         c == ('n' & 0x1f) || c == ('p' & 0x1f) || c == ('r' & 0x1f);
+}
 
-  printf("%d\n", result);
-  free(graphics);
-  return 0;
+/* Index of the first offset in the set that is not less than offset */
+static int lower_bound(const struct match_set* set, int offset) {
+  int lo = 0;
+  int hi = set->count;
+  while (lo < hi) {
+    int mid = lo + (hi - lo) / 2;
+    if (set->offsets[mid] < offset) {
+      lo = mid + 1;
+    } else {
+      hi = mid;
+    }
+  }
+  return lo;
 }
 
-static void change_graphics(enum graphics new, enum graphics *old_ptr) {
-  enum graphics old = *old_ptr;
-  *old_ptr = new;
-  if (old != new) {
-    if (old != GRAPHICS_NORMAL) {
-      fputs(normal, stderr);
+/* Write the frame buffered in out to the terminal */
+static void flush_output(void) {
+  double start = now_us();
+  fflush(out);
+  size_t written = 0;
+  while (written < out_len) {
+    ssize_t n = write(STDERR_FILENO, out_buf + written, out_len - written);
+    trace_syscalls++;
+    if (n > 0) {
+      written += n;
+    } else if (n < 0 && errno != EINTR) {
+      break;
     }
-    if (new & GRAPHICS_UNDERLINE) {
-      fputs(underline, stderr);
+  }
+  trace_bytes += written;
+  trace_record("write", 1, start, written);
+  fseek(out, 0, SEEK_SET);
+}
+
+/* Take the most underlined spans from SHELLHOP_HIGHLIGHTS if it's set */
+static void highlight_limit_from_env(struct shellhop* s) {
+  const char* limit = getenv("SHELLHOP_HIGHLIGHTS");
+  if (limit != NULL && *limit != '\0') {
+    shellhop_set_highlight_limit(s, atoi(limit));
+  }
+}
+
+/*
+ * Map the history file named by SHELLHOP_HISTORY, or ~/.shellhop_history,
+ * creating it if needed. Returns false if it can't be used.
+ */
+static bool history_open(struct history* h) {
+  h->fd = -1;
+  h->file = NULL;
+  const char* path = getenv("SHELLHOP_HISTORY");
+  char home_path[PATH_MAX];
+  if (path == NULL || *path == '\0') {
+    const char* home = getenv("HOME");
+    if (home == NULL || *home == '\0') {
+      return false;
     }
-    if (new & GRAPHICS_REVERSE_VIDEO) {
-      fputs(reverse_video, stderr);
+    snprintf(home_path, sizeof(home_path), "%s/.shellhop_history", home);
+    path = home_path;
+  }
+  h->fd = open(path, O_RDWR | O_CREAT | O_CLOEXEC, 0600);
+  if (h->fd < 0) {
+    return false;
+  }
+
+  /* Whichever shell opens it first sizes the file, which reads as zeros */
+  struct stat st;
+  if (!history_lock(h, F_WRLCK) || fstat(h->fd, &st) < 0 ||
+      (st.st_size < (off_t)sizeof(*h->file) && ftruncate(h->fd, sizeof(*h->file)) < 0)) {
+    history_close(h);
+    return false;
+  }
+  void* map = mmap(NULL, sizeof(*h->file), PROT_READ | PROT_WRITE, MAP_SHARED, h->fd, 0);
+  if (map == MAP_FAILED) {
+    history_close(h);
+    return false;
+  }
+  h->file = map;
+  if (memcmp(h->file->magic, HISTORY_MAGIC, sizeof(h->file->magic)) != 0) {
+    memset(h->file, 0, sizeof(*h->file));
+    memcpy(h->file->magic, HISTORY_MAGIC, sizeof(h->file->magic));
+  }
+  history_lock(h, F_UNLCK);
+  return true;
+}
+
+static void history_close(struct history* h) {
+  if (h->file != NULL) {
+    munmap(h->file, sizeof(*h->file));
+    h->file = NULL;
+  }
+  if (h->fd >= 0) {
+    close(h->fd); /* drops any lock */
+    h->fd = -1;
+  }
+}
+
+/* Take or drop a lock on the whole file, waiting for other shells */
+static bool history_lock(const struct history* h, short type) {
+  struct flock lock = { .l_type = type, .l_whence = SEEK_SET };
+  while (fcntl(h->fd, F_SETLKW, &lock) < 0) {
+    if (errno != EINTR) {
+      return false;
     }
   }
+  return true;
 }
 
-static const char*
-backwards_strstr(const char* haystack, const char* needle, int offset) {
-  size_t needle_len = strlen(needle);
-  for (int i = offset; i >= 0; i--) {
-    if (!strncmp(haystack + i, needle, needle_len)) {
-      return haystack + i;
+/* Copy the newest needle and return its length, 0 if there is none */
+static int history_last(const struct history* h, char* needle) {
+  if (!history_lock(h, F_RDLCK)) {
+    return 0;
+  }
+  int len = 0;
+  unsigned int count = h->file->count;
+  if (count > 0) {
+    const struct history_entry* e = &h->file->entries[(count - 1) % HISTORY_SIZE];
+    if (e->len > 0 && e->len <= HISTORY_NEEDLE_MAX) {
+      len = e->len;
+      memcpy(needle, e->needle, len);
     }
   }
-  return NULL;
+  history_lock(h, F_UNLCK);
+  return len;
 }
 
-static struct termios orig_termios;
+/* Add a needle unless it is empty, too long or the same as the newest */
+static void history_add(struct history* h, const char* needle, int len) {
+  if (len == 0 || len > HISTORY_NEEDLE_MAX || !history_lock(h, F_WRLCK)) {
+    return;
+  }
+  unsigned int count = h->file->count;
+  const struct history_entry* last = &h->file->entries[(count - 1) % HISTORY_SIZE];
+  if (count == 0 || last->len != len || memcmp(last->needle, needle, len) != 0) {
+    struct history_entry* e = &h->file->entries[count % HISTORY_SIZE];
+    e->len = len;
+    memcpy(e->needle, needle, len);
+    h->file->count = count + 1;
+  }
+  history_lock(h, F_UNLCK);
+}
 
-static void restore_termios(void) {
-  if (tcsetattr(STDIN_FILENO, TCSAFLUSH, &orig_termios) < 0) {
-    perror("tcsetattr");
-    abort();
+static void trace_open(void) {
+  const char* path = getenv("SHELLHOP_TRACE");
+  if (path == NULL || *path == '\0') {
+    return;
+  }
+  trace_fd = open(path, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0644);
+  if (trace_fd < 0) {
+    return;
+  }
+  trace_events = calloc(TRACE_MAX_EVENTS, sizeof(trace_events[0]));
+  trace_count = 0;
+  trace_dropped = 0;
+  trace_syscalls = 0;
+  trace_bytes = 0;
+  trace_start = now_us();
+}
+
+/* Record a phase that began at start and ends now */
+static void trace_record(const char* name, int tid, double start, long long arg) {
+  if (trace_events == NULL) {
+    return;
+  }
+  double end = now_us();
+  pthread_mutex_lock(&trace_lock);
+  if (trace_count < TRACE_MAX_EVENTS) {
+    struct trace_event* e = &trace_events[trace_count];
+    e->name = name;
+    e->tid = tid;
+    e->start = start - trace_start;
+    e->dur = end - start;
+    e->arg = arg;
+    trace_count++;
+  } else {
+    trace_dropped++;
+  }
+  pthread_mutex_unlock(&trace_lock);
+}
+
+/*
+ * Write the recorded events as JSON. Only async-signal-safe calls are made,
+ * since this also runs from the SIGINT handler.
+ */
+static void trace_dump(void) {
+  char buf[256];
+  int len = 0;
+  long long pid = getpid();
+  signal_write(trace_fd, "{\"traceEvents\":[\n");
+  for (int i = 0; i < trace_count; i++) {
+    const struct trace_event* e = &trace_events[i];
+    len = 0;
+    append_str(buf, &len, "{\"name\":\"");
+    append_str(buf, &len, e->name);
+    append_str(buf, &len, "\",\"ph\":\"X\",\"pid\":");
+    append_int(buf, &len, pid);
+    append_str(buf, &len, ",\"tid\":");
+    append_int(buf, &len, e->tid);
+    append_str(buf, &len, ",\"ts\":");
+    append_int(buf, &len, e->start);
+    append_str(buf, &len, ",\"dur\":");
+    append_int(buf, &len, e->dur);
+    append_str(buf, &len, ",\"args\":{\"n\":");
+    append_int(buf, &len, e->arg);
+    append_str(buf, &len, "}},\n");
+    signal_write(trace_fd, buf);
+  }
+
+  /* Totals, as an instant event at the end */
+  len = 0;
+  append_str(buf, &len, "{\"name\":\"totals\",\"ph\":\"i\",\"s\":\"g\",\"pid\":");
+  append_int(buf, &len, pid);
+  append_str(buf, &len, ",\"tid\":1,\"ts\":");
+  append_int(buf, &len, now_us() - trace_start);
+  append_str(buf, &len, ",\"args\":{\"syscalls\":");
+  append_int(buf, &len, trace_syscalls);
+  append_str(buf, &len, ",\"bytes_written\":");
+  append_int(buf, &len, trace_bytes);
+  append_str(buf, &len, ",\"dropped_events\":");
+  append_int(buf, &len, trace_dropped);
+  append_str(buf, &len, "}}\n]}\n");
+  signal_write(trace_fd, buf);
+}
+
+/* Append to a NUL-terminated buffer; callers keep within its size */
+static void append_str(char* buf, int* len, const char* str) {
+  while (*str != '\0') {
+    buf[(*len)++] = *str++;
+  }
+  buf[*len] = '\0';
+}
+
+static void append_int(char* buf, int* len, long long v) {
+  char digits[24];
+  int n = 0;
+  unsigned long long u = v < 0 ? -(unsigned long long)v : (unsigned long long)v;
+  do {
+    digits[n++] = '0' + u % 10;
+    u /= 10;
+  } while (u > 0);
+  if (v < 0) {
+    buf[(*len)++] = '-';
+  }
+  while (n > 0) {
+    buf[(*len)++] = digits[--n];
+  }
+  buf[*len] = '\0';
+}
+
+static double now_us(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec * 1e6 + ts.tv_nsec / 1e3;
+}
+
+/* Whether fd can be read without blocking */
+static bool input_pending(int fd) {
+  struct pollfd pfd = { .fd = fd, .events = POLLIN };
+  trace_syscalls++;
+  return poll(&pfd, 1, 0) > 0;
+}
+
+/* Columns of the terminal, or 0 if unknown */
+static int terminal_width(void) {
+  struct winsize ws;
+  if (ioctl(STDERR_FILENO, TIOCGWINSZ, &ws) < 0 &&
+      ioctl(STDIN_FILENO, TIOCGWINSZ, &ws) < 0) {
+    return 0;
+  }
+  return ws.ws_col;
+}
+
+/* Wait until fd or wake_fd (unless -1) is readable; false if interrupted */
+static bool wait_input(int fd, int wake_fd) {
+  fd_set fds;
+  FD_ZERO(&fds);
+  FD_SET(fd, &fds);
+  if (wake_fd >= 0) {
+    FD_SET(wake_fd, &fds);
   }
+  int nfds = (fd > wake_fd ? fd : wake_fd) + 1;
+  trace_syscalls++;
+  return pselect(nfds, &fds, NULL, NULL, NULL, &wait_mask) >= 0 || errno != EINTR;
+}
+
+static void restore_termios(void) {
+  /* Keys typed after Enter are left for the shell */
+  tcsetattr(STDIN_FILENO, TCSANOW, &orig_termios);
 }
 
-static void signal_write(const char* str) {
+static void signal_write(int fd, const char* str) {
   int n = strlen(str);
   int written = 0;
   while (written < n) {
-    int c = write(STDERR_FILENO, str + written, n - written);
+    int c = write(fd, str + written, n - written);
     if (c > 0) {
       written += c;
     } else {
@@ -280,9 +2998,12 @@ static void signal_write(const char* str) {
 
 static void sigint(int signum) {
   restore_termios();
-  signal_write(restore_cursor);
-  signal_write(clear);
-  signal_write(show_cursor);
+  signal_write(STDERR_FILENO, restore_cursor);
+  signal_write(STDERR_FILENO, clear);
+  signal_write(STDERR_FILENO, show_cursor);
+  if (trace_fd >= 0) {
+    trace_dump();
+  }
   signal(signum, SIG_DFL);
 #ifdef USE_GCOV
   void __gcov_flush(void);
@@ -291,20 +3012,30 @@ static void sigint(int signum) {
   raise(signum);
 }
 
-static void set_raw_mode(void) {
+static void sigwinch(int signum) {
+  window_changed = 1;
+}
+
+static bool set_raw_mode(int flags) {
   if (tcgetattr(STDIN_FILENO, &orig_termios) < 0) {
     perror("tcgetattr");
-    abort();
+    return false;
   }
 
   struct termios raw = orig_termios;
   raw.c_iflag &= ~ICRNL;
   raw.c_lflag &= ~(ECHO | ICANON);
-  if (tcsetattr(STDIN_FILENO, TCSAFLUSH, &raw) < 0) {
+  if (flags & SHELLHOP_NO_SIGNALS) {
+    /* Ctrl-C is read as a key and cancels the search */
+    raw.c_lflag &= ~ISIG;
+  }
+  /* Keep keys typed since the binding was pressed; they start the needle */
+  if (tcsetattr(STDIN_FILENO, TCSANOW, &raw) < 0) {
     perror("tcsetattr");
-    abort();
+    return false;
   }
 
-  atexit(restore_termios);
-  signal(SIGINT, sigint);
+  struct sigaction sa = { .sa_handler = sigint };
+  sigaction(SIGINT, &sa, &old_sigint);
+  return true;
 }
@@ -0,0 +1,184 @@
+/*
+ * Copyright 2017 Rich Lane
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+#ifndef SHELLHOP_H
+#define SHELLHOP_H
+
+#include <stddef.h>
+#include <stdio.h>
+
+/*
+ * Incremental search state for one line. The line is not copied and must
+ * outlive the state.
+ */
+struct shellhop;
+
+/* Return values of shellhop_feed */
+enum {
+  SHELLHOP_CONTINUE,
+  SHELLHOP_ACCEPT, /* Enter */
+  SHELLHOP_CANCEL, /* Escape or Ctrl-C */
+};
+
+struct shellhop* shellhop_new(const char* line, size_t line_len);
+void shellhop_free(struct shellhop* s);
+
+/*
+ * Start a new search on another line, as shellhop_new would, but keeping the
+ * flags, highlight limit and allocations of s. The recalled needle is cleared.
+ */
+void shellhop_reset(struct shellhop* s, const char* line, size_t line_len);
+
+/* Flags for shellhop_set_flags, shellhop_interactive and shellhop_replay */
+#define SHELLHOP_IGNORE_CASE (1 << 2) /* ASCII letters match either case */
+#define SHELLHOP_SMART_CASE (1 << 3)  /* ignore case unless the needle has uppercase */
+#define SHELLHOP_LABELS (1 << 5)      /* label matches so that one key jumps to each */
+#define SHELLHOP_REGEX (1 << 6)       /* the needle is an extended regular expression */
+
+/*
+ * Change how the needle is matched. Call before the first key. Either case
+ * flag makes a lowercased copy of the line.
+ *
+ * With SHELLHOP_REGEX the needle may use . [] () | * + ? ^ $ and the escapes
+ * \d \w \s and their negations; ^ and $ match at the ends of the line. A
+ * character is kept if the needle still parses, even if nothing matches,
+ * and groups or brackets left open are taken as closed. SHELLHOP_LABELS is
+ * ignored along with it.
+ */
+void shellhop_set_flags(struct shellhop* s, int flags);
+
+/*
+ * Set the needle that Ctrl-R brings back while the needle is empty. Call
+ * after shellhop_set_flags: its matches are found now, unless the line is
+ * long, so that recalling it takes no search.
+ */
+void shellhop_set_recall(struct shellhop* s, const char* needle, size_t len);
+
+/*
+ * Apply keys: printable characters extend the needle if it still matches,
+ * DEL removes the last one, Ctrl-N/Ctrl-P move between matches and Ctrl-R
+ * recalls a needle if there is none yet. With
+ * SHELLHOP_LABELS, typing a label drawn by the last render accepts its
+ * match. Stops at the first key that accepts or cancels the search.
+ */
+int shellhop_feed(struct shellhop* s, const char* keys, size_t len);
+
+/* Offset of the current match */
+int shellhop_cursor(const struct shellhop* s);
+
+/* The characters typed so far, NUL-terminated */
+const char* shellhop_needle(const struct shellhop* s, int* len);
+
+/*
+ * Sorted offsets of every match of the needle, and the index of the current
+ * one among them. There are no matches while the needle is empty.
+ */
+const int* shellhop_matches(const struct shellhop* s, int* count);
+int shellhop_current(const struct shellhop* s);
+
+/*
+ * Number of characters before offset in the line, which is decoded in the
+ * locale's character set when the state is created
+ */
+int shellhop_char_index(const struct shellhop* s, int offset);
+
+/* Styles of rendered cells */
+#define SHELLHOP_UNDERLINE (1 << 0)     /* part of a match */
+#define SHELLHOP_REVERSE_VIDEO (1 << 1) /* part of the current match */
+#define SHELLHOP_LABEL (1 << 2)         /* a label drawn over a match */
+
+/*
+ * Underline at most limit separate spans of matches in a render, those
+ * nearest the current match, or every visible match if limit is 0. This
+ * keeps frames of lines dense with matches within a few hundred bytes of the
+ * plain line by default. shellhop_interactive and shellhop_replay take the
+ * limit from $SHELLHOP_HIGHLIGHTS when it is set.
+ */
+void shellhop_set_highlight_limit(struct shellhop* s, int limit);
+
+/*
+ * Render the search as one row of cells: the prompt, the part of the line
+ * that fits in width columns (unlimited if 0) and the match counter. Up to
+ * size cells are written to text and their styles to styles. Returns the
+ * number of cells in the row, which may be more than size. The view scrolls
+ * to follow the current match, which is why s is updated.
+ */
+int shellhop_render(struct shellhop* s, int width, char* text,
+                    unsigned char* styles, int size);
+
+/* Flags for shellhop_find, along with the case flags */
+#define SHELLHOP_BACKWARD (1 << 1)
+
+/*
+ * Store in offsets up to max offsets of needle in line, overlapping matches
+ * included: those starting at or after from in increasing order or, with
+ * SHELLHOP_BACKWARD, those starting at or before from in decreasing order.
+ * Case is ignored, and with SHELLHOP_REGEX needle is a regex, as
+ * shellhop_set_flags would have it with the same flags. Returns the number
+ * stored.
+ */
+int shellhop_find(const char* line, size_t line_len, const char* needle,
+                  size_t needle_len, int from, int flags, int* offsets, int max);
+
+/*
+ * Find every match of needle in line, as a search with the same flags would,
+ * in a single pass. Returns the number of matches and stores their offsets in
+ * increasing order in *offsets, which the caller frees.
+ */
+int shellhop_find_all(const char* line, size_t line_len, const char* needle,
+                      size_t needle_len, int flags, int** offsets);
+
+/* Flags for shellhop_interactive and shellhop_replay, along with the case flags */
+#define SHELLHOP_NO_SIGNALS (1 << 0) /* read Ctrl-C as a key instead of raising SIGINT */
+#define SHELLHOP_CHARS (1 << 4)      /* return a character index rather than an offset */
+#define SHELLHOP_HISTORY (1 << 7)    /* remember accepted needles; Ctrl-R recalls the last */
+
+/*
+ * Run an incremental search on line, reading keys from stdin and drawing
+ * on stderr. The terminal and signal state are restored before returning.
+ * Returns the offset of the chosen match, or -1 if input ended or the
+ * terminal couldn't be set up.
+ *
+ * With SHELLHOP_HISTORY, accepted needles are kept in the file named by
+ * $SHELLHOP_HISTORY, or ~/.shellhop_history, which concurrent shells share.
+ */
+int shellhop_interactive(const char* line, size_t line_len, int flags);
+
+/*
+ * As shellhop_interactive, on the line s was created or last reset with. s is
+ * left for shellhop_reset, so that a caller running many searches keeps its
+ * buffers between them.
+ */
+int shellhop_run(struct shellhop* s, int flags);
+
+/*
+ * Jump as if the last needle in the history had been typed and accepted,
+ * without a terminal. Returns the offset of its first match, or -1 if there
+ * is no needle or it doesn't match.
+ */
+int shellhop_repeat(const char* line, size_t line_len, int flags);
+
+/*
+ * Apply keys one at a time without a terminal, drawing the frames that
+ * shellhop_interactive would on stderr for a terminal width columns wide
+ * (unlimited if 0). For the initial frame and each key, the microseconds
+ * spent searching and rendering and the bytes drawn are written to report
+ * as tab-separated rows. Returns the offset as shellhop_interactive does,
+ * or -1 if the keys ran out first.
+ */
+int shellhop_replay(const char* line, size_t line_len, const char* keys,
+                    size_t keys_len, int width, int flags, FILE* report);
+
+#endif
@@ -12,14 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import fcntl
+import json
+import locale
 import os
 import select
+import shutil
 import subprocess
+import tempfile
 import time
 import unittest
 import signal
+import struct
+import termios
 import platform
 import pty
+import random
+import re
+
+import pyshellhop
 
 BINARY = './shellhop'
 
@@ -30,15 +40,30 @@ def set_nonblocking(f):
     fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
 
-def SpawnShellhop(argv):
+def set_columns(fd, columns):
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', 24, columns, 0, 0))
+
+
+def SpawnShellhop(argv, columns=None, line_fd=None, env=None, typeahead=None):
     if isinstance(argv, str):
         argv = [argv]
     master, slave = pty.openpty()
+    if columns is not None:
+        set_columns(slave, columns)
+    if typeahead is not None:
+        os.write(master, typeahead)
+    preexec_fn = None
+    if line_fd is not None:
+        def preexec_fn():
+            os.dup2(line_fd, 3)
+            fcntl.fcntl(3, fcntl.F_SETFD, 0)
     process = subprocess.Popen(
         [BINARY] + argv,
         stdin=slave,
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
+        stderr=subprocess.PIPE,
+        preexec_fn=preexec_fn,
+        env=env)
     set_nonblocking(process.stdout)
     set_nonblocking(process.stderr)
     stdin = os.fdopen(master, 'w', 0)
@@ -56,6 +81,12 @@ NORMAL = '\x1b[0m'
 CLEAR = '\x1b[J'
 
 
+def CURSOR_FORWARD(n):
+    if n == 1:
+        return '\x1b[C'
+    return '\x1b[%dC' % n
+
+
 class ShellhopTest(unittest.TestCase):
 
     def expect(self, f, expected, timeout=1.0):
@@ -73,6 +104,15 @@ class ShellhopTest(unittest.TestCase):
             data = f.read()
             self.assertEquals(data, '')
 
+    def read_frame(self, f, timeout=0.1):
+        data = ''
+        while select.select([f], [], [], timeout)[0]:
+            chunk = f.read()
+            if not chunk:
+                break
+            data += chunk
+        return data
+
     def test_basic(self):
         process, stdin, stdout, stderr = SpawnShellhop("abracadabra")
         self.expect(stderr, BEGINNING_OF_LINE)
@@ -84,11 +124,11 @@ class ShellhopTest(unittest.TestCase):
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
-        # Write one character, expect two matches.
+        # Write one character, expect two matches. Only the changed part of
+        # the line is redrawn.
         stdin.write('b')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(13))
         self.expect(stderr, REVERSE_VIDEO)
         self.expect(stderr, 'b')
         self.expect(stderr, NORMAL)
@@ -96,52 +136,32 @@ class ShellhopTest(unittest.TestCase):
         self.expect(stderr, UNDERLINE)
         self.expect(stderr, 'b')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, 'ra')
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, 'ra [1/2]')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
-        # Write two characters, expect redraws for each.
+        # Write two characters at once, expect a single redraw.
         stdin.write('ra')
-
-        self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
-        self.expect(stderr, REVERSE_VIDEO)
-        self.expect(stderr, 'br')
-        self.expect(stderr, NORMAL)
-        self.expect(stderr, 'acada')
-        self.expect(stderr, UNDERLINE)
-        self.expect(stderr, 'br')
-        self.expect(stderr, NORMAL)
-        self.expect(stderr, 'a')
-        self.expect(stderr, CLEAR)
-
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(14))
         self.expect(stderr, REVERSE_VIDEO)
-        self.expect(stderr, 'bra')
+        self.expect(stderr, 'ra')
         self.expect(stderr, NORMAL)
         self.expect(stderr, 'cada')
         self.expect(stderr, UNDERLINE)
         self.expect(stderr, 'bra')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, CLEAR)
-
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Write another character and get a unique match.
         stdin.write('c')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(16))
         self.expect(stderr, REVERSE_VIDEO)
-        self.expect(stderr, 'brac')
+        self.expect(stderr, 'c')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, 'adabra')
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, 'adabra [1/1')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
@@ -167,33 +187,28 @@ class ShellhopTest(unittest.TestCase):
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
-        # Hit backspace with no text.
+        # Hit backspace with no text. Nothing changes on screen.
         stdin.write('\x7f')
-        self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'abc')
-        self.expect(stderr, CLEAR)
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Write a character.
         stdin.write('b')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(13))
         self.expect(stderr, REVERSE_VIDEO)
         self.expect(stderr, 'b')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, 'c')
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, 'c [1/1]')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
-        # Hit backspace.
+        # Hit backspace. The counter is cleared.
         stdin.write('\x7f')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'abc')
+        self.expect(stderr, CURSOR_FORWARD(13))
+        self.expect(stderr, 'b')
+        self.expect(stderr, CURSOR_FORWARD(1))
         self.expect(stderr, CLEAR)
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
@@ -244,48 +259,32 @@ class ShellhopTest(unittest.TestCase):
 
         # Write a nonmatching character. It should be ignored.
         stdin.write('d')
-        self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'abc')
-        self.expect(stderr, CLEAR)
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Write a matching character.
         stdin.write('b')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(13))
         self.expect(stderr, REVERSE_VIDEO)
         self.expect(stderr, 'b')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, 'c')
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, 'c [1/1]')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Write a nonmatching character. It should be ignored.
         stdin.write('e')
-        self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
-        self.expect(stderr, REVERSE_VIDEO)
-        self.expect(stderr, 'b')
-        self.expect(stderr, NORMAL)
-        self.expect(stderr, 'c')
-        self.expect(stderr, CLEAR)
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Write a matching character.
         stdin.write('c')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(14))
         self.expect(stderr, REVERSE_VIDEO)
-        self.expect(stderr, 'bc')
+        self.expect(stderr, 'c')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, CLEAR)
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
@@ -314,8 +313,7 @@ class ShellhopTest(unittest.TestCase):
         # Write a matching character.
         stdin.write('b')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(13))
         self.expect(stderr, REVERSE_VIDEO)
         self.expect(stderr, 'b')
         self.expect(stderr, NORMAL)
@@ -327,18 +325,16 @@ class ShellhopTest(unittest.TestCase):
         self.expect(stderr, UNDERLINE)
         self.expect(stderr, 'b')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, 'c')
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, 'c [1/3]')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Write a matching character.
         stdin.write('c')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(14))
         self.expect(stderr, REVERSE_VIDEO)
-        self.expect(stderr, 'bc')
+        self.expect(stderr, 'c')
         self.expect(stderr, NORMAL)
         self.expect(stderr, 'a')
         self.expect(stderr, UNDERLINE)
@@ -348,15 +344,13 @@ class ShellhopTest(unittest.TestCase):
         self.expect(stderr, UNDERLINE)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, CLEAR)
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Hit ctrl-N to move to second match.
         stdin.write('\x0e')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(13))
         self.expect(stderr, UNDERLINE)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
@@ -368,19 +362,14 @@ class ShellhopTest(unittest.TestCase):
         self.expect(stderr, UNDERLINE)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, ' [2')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Hit ctrl-N to move to third match.
         stdin.write('\x0e')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
-        self.expect(stderr, UNDERLINE)
-        self.expect(stderr, 'bc')
-        self.expect(stderr, NORMAL)
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(16))
         self.expect(stderr, UNDERLINE)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
@@ -388,15 +377,14 @@ class ShellhopTest(unittest.TestCase):
         self.expect(stderr, REVERSE_VIDEO)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, ' [3')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Hit ctrl-N to move to first match.
         stdin.write('\x0e')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(13))
         self.expect(stderr, REVERSE_VIDEO)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
@@ -408,15 +396,14 @@ class ShellhopTest(unittest.TestCase):
         self.expect(stderr, UNDERLINE)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, ' [1')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Hit ctrl-P to move to third match.
         stdin.write('\x10')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(13))
         self.expect(stderr, UNDERLINE)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
@@ -428,19 +415,14 @@ class ShellhopTest(unittest.TestCase):
         self.expect(stderr, REVERSE_VIDEO)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, ' [3')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
         # Hit ctrl-P to move to second match.
         stdin.write('\x10')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
-        self.expect(stderr, UNDERLINE)
-        self.expect(stderr, 'bc')
-        self.expect(stderr, NORMAL)
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(16))
         self.expect(stderr, REVERSE_VIDEO)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
@@ -448,7 +430,7 @@ class ShellhopTest(unittest.TestCase):
         self.expect(stderr, UNDERLINE)
         self.expect(stderr, 'bc')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, ' [2')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
@@ -463,6 +445,434 @@ class ShellhopTest(unittest.TestCase):
 
         self.assertEquals(process.wait(), 0)
 
+    def test_adjacent_matches(self):
+        process, stdin, stdout, stderr = SpawnShellhop("abab")
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+        self.expect(stderr, RESTORE_CURSOR + '(shellhop): abab' + CLEAR)
+
+        # Adjacent matches switch attributes with a single sequence.
+        stdin.write('ab')
+        self.expect(stderr, RESTORE_CURSOR)
+        self.expect(stderr, CURSOR_FORWARD(12))
+        self.expect(stderr, REVERSE_VIDEO)
+        self.expect(stderr, 'ab')
+        self.expect(stderr, '\x1b[4;27m')
+        self.expect(stderr, 'ab')
+        self.expect(stderr, NORMAL)
+        self.expect(stderr, ' [1/2]')
+        self.expect_nothing(stderr)
+
+        stdin.write('\r')
+        self.expect(stderr, RESTORE_CURSOR + CLEAR + SHOW_CURSOR)
+        self.expect(stdout, '0\n')
+        self.assertEquals(process.wait(), 0)
+
+    def test_output_bytes(self):
+        line = 'x' * 2000 + 'abc' + 'y' * 2000 + 'abd' + 'z' * 2000
+        process, stdin, stdout, stderr = SpawnShellhop(line)
+        self.assertEquals(len(self.read_frame(stderr)), 6036)
+
+        # Each keystroke only sends the cells that changed, regardless of
+        # the length of the line.
+        for key in ['a', 'b', '\x0e', '\x10', 'd', '\x7f']:
+            stdin.write(key)
+            self.assertLess(len(self.read_frame(stderr)), 64)
+
+        stdin.write('\r')
+        self.expect(stdout, '4003\n')
+        self.assertEquals(process.wait(), 0)
+
+    def test_viewport(self):
+        line = "echo one two three four five six seven eight nine ten"
+        process, stdin, stdout, stderr = SpawnShellhop(line, columns=40)
+        self.expect(stderr, BEGINNING_OF_LINE)
+        self.expect(stderr, SAVE_CURSOR)
+        self.expect(stderr, HIDE_CURSOR)
+        self.expect(stderr, RESTORE_CURSOR)
+        self.expect(stderr, '(shellhop): echo one two three four ...')
+        self.expect(stderr, CLEAR)
+        self.expect_nothing(stderr)
+
+        # The counter takes room from the line.
+        stdin.write('t')
+        self.expect(stderr, RESTORE_CURSOR)
+        self.expect(stderr, CURSOR_FORWARD(21))
+        self.expect(stderr, REVERSE_VIDEO + 't' + NORMAL + 'wo ')
+        self.expect(stderr, UNDERLINE + 't' + NORMAL + 'hree... [1/4]')
+        self.expect_nothing(stderr)
+
+        # Moving to a match near the edge scrolls the line.
+        stdin.write('\x0e')
+        self.expect(stderr, RESTORE_CURSOR)
+        self.expect(stderr, CURSOR_FORWARD(12))
+        self.expect(stderr, '... one ')
+        self.expect(stderr, UNDERLINE + 't' + NORMAL + 'wo ')
+        self.expect(stderr, REVERSE_VIDEO + 't' + NORMAL + 'hree ... [2')
+        self.expect_nothing(stderr)
+
+        # The last match shows the end of the line without an ellipsis.
+        stdin.write('\x10\x10')
+        self.expect(stderr, RESTORE_CURSOR)
+        self.expect(stderr, CURSOR_FORWARD(15))
+        self.expect(stderr, 'ven eigh')
+        self.expect(stderr, UNDERLINE + 't' + NORMAL + ' nine ')
+        self.expect(stderr, REVERSE_VIDEO + 't' + NORMAL + 'en [4')
+        self.expect_nothing(stderr)
+
+        stdin.write('\r')
+        self.expect(stderr, RESTORE_CURSOR + CLEAR + SHOW_CURSOR)
+        self.expect(stdout, '50\n')
+        self.assertEquals(process.wait(), 0)
+
+    def test_sigwinch(self):
+        line = "echo one two three four five six seven eight nine ten"
+        process, stdin, stdout, stderr = SpawnShellhop(line, columns=40)
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+        self.expect(stderr, RESTORE_CURSOR)
+        self.expect(stderr, '(shellhop): echo one two three four ...')
+        self.expect(stderr, CLEAR)
+
+        # A resize redraws the whole frame for the new width.
+        set_columns(stdin.fileno(), 30)
+        os.kill(process.pid, signal.SIGWINCH)
+        self.expect(stderr, RESTORE_CURSOR)
+        self.expect(stderr, '(shellhop): echo one two t...')
+        self.expect(stderr, CLEAR)
+        self.expect_nothing(stderr)
+
+        stdin.write('\r')
+        self.expect(stderr, RESTORE_CURSOR + CLEAR + SHOW_CURSOR)
+        self.expect(stdout, '0\n')
+        self.assertEquals(process.wait(), 0)
+
+    def test_fd(self):
+        line = 'x' * 100000 + 'needle in a haystack\n'
+
+        # A regular file is mapped.
+        f = tempfile.TemporaryFile()
+        f.write(line)
+        f.flush()
+        f.seek(0)
+        process, stdin, stdout, stderr = SpawnShellhop(
+            ["--fd", "3"], columns=80, line_fd=f.fileno())
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+        stdin.write('needle in a haystack')
+        stdin.write('\r')
+        self.expect(stdout, '100000\n')
+        self.assertEquals(process.wait(), 0)
+
+        # A pipe is read until EOF.
+        r, w = os.pipe()
+        fcntl.fcntl(w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        process, stdin, stdout, stderr = SpawnShellhop(
+            ["-f", "3"], columns=80, line_fd=r)
+        os.close(r)
+        os.write(w, 'abc\n')
+        os.close(w)
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+        self.expect(stderr, RESTORE_CURSOR + '(shellhop): abc' + CLEAR)
+        stdin.write('c\r')
+        self.expect(stdout, '2\n')
+        self.assertEquals(process.wait(), 0)
+
+    def test_background_search(self):
+        # Lines this long are searched on a worker thread. Keys typed while
+        # a search runs are all applied, in order.
+        line = 'ab' * 1000000 + 'abend\n'
+        f = tempfile.TemporaryFile()
+        f.write(line)
+        f.flush()
+        f.seek(0)
+        process, stdin, stdout, stderr = SpawnShellhop(
+            ["--fd", "3"], columns=80, line_fd=f.fileno())
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+        for c in 'abxe\x7fen':
+            stdin.write(c)
+        stdin.write('\r')
+        self.expect(stdout, '2000000\n', timeout=10)
+        self.assertEquals(process.wait(), 0)
+
+        # Escape doesn't wait for the search.
+        f.seek(0)
+        process, stdin, stdout, stderr = SpawnShellhop(
+            ["--fd", "3"], columns=80, line_fd=f.fileno())
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+        stdin.write('a')
+        stdin.write('\x1b')
+        self.expect(stdout, '0\n')
+        self.assertEquals(process.wait(), 0)
+
+    def test_replay(self):
+        keys = tempfile.NamedTemporaryFile()
+        keys.write('br\x0e\r\n')
+        keys.flush()
+        env = dict(os.environ, COLUMNS='80')
+        process = subprocess.Popen(
+            [BINARY, '--replay', keys.name, 'abracadabra'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        stdout, stderr = process.communicate()
+        self.assertEquals(process.returncode, 0)
+
+        # The frames are drawn as on a terminal
+        self.assertTrue(stderr.startswith(
+            BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR + RESTORE_CURSOR +
+            '(shellhop): abracadabra' + CLEAR))
+        self.assertTrue(stderr.endswith(RESTORE_CURSOR + CLEAR + SHOW_CURSOR))
+
+        rows = [row.split('\t') for row in stdout.splitlines()]
+        self.assertEquals(rows[0], ['key', 'search_us', 'render_us', 'bytes'])
+        self.assertEquals([row[0] for row in rows[1:-1]],
+                          ['start', '0x62', '0x72', '0x0e', '0x0d', 'total'])
+        self.assertEquals(sum(int(row[3]) for row in rows[1:-2]), len(stderr))
+        self.assertEquals(int(rows[-2][3]), len(stderr))
+        self.assertEquals(rows[-1], ['8'])
+
+    def test_query(self):
+        def query(args, lines):
+            process = subprocess.Popen(
+                [BINARY, '--query'] + args,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate(lines)
+            self.assertEquals(stderr, '')
+            self.assertEquals(process.returncode, 0)
+            return stdout
+
+        lines = 'abracadabra\naaaa\nxyz\n'
+        self.assertEquals(query(['a'], lines), '0 3 5 7 10\n0 1 2 3\n\n')
+        self.assertEquals(query(['aa'], lines), '\n0 1 2\n\n')
+        self.assertEquals(query(['a', '--first'], lines), '0\n0\n-1\n')
+        self.assertEquals(query(['a', '--from', '4'], lines), '5 7 10\n\n\n')
+        self.assertEquals(query(['aa', '--backward'], lines), '\n2 1 0\n\n')
+        self.assertEquals(query(['a', '--backward', '--from', '6', '--first'], lines),
+                          '5\n3\n-1\n')
+        self.assertEquals(query(['a\nb', '-0'], 'a\nb\0xa\nb'), '0\n1\n')
+        self.assertEquals(query(['make', '-i'], 'Make make MAKE\n'), '0 5 10\n')
+        self.assertEquals(query(['Make', '-S'], 'Make make MAKE\n'), '0\n')
+        self.assertEquals(query(['mAKE', '-i', '--backward'], 'Make make\n'), '5 0\n')
+        self.assertEquals(query(['a.c', '-E'], 'abc a.c\nac\n'), '0 4\n\n')
+        self.assertEquals(query(['a[0-9]+', '-E', '--backward', '--from', '5'], 'a1 a22 a3\n'),
+                          '3 0\n')
+        self.assertEquals(query(['A.', '-E', '-S', '--first'], 'ab Ab\n'), '3\n')
+        self.assertEquals(query(['ake', '-S', '--from', '2'], 'MAKE make\n'), '6\n')
+
+        # Matches start on whole characters, as in an interactive search
+        line = u'caf\xe9 \xe9'.encode('utf-8') + '\n'
+        for lc_all, expected in [('C.UTF-8', '\n'), ('C', '4 7\n')]:
+            process = subprocess.Popen(
+                [BINARY, '--query', '\xa9'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                env=dict(os.environ, LC_ALL=lc_all))
+            self.assertEquals(process.communicate(line)[0], expected)
+
+        # More matches than fit in one batch
+        self.assertEquals(query(['a'], 'a' * 1000),
+                          ' '.join(str(i) for i in range(1000)) + '\n')
+        self.assertEquals(query(['a', '-E'], 'a' * 1000),
+                          ' '.join(str(i) for i in range(1000)) + '\n')
+        self.assertEquals(query(['a', '-E', '--backward', '--first'], 'a' * 1000), '999\n')
+
+    def test_server(self):
+        master, slave = pty.openpty()
+
+        def preexec_fn():
+            # Make the pty the controlling terminal, as it is for a coprocess
+            os.setsid()
+            fcntl.ioctl(slave, termios.TIOCSCTTY, 0)
+
+        process = subprocess.Popen(
+            [BINARY, '--server'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            preexec_fn=preexec_fn)
+        os.close(slave)
+        terminal = os.fdopen(master, 'r+', 0)
+        set_nonblocking(terminal)
+
+        # One process serves several activations
+        process.stdin.write('0\0abracadabra\0')
+        process.stdin.flush()
+        self.expect(terminal, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+        terminal.write('cad\r')
+        self.assertEquals(process.stdout.readline(), '4\n')
+
+        process.stdin.write('5\0hello world\0')
+        process.stdin.flush()
+        self.read_frame(terminal)
+        terminal.write('o\x0e\r')
+        self.assertEquals(process.stdout.readline(), '7\n')
+
+        # Ctrl-C cancels rather than killing the server
+        process.stdin.write('3\0abc\0')
+        process.stdin.flush()
+        self.read_frame(terminal)
+        terminal.write('\x03')
+        self.assertEquals(process.stdout.readline(), '0\n')
+
+        process.stdin.close()
+        self.assertEquals(process.wait(), 0)
+        terminal.close()
+
+    def test_typeahead(self):
+        # Keys typed before the terminal is set up are not lost
+        process, stdin, stdout, stderr = SpawnShellhop("abracadabra", typeahead='cad')
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR +
+                    RESTORE_CURSOR + '(shellhop): abra' + REVERSE_VIDEO + 'cad' +
+                    NORMAL + 'abra [1/1]' + CLEAR)
+        self.expect_nothing(stderr)
+        stdin.write('\r')
+        self.expect(stdout, '4\n')
+        self.assertEquals(process.wait(), 0)
+
+        # Enter typed before raw mode arrives as a newline
+        process, stdin, stdout, stderr = SpawnShellhop("abracadabra", typeahead='cad\r')
+        self.expect(stdout, '4\n')
+        self.assertEquals(process.wait(), 0)
+
+    def test_utf8(self):
+        line = u'h\xe9llo w\xf6rld \u6f22\u5b57 wend'.encode('utf-8')
+        process, stdin, stdout, stderr = SpawnShellhop(
+            ['--chars', line], env=dict(os.environ, LC_ALL='C.UTF-8'))
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR +
+                    RESTORE_CURSOR + '(shellhop): ' + line + CLEAR)
+
+        # The cursor moves by columns, two for each wide character
+        stdin.write('w')
+        self.expect(stderr, RESTORE_CURSOR + CURSOR_FORWARD(18) + REVERSE_VIDEO + 'w' +
+                    CURSOR_FORWARD(10) + '\x1b[4;27m' + 'w' + NORMAL + 'end [1/2]')
+        self.expect_nothing(stderr)
+
+        # The result counts characters rather than bytes
+        stdin.write('\x0e\r')
+        self.expect(stdout, '15\n')
+        self.assertEquals(process.wait(), 0)
+
+    def test_labels(self):
+        process, stdin, stdout, stderr = SpawnShellhop(["--labels", "aba abs xab"])
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR +
+                    RESTORE_CURSOR + '(shellhop): aba abs xab' + CLEAR)
+        stdin.write('ab')
+        self.expect(stderr, RESTORE_CURSOR + CURSOR_FORWARD(12) + REVERSE_VIDEO + 'ab' +
+                    NORMAL + 'a ' + '\x1b[4;1m' + 'd' + '\x1b[22m' + 'b' + NORMAL + 's x' +
+                    '\x1b[4;1m' + 'f' + '\x1b[22m' + 'b' + NORMAL + ' [1/3]')
+        self.expect_nothing(stderr)
+        stdin.write('f')
+        self.expect(stdout, '9\n')
+        self.assertEquals(process.wait(), 0)
+
+    def test_regex(self):
+        process, stdin, stdout, stderr = SpawnShellhop(["--regex", "ls --all -l"])
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR +
+                    RESTORE_CURSOR + '(shellhop): ls --all -l' + CLEAR)
+        stdin.write(r' -\w$')
+        self.expect(stderr, RESTORE_CURSOR + CURSOR_FORWARD(20) + REVERSE_VIDEO + ' -l' +
+                    NORMAL + ' [1/1]')
+        self.expect_nothing(stderr)
+        stdin.write('\r')
+        self.expect(stdout, '8\n')
+        self.assertEquals(process.wait(), 0)
+
+        # Labels would take letters that continue the pattern, such as the s of \s
+        keys = tempfile.NamedTemporaryFile()
+        keys.write('x\\s\r')
+        keys.flush()
+        process = subprocess.Popen(
+            [BINARY, '--regex', '--replay', keys.name, 'x1 x2 x3 x y'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        self.assertEquals(process.returncode, 0)
+        self.assertEquals(stdout.splitlines()[-1], '9')
+        process = subprocess.Popen(
+            [BINARY, '--regex', '--labels', '--replay', keys.name, 'x1 x2 x3 x y'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        self.assertEquals(process.returncode, 1)
+        self.assertEquals(stdout, '')
+        self.assertEquals(stderr, "./shellhop: --labels can't be used with --regex\n")
+
+    def test_history(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ, SHELLHOP_HISTORY=os.path.join(tmpdir, 'history'))
+
+            def repeat(line):
+                process = subprocess.Popen(
+                    [BINARY, '--repeat', line], stdout=subprocess.PIPE, env=env)
+                stdout, _ = process.communicate()
+                return process.returncode, stdout
+
+            self.assertEquals(repeat('ls -l'), (1, ''))
+
+            process, stdin, stdout, stderr = SpawnShellhop(["-H", "ls --all -l"], env=env)
+            stdin.write('-l\r')
+            self.expect(stdout, '9\n')
+            self.assertEquals(process.wait(), 0)
+
+            # The last needle is found without a terminal
+            self.assertEquals(repeat('echo -l -l'), (0, '5\n'))
+            self.assertEquals(repeat('echo'), (1, ''))
+
+            # Ctrl-R recalls it
+            process, stdin, stdout, stderr = SpawnShellhop(["-H", "cat -l -a"], env=env)
+            self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR +
+                        RESTORE_CURSOR + '(shellhop): cat -l -a' + CLEAR)
+            stdin.write('\x12')
+            self.expect(stderr, RESTORE_CURSOR + CURSOR_FORWARD(16) + REVERSE_VIDEO + '-l' +
+                        NORMAL + ' -a [1/1]')
+            stdin.write('\x7fa\r')
+            self.expect(stdout, '7\n')
+            self.assertEquals(process.wait(), 0)
+            self.assertEquals(repeat('cat -a'), (0, '4\n'))
+
+            # Cancelling doesn't change the history
+            process, stdin, stdout, stderr = SpawnShellhop(["-H", "cat -l"], env=env)
+            stdin.write('c\x1b')
+            self.expect(stdout, '0\n')
+            self.assertEquals(process.wait(), 0)
+            self.assertEquals(repeat('cat -a'), (0, '4\n'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_lines(self):
+        process, stdin, stdout, stderr = SpawnShellhop("ls \\\n  -l\necho -l")
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR +
+                    RESTORE_CURSOR + '(shellhop): ls \\ [line 1/3]' + CLEAR)
+
+        # Moving to another line redraws the one row in place
+        stdin.write('-l')
+        self.expect(stderr, RESTORE_CURSOR + CURSOR_FORWARD(12) + '  ' + REVERSE_VIDEO +
+                    '-l' + NORMAL + ' [1/2] [line 2/3]')
+        stdin.write('\x0e')
+        self.expect(stderr, RESTORE_CURSOR + CURSOR_FORWARD(12) + 'echo ' + REVERSE_VIDEO +
+                    '-l' + NORMAL + ' [2/2] [line 3/3]')
+        self.expect_nothing(stderr)
+        stdin.write('\r')
+        self.expect(stdout, '15\n')
+        self.assertEquals(process.wait(), 0)
+
+    def test_narrow_keeps_position(self):
+        process, stdin, stdout, stderr = SpawnShellhop("abxabyabz")
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+
+        # Move to the second match, then narrow. The selection should stay
+        # on or after the second match.
+        stdin.write('ab\x0ey\r')
+        self.expect(stdout, '3\n')
+        self.assertEquals(process.wait(), 0)
+
+        process, stdin, stdout, stderr = SpawnShellhop("abxabyabz")
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+
+        # Narrowing to a match before the current one wraps around.
+        stdin.write('ab\x0e\x0ex\r')
+        self.expect(stdout, '0\n')
+        self.assertEquals(process.wait(), 0)
+
+        process, stdin, stdout, stderr = SpawnShellhop("abxabyabz")
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+
+        # Backspace returns to the wider match set without moving.
+        stdin.write('ab\x0ey\x7f\x7f\x0e\r')
+        self.expect(stdout, '6\n')
+        self.assertEquals(process.wait(), 0)
+
     def test_sigint(self):
         process, stdin, stdout, stderr = SpawnShellhop("abc")
         self.expect(stderr, BEGINNING_OF_LINE)
@@ -482,6 +892,38 @@ class ShellhopTest(unittest.TestCase):
         self.expect_nothing(stdout)
         self.assertEquals(process.wait(), -signal.SIGINT)
 
+    def test_trace(self):
+        trace = tempfile.NamedTemporaryFile()
+        env = dict(os.environ, SHELLHOP_TRACE=trace.name)
+        process, stdin, stdout, stderr = SpawnShellhop("abracadabra", env=env)
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+        stdin.write('b')
+        drawn = BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR + self.read_frame(stderr)
+        stdin.write('\r')
+        self.expect(stdout, '1\n')
+        self.assertEquals(process.wait(), 0)
+        drawn += stderr.read()
+
+        events = json.load(open(trace.name))['traceEvents']
+        names = set(e['name'] for e in events)
+        self.assertTrue(set(['read', 'search', 'build', 'draw', 'write']) <= names)
+        totals = events[-1]
+        self.assertEquals(totals['name'], 'totals')
+        self.assertEquals(totals['args']['bytes_written'], len(drawn))
+        self.assertEquals(totals['args']['dropped_events'], 0)
+        self.assertEquals(sum(e['args']['n'] for e in events if e['name'] == 'write'),
+                          len(drawn))
+
+        # The trace is also written when interrupted
+        process, stdin, stdout, stderr = SpawnShellhop("abc", env=env)
+        self.expect(stderr, BEGINNING_OF_LINE + SAVE_CURSOR + HIDE_CURSOR)
+        self.read_frame(stderr)
+        os.kill(process.pid, signal.SIGINT)
+        self.assertEquals(process.wait(), -signal.SIGINT)
+        events = json.load(open(trace.name))['traceEvents']
+        self.assertTrue('write' in [e['name'] for e in events])
+        self.assertEquals(events[-1]['name'], 'totals')
+
     def test_escape(self):
         process, stdin, stdout, stderr = SpawnShellhop("abc")
         self.expect(stderr, BEGINNING_OF_LINE)
@@ -496,13 +938,11 @@ class ShellhopTest(unittest.TestCase):
         # Write a matching character.
         stdin.write('b')
         self.expect(stderr, RESTORE_CURSOR)
-        self.expect(stderr, '(shellhop): ')
-        self.expect(stderr, 'a')
+        self.expect(stderr, CURSOR_FORWARD(13))
         self.expect(stderr, REVERSE_VIDEO)
         self.expect(stderr, 'b')
         self.expect(stderr, NORMAL)
-        self.expect(stderr, 'c')
-        self.expect(stderr, CLEAR)
+        self.expect(stderr, 'c [1/1]')
         self.expect_nothing(stderr)
         self.expect_nothing(stdout)
 
@@ -518,7 +958,7 @@ class ShellhopTest(unittest.TestCase):
     def test_bash_source(self):
         script = r"""
 function _shellhop {
-  READLINE_POINT=$(./shellhop "$READLINE_LINE");
+  READLINE_POINT=$(./shellhop --chars --fd 3 3<<<"$READLINE_LINE");
 };
 bind '"\C-xS0":beginning-of-line';
 bind -x '"\C-xS1":"_shellhop"';
@@ -537,10 +977,28 @@ bind '"\C-x\C-f":"\C-xS0\C-xS1"';
         self.expect_nothing(stdout)
         self.assertEquals(process.wait(), 0)
 
+    def test_bash_builtin_source(self):
+        # The builtin is used when shellhop.so is next to the binary.
+        tmpdir = tempfile.mkdtemp()
+        try:
+            binary = os.path.join(tmpdir, 'shellhop')
+            shutil.copy(BINARY, binary)
+            open(binary + '.so', 'w').close()
+            script = r"""
+enable -f %s.so shellhop;
+bind '"\C-xS0":beginning-of-line';
+bind -x '"\C-xS1":"shellhop"';
+bind '"\C-x\C-f":"\C-xS0\C-xS1"';
+"""[1:] % binary
+            output = subprocess.check_output([binary, '--bash'])
+            self.assertEquals(output, script)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_bash_source_with_key(self):
         script = r"""
 function _shellhop {
-  READLINE_POINT=$(./shellhop "$READLINE_LINE");
+  READLINE_POINT=$(./shellhop --chars --fd 3 3<<<"$READLINE_LINE");
 };
 bind '"\C-xS0":beginning-of-line';
 bind -x '"\C-xS1":"_shellhop"';
@@ -559,13 +1017,84 @@ bind '"\C-j":"\C-xS0\C-xS1"';
         self.expect_nothing(stdout)
         self.assertEquals(process.wait(), 0)
 
-    def test_zsh_source(self):
+    def test_bash_server_source(self):
         script = r"""
+{ set +m; coproc _SHELLHOP { exec ./shellhop --server --chars; }; set -m; } 2>/dev/null;
 function _shellhop {
-  CURSOR=$(./shellhop "$BUFFER" </dev/tty);
-  zle redisplay;
+  if [[ -n ${_SHELLHOP[1]} ]]; then
+    printf '%s\0%s\0' "$READLINE_POINT" "$READLINE_LINE" >&"${_SHELLHOP[1]}";
+    read -r READLINE_POINT <&"${_SHELLHOP[0]}";
+  else
+    READLINE_POINT=$(./shellhop --chars --fd 3 3<<<"$READLINE_LINE");
+  fi;
 };
-zle -N shellhop _shellhop;
+bind '"\C-xS0":beginning-of-line';
+bind -x '"\C-xS1":"_shellhop"';
+bind '"\C-x\C-f":"\C-xS0\C-xS1"';
+"""[1:]
+
+        process, stdin, stdout, stderr = SpawnShellhop(["--bash", "--server"])
+        self.expect(stdout, script)
+        self.expect_nothing(stderr)
+        self.expect_nothing(stdout)
+        self.assertEquals(process.wait(), 0)
+
+    def test_zsh_server_source(self):
+        script = r"""
+if ! zmodload zsh/shellhop 2>/dev/null; then
+  () {
+    setopt local_options no_monitor;
+    coproc exec ./shellhop --server --chars;
+    exec {_shellhop_in}<&p;
+    exec {_shellhop_out}>&p;
+  };
+  function _shellhop {
+    print -rn -- "$CURSOR"$'\0'"$BUFFER"$'\0' >&$_shellhop_out;
+    read -r CURSOR <&$_shellhop_in;
+    zle redisplay;
+  };
+  zle -N shellhop _shellhop;
+fi;
+bindkey '\C-x\C-f' shellhop;
+"""[1:]
+
+        process, stdin, stdout, stderr = SpawnShellhop(["-z", "-s"])
+        self.expect(stdout, script)
+        self.expect_nothing(stderr)
+        self.expect_nothing(stdout)
+        self.assertEquals(process.wait(), 0)
+
+    def test_case_source(self):
+        output = subprocess.check_output([BINARY, '--bash', '--smart-case'])
+        self.assertTrue('READLINE_POINT=$(./shellhop --chars -S --fd 3' in output)
+        output = subprocess.check_output([BINARY, '--bash', '--server', '-i'])
+        self.assertTrue('exec ./shellhop --server --chars -i;' in output)
+        self.assertTrue('READLINE_POINT=$(./shellhop --chars -i --fd 3' in output)
+        output = subprocess.check_output([BINARY, '--zsh', '--ignore-case'])
+        self.assertTrue(output.startswith('SHELLHOP_CASE=ignore;\nif ! zmodload'))
+        self.assertTrue('CURSOR=$(./shellhop --chars -i --fd 3' in output)
+        output = subprocess.check_output([BINARY, '--bash', '--labels', '-S'])
+        self.assertTrue('READLINE_POINT=$(./shellhop --chars -S -l --fd 3' in output)
+        output = subprocess.check_output([BINARY, '--bash', '--history', '-E'])
+        self.assertTrue('READLINE_POINT=$(./shellhop --chars -E -H --fd 3' in output)
+
+        # The zsh module is skipped for options it doesn't support
+        for option in ['-l', '-E', '-H']:
+            for server in [[], ['--server']]:
+                output = subprocess.check_output([BINARY, '--zsh', option] + server)
+                self.assertTrue(output.startswith('if true; then\n'))
+                self.assertTrue('--chars %s' % option in output)
+                self.assertTrue('zmodload' not in output)
+
+    def test_zsh_source(self):
+        script = r"""
+if ! zmodload zsh/shellhop 2>/dev/null; then
+  function _shellhop {
+    CURSOR=$(./shellhop --chars --fd 3 3<<<"$BUFFER" </dev/tty);
+    zle redisplay;
+  };
+  zle -N shellhop _shellhop;
+fi;
 bindkey '\C-x\C-f' shellhop;
 """[1:]
 
@@ -583,11 +1112,13 @@ bindkey '\C-x\C-f' shellhop;
 
     def test_zsh_source_with_key(self):
         script = r"""
-function _shellhop {
-  CURSOR=$(./shellhop "$BUFFER" </dev/tty);
-  zle redisplay;
-};
-zle -N shellhop _shellhop;
+if ! zmodload zsh/shellhop 2>/dev/null; then
+  function _shellhop {
+    CURSOR=$(./shellhop --chars --fd 3 3<<<"$BUFFER" </dev/tty);
+    zle redisplay;
+  };
+  zle -N shellhop _shellhop;
+fi;
 bindkey '\C-j' shellhop;
 """[1:]
 
@@ -606,6 +1137,9 @@ bindkey '\C-j' shellhop;
     def test_help(self):
         help_text = """\
 usage: ./shellhop [OPTION]... LINE
+  or:  ./shellhop [OPTION]... --fd=FD
+  or:  ./shellhop --query=NEEDLE [OPTION]...
+  or:  ./shellhop --server
 
 Do an incremental search on the given line and write the index of the first
 match to stdout.
@@ -613,6 +1147,39 @@ match to stdout.
   -b, --bash     output Bash shell commands to stdout
   -z, --zsh      output Zsh shell commands to stdout
   -k, --key=KEY  specify a key for --bash and --zsh
+  -i, --ignore-case
+                 match ASCII letters in either case
+  -S, --smart-case
+                 ignore case unless the needle has an uppercase letter
+  -l, --labels   once two characters are typed, label the matches on
+                 screen; typing a label jumps to its match
+  -E, --regex    search for an extended regular expression rather than
+                 a string
+  -H, --history  remember accepted needles in $SHELLHOP_HISTORY or
+                 ~/.shellhop_history; Ctrl-R recalls the last one
+      --repeat   write the index of the first match of the last needle
+                 remembered, without searching interactively
+  -c, --chars    write the number of characters before the match rather
+                 than bytes, as shells count them for the cursor
+  -f, --fd=FD    read LINE from file descriptor FD, dropping one trailing
+                 newline so that a here-string can be used
+  -r, --replay=FILE
+                 apply the keys in FILE without a terminal, writing frames
+                 to stderr and the time taken by each key to stdout; the
+                 width is taken from COLUMNS
+  -q, --query=NEEDLE
+                 read lines from stdin and write a line with the offsets
+                 of NEEDLE in each, separated by spaces
+  -0, --null     with --query, lines end with NUL rather than newline
+      --first    with --query, write only the first offset, or -1
+      --from=OFFSET
+                 with --query, only find matches from OFFSET on
+      --backward with --query, find matches at or before --from (by
+                 default the end of the line), nearest first
+  -s, --server   read NUL-terminated pairs of cursor and LINE from stdin,
+                 search each on the terminal and write the resulting
+                 index to stdout; with --bash and --zsh, output commands
+                 that run shellhop as a coprocess
   -h, --help     display this help and exit
 """
 
@@ -644,5 +1211,405 @@ match to stdout.
         self.expect_nothing(stdout)
         self.assertEquals(process.wait(), 1)
 
+class EngineTest(unittest.TestCase):
+    """Drives libshellhop in-process through the Python binding."""
+
+    def test_feed(self):
+        s = pyshellhop.Shellhop(b"abracadabra")
+        self.assertEquals(s.feed(b"b"), pyshellhop.CONTINUE)
+        self.assertEquals(s.needle, b"b")
+        self.assertEquals(s.matches, [1, 8])
+        self.assertEquals(s.cursor, 1)
+        self.assertEquals(s.feed(b"\x0e"), pyshellhop.CONTINUE)
+        self.assertEquals(s.current, 1)
+        self.assertEquals(s.cursor, 8)
+        # Nonmatching characters are ignored
+        self.assertEquals(s.feed(b"rx"), pyshellhop.CONTINUE)
+        self.assertEquals(s.needle, b"br")
+        self.assertEquals(s.cursor, 8)
+        self.assertEquals(s.feed(b"\x7f\x7f"), pyshellhop.CONTINUE)
+        self.assertEquals(s.matches, [])
+        self.assertEquals(s.feed(b"\r"), pyshellhop.ACCEPT)
+        self.assertEquals(s.cursor, 8)
+        self.assertEquals(pyshellhop.Shellhop(b"abc").feed(b"b\x1bc"), pyshellhop.CANCEL)
+
+    def test_render(self):
+        s = pyshellhop.Shellhop(b"abracadabra")
+        s.feed(b"br")
+        text, styles = s.render()
+        self.assertEquals(text, b"(shellhop): abracadabra [1/2]")
+        U, R = pyshellhop.UNDERLINE, pyshellhop.REVERSE_VIDEO
+        self.assertEquals(styles, [0] * 13 + [R, R] + [0] * 5 + [U, U] + [0] * 7)
+
+        s = pyshellhop.Shellhop(b"echo one two three four five six")
+        s.feed(b"six")
+        text, styles = s.render(30)
+        self.assertEquals(text, b"(shellhop): ...five six [1/1]")
+
+    def test_labels(self):
+        s = pyshellhop.Shellhop(b"aba abs xab", pyshellhop.LABELS)
+        s.feed(b"a")
+        text, styles = s.render()
+        self.assertEquals(text, b"(shellhop): aba abs xab [1/4]")
+
+        # Matches at token starts come first, and labels never extend the needle
+        s.feed(b"b")
+        text, styles = s.render()
+        self.assertEquals(text, b"(shellhop): aba dbs xfb [1/3]")
+        U, R, L = pyshellhop.UNDERLINE, pyshellhop.REVERSE_VIDEO, pyshellhop.LABEL
+        self.assertEquals(styles, [0] * 12 + [R, R] + [0] * 2 + [U | L, U] + [0] * 3 +
+                          [U | L, U] + [0] * 6)
+        self.assertEquals(s.feed(b"f"), pyshellhop.ACCEPT)
+        self.assertEquals(s.cursor, 9)
+
+        # Labels last for one key
+        s = pyshellhop.Shellhop(b"aba abs xab", pyshellhop.LABELS)
+        s.feed(b"ab")
+        s.render()
+        s.feed(b"\x0e")
+        self.assertEquals(s.feed(b"f"), pyshellhop.CONTINUE)
+        self.assertEquals(s.feed(b"s"), pyshellhop.CONTINUE)
+        self.assertEquals(s.needle, b"abs")
+
+        # Nor do they extend it at matches out of view
+        for line, width in [(b"ab1 ab2 ab3\nabs", 0), (b"abq ab1 ab2 ab3 " + b"x" * 60 + b" abs", 60)]:
+            s = pyshellhop.Shellhop(line, pyshellhop.LABELS)
+            s.feed(b"ab")
+            text, styles = s.render(width)
+            self.assertTrue(b"s" not in text[12:])
+            self.assertEquals(s.feed(b"s"), pyshellhop.CONTINUE)
+            self.assertEquals(s.needle, b"abs")
+            self.assertEquals(s.cursor, len(line) - 3)
+
+    def test_regex_labels(self):
+        # The engine doesn't label regex matches
+        s = pyshellhop.Shellhop(b"x1 x2 x3 x y", pyshellhop.REGEX | pyshellhop.LABELS)
+        s.feed(b"x")
+        s.feed(b"\\")
+        text, styles = s.render()
+        self.assertFalse(any(x & pyshellhop.LABEL for x in styles))
+        self.assertEquals(s.feed(b"s\r"), pyshellhop.ACCEPT)
+        self.assertEquals(s.cursor, 9)
+
+    def test_recall(self):
+        s = pyshellhop.Shellhop(b"ls --all -l")
+        s.set_recall(b"-l")
+        self.assertEquals(s.feed(b"\x12"), pyshellhop.CONTINUE)
+        self.assertEquals(s.needle, b"-l")
+        self.assertEquals(s.matches, [9])
+        self.assertEquals(s.cursor, 9)
+        # Only an empty needle is replaced
+        s.feed(b"\x7f\x12")
+        self.assertEquals(s.needle, b"-")
+        self.assertEquals(s.matches, [3, 4, 9])
+
+        s = pyshellhop.Shellhop(b"ls --all", pyshellhop.REGEX)
+        s.set_recall(b"-+a")
+        s.feed(b"\x12")
+        self.assertEquals(s.matches, [3, 4])
+
+        # A needle without matches isn't recalled
+        s = pyshellhop.Shellhop(b"ls --all")
+        s.set_recall(b"-l")
+        s.feed(b"\x12")
+        self.assertEquals(s.needle, b"")
+
+    def test_reset(self):
+        s = pyshellhop.Shellhop(b"Ab ab", pyshellhop.IGNORE_CASE)
+        s.set_recall(b"ab")
+        s.feed(b"ab\x0e")
+        self.assertEquals(s.cursor, 3)
+        # The flags carry over to the new line, the needle and recall don't
+        s.reset(b"xx AB\ncd")
+        self.assertEquals(s.needle, b"")
+        self.assertEquals(s.matches, [])
+        self.assertEquals(s.cursor, 0)
+        s.feed(b"\x12")
+        self.assertEquals(s.needle, b"")
+        s.feed(b"ab")
+        self.assertEquals(s.matches, [3])
+        self.assertEquals(s.cursor, 3)
+        s.feed(b"\x7f\x7fc")
+        self.assertEquals(s.cursor, 6)
+
+    def test_highlight_limit(self):
+        U, R = pyshellhop.UNDERLINE, pyshellhop.REVERSE_VIDEO
+        s = pyshellhop.Shellhop(b"a-a-a-a-a-a")
+        s.set_highlight_limit(2)
+        s.feed(b"a\x0e\x0e")
+        text, styles = s.render()
+        self.assertEquals(text, b"(shellhop): a-a-a-a-a-a [3/6]")
+        # Only the spans nearest the current match are underlined
+        self.assertEquals(styles, [0] * 14 + [U, 0, R, 0, U] + [0] * 10)
+        s.feed(b"\x0e\x0e\x0e")
+        self.assertEquals(s.current, 5)
+        text, styles = s.render()
+        self.assertEquals(styles, [0] * 18 + [U, 0, U, 0, R] + [0] * 6)
+
+        # The default keeps a dense line's frame near the size of the line
+        s = pyshellhop.Shellhop(b"a-" * 5000)
+        s.feed(b"a")
+        text, styles = s.render()
+        self.assertEquals(styles.count(U), 32)
+        s.set_highlight_limit(0)
+        text, styles = s.render()
+        self.assertEquals(styles.count(U), 4999)
+
+    def test_render_lines(self):
+        # Only the line of a multi-line buffer holding the current match is shown
+        s = pyshellhop.Shellhop(b"cat <<EOF\nabc\nEOF\necho abc")
+        text, styles = s.render()
+        self.assertEquals(text, b"(shellhop): cat <<EOF [line 1/4]")
+        s.feed(b"abc")
+        text, styles = s.render()
+        self.assertEquals(text, b"(shellhop): abc [1/2] [line 2/4]")
+        self.assertEquals(styles, [0] * 12 + [pyshellhop.REVERSE_VIDEO] * 3 + [0] * 17)
+        s.feed(b"\x0e")
+        text, styles = s.render()
+        self.assertEquals(text, b"(shellhop): echo abc [2/2] [line 4/4]")
+        self.assertEquals(s.cursor, 23)
+
+        s = pyshellhop.Shellhop(b"x\necho one two three four five six")
+        s.feed(b"six")
+        text, styles = s.render(41)
+        self.assertEquals(text, b"(shellhop): ...five six [1/1] [line 2/2]")
+
+    def test_random(self):
+        # Compare against a naive search of every prefix of the needle
+        rng = random.Random(0)
+        for _ in range(2000):
+            line = bytes(bytearray(rng.choice(b"ab ") for _ in range(rng.randint(0, 30))))
+            keys = bytes(bytearray(rng.choice(b"ab \x7f\x0e\x10") for _ in range(8)))
+            s = pyshellhop.Shellhop(line)
+            for key in bytearray(keys):
+                old_needle = s.needle
+                s.feed(bytes(bytearray([key])))
+                needle = s.needle
+                if key == 0x7f:
+                    self.assertEquals(needle, old_needle[:-1])
+                elif key in (0x0e, 0x10):
+                    self.assertEquals(needle, old_needle)
+                else:
+                    candidate = old_needle + bytes(bytearray([key]))
+                    self.assertEquals(needle, candidate if candidate in line else old_needle)
+                expected = [i for i in range(len(line)) if needle and line.startswith(needle, i)]
+                self.assertEquals(s.matches, expected)
+                if expected:
+                    self.assertEquals(s.cursor, expected[s.current])
+
+    def test_random_render(self):
+        # Compare highlights against styling each cell separately
+        rng = random.Random(2)
+        for _ in range(2000):
+            line = bytes(bytearray(rng.choice(b"ab") for _ in range(rng.randint(1, 30))))
+            s = pyshellhop.Shellhop(line)
+            s.feed(bytes(bytearray(rng.choice(b"ab") for _ in range(rng.randint(1, 4)))))
+            s.feed(b"\x0e" * rng.randint(0, 3))
+            text, styles = s.render()
+            expected = [0] * len(line)
+            for i in s.matches:
+                style = pyshellhop.REVERSE_VIDEO if i == s.cursor else pyshellhop.UNDERLINE
+                for k in range(i, i + len(s.needle)):
+                    expected[k] |= style
+            self.assertEquals(styles[12:12 + len(line)], expected)
+            self.assertFalse(any(styles[:12] + styles[12 + len(line):]))
+
+    def test_random_runs(self):
+        # Feed several characters at once, then backspace through them
+        rng = random.Random(1)
+        for _ in range(2000):
+            line = bytes(bytearray(rng.choice(b"ab") for _ in range(rng.randint(0, 30))))
+            s = pyshellhop.Shellhop(line)
+            keys = bytes(bytearray(rng.choice(b"ab") for _ in range(rng.randint(1, 6))))
+            s.feed(keys)
+            needle = b""
+            for c in bytearray(keys):
+                candidate = needle + bytes(bytearray([c]))
+                if candidate in line:
+                    needle = candidate
+            self.assertEquals(s.needle, needle)
+            while needle:
+                expected = [i for i in range(len(line)) if line.startswith(needle, i)]
+                self.assertEquals(s.matches, expected)
+                self.assertEquals(s.cursor, expected[s.current])
+                s.feed(b"\x7f")
+                needle = needle[:-1]
+
+    def test_case(self):
+        s = pyshellhop.Shellhop(b"Make make MAKE", pyshellhop.IGNORE_CASE)
+        s.feed(b"mAke")
+        self.assertEquals(s.needle, b"mAke")
+        self.assertEquals(s.matches, [0, 5, 10])
+
+        # Smart case matches exactly once the needle has an uppercase letter
+        s = pyshellhop.Shellhop(b"Make make MAKE", pyshellhop.SMART_CASE)
+        s.feed(b"ma")
+        self.assertEquals(s.matches, [0, 5, 10])
+        s.feed(b"K")
+        self.assertEquals(s.needle, b"ma")
+        s.feed(b"\x7f\x7fM")
+        self.assertEquals(s.matches, [0, 10])
+        s.feed(b"A")
+        self.assertEquals(s.matches, [10])
+        s.feed(b"\x7f")
+        self.assertEquals(s.matches, [0, 10])
+
+    def test_random_case(self):
+        def matches(line, needle, flags):
+            if flags == pyshellhop.IGNORE_CASE or (
+                    flags == pyshellhop.SMART_CASE and needle == needle.lower()):
+                line, needle = line.lower(), needle.lower()
+            return [i for i in range(len(line)) if needle and line.startswith(needle, i)]
+
+        rng = random.Random(3)
+        for _ in range(2000):
+            flags = rng.choice([pyshellhop.IGNORE_CASE, pyshellhop.SMART_CASE])
+            line = bytes(bytearray(rng.choice(b"aAb") for _ in range(rng.randint(0, 30))))
+            s = pyshellhop.Shellhop(line, flags)
+            needle = b""
+            for _ in range(6):
+                # Runs of characters are searched differently from single ones
+                keys = bytes(bytearray(rng.choice(b"aAb\x7f") for _ in range(rng.randint(1, 3))))
+                s.feed(keys)
+                for c in bytearray(keys):
+                    if c == 0x7f:
+                        needle = needle[:-1]
+                    elif matches(line, needle + bytes(bytearray([c])), flags):
+                        needle += bytes(bytearray([c]))
+                self.assertEquals(s.needle, needle)
+                self.assertEquals(s.matches, matches(line, needle, flags))
+
+    def test_regex(self):
+        s = pyshellhop.Shellhop(b"ls --color=auto --all -l", pyshellhop.REGEX)
+        s.feed(br"--\w+=")
+        self.assertEquals(s.matches, [3])
+        text, styles = s.render()
+        self.assertEquals(styles[12:], [0] * 3 + [pyshellhop.REVERSE_VIDEO] * 8 + [0] * 19)
+
+        # Open groups are taken as closed, and keys that don't parse are ignored
+        s = pyshellhop.Shellhop(b"foo bar baz", pyshellhop.REGEX)
+        s.feed(b")(ba")
+        self.assertEquals(s.needle, b"(ba")
+        self.assertEquals(s.matches, [4, 8])
+        s.feed(b"r|fo)$")
+        self.assertEquals(s.matches, [])
+        s.feed(b"\x7f\x7f")
+        self.assertEquals(s.needle, b"(bar|fo")
+        self.assertEquals(s.matches, [0, 4])
+
+        # A needle with no matches leaves the cursor where it was
+        s = pyshellhop.Shellhop(b"foo bar baz", pyshellhop.REGEX)
+        s.feed(b"baz|q\x0e")
+        self.assertEquals(s.cursor, 8)
+        s.feed(b"\x7f\x7f\x7f\x7fq\x0e")
+        self.assertEquals(s.matches, [])
+        self.assertEquals(s.render()[0], b"(shellhop): foo bar baz [0/0]")
+        self.assertEquals(s.cursor, 8)
+
+        s = pyshellhop.Shellhop(b"Foo foo", pyshellhop.REGEX | pyshellhop.IGNORE_CASE)
+        s.feed(b"^[f]")
+        self.assertEquals(s.matches, [0])
+
+    def test_random_regex(self):
+        # Compare with Python's re, taking the longest match at each offset
+        def pattern(rng, depth):
+            atoms = []
+            for _ in range(rng.randint(1, 3)):
+                r = rng.random()
+                if r < 0.15 and depth < 2:
+                    atoms.append(b"(" + pattern(rng, depth + 1) + b")")
+                    continue
+                atom = rng.choice([b"a", b"b", b"A", b".", b"[ab]", b"[^a]", b"[^aB]", br"\w",
+                                   b"^"])
+                if atom != b"^":
+                    atom += rng.choice([b"", b"", b"*", b"+", b"?"])
+                atoms.append(atom)
+            alt = b"".join(atoms)
+            if rng.random() < 0.2:
+                alt += b"|" + pattern(rng, depth + 1)
+            return alt
+
+        rng = random.Random(5)
+        for _ in range(1000):
+            line = bytes(bytearray(rng.choice(b"abAB -") for _ in range(rng.randint(0, 20))))
+            needle = pattern(rng, 0)
+            # Negated classes must exclude both cases of their letters
+            ignore_case = rng.random() < 0.5
+            flags = pyshellhop.REGEX | (pyshellhop.IGNORE_CASE if ignore_case else 0)
+            s = pyshellhop.Shellhop(line, flags)
+            s.feed(needle)
+            self.assertEquals(s.needle, needle)
+            regex = re.compile(b"(?:" + needle + br")\Z", re.I if ignore_case else 0)
+            ends = [[j for j in range(i, len(line) + 1) if regex.match(line, i, j)]
+                    for i in range(len(line) + 1)]
+            self.assertEquals(s.matches, [i for i in range(len(line) + 1) if ends[i]])
+            if s.matches:
+                text, styles = s.render()
+                current = [x for x in styles if x & pyshellhop.REVERSE_VIDEO]
+                self.assertEquals(len(current), max(ends[s.cursor]) - s.cursor)
+
+    def test_utf8(self):
+        locale.setlocale(locale.LC_CTYPE, 'C.UTF-8')
+        try:
+            line = u'h\xe9llo \u6f22\u5b57 wend'.encode('utf-8')
+            s = pyshellhop.Shellhop(line)
+            s.feed(b'w')
+            self.assertEquals(s.cursor, 14)
+            self.assertEquals(s.char_index(s.cursor), 9)
+
+            # A partly typed character highlights the whole of it
+            s = pyshellhop.Shellhop(line)
+            s.feed(u'\u6f22'.encode('utf-8')[:1])
+            text, styles = s.render()
+            self.assertEquals(styles[12 + 7:12 + 10], [pyshellhop.REVERSE_VIDEO] * 3)
+
+            # Wide characters take two columns
+            s = pyshellhop.Shellhop(line)
+            text, styles = s.render(width=23)
+            self.assertEquals(text.decode('utf-8'), u'(shellhop): h\xe9llo ...')
+        finally:
+            locale.setlocale(locale.LC_CTYPE, 'C')
+
+    def test_random_utf8(self):
+        chars = [u'a', u'\xe9', u'\u6f22', u'\u0301']
+        widths = {u'a': 1, u'\xe9': 1, u'\u6f22': 2, u'\u0301': 0}
+        rng = random.Random(4)
+        locale.setlocale(locale.LC_CTYPE, 'C.UTF-8')
+        try:
+            for _ in range(1000):
+                line = u''.join(rng.choice(chars) for _ in range(rng.randint(0, 30)))
+                keys = u''.join(rng.choice(chars) for _ in range(rng.randint(0, 3)))
+                keys = keys.encode('utf-8')[:rng.randint(0, 6)] + b'\x0e' * rng.randint(0, 2)
+                width = rng.randint(30, 50)
+                s = pyshellhop.Shellhop(line.encode('utf-8'))
+                s.feed(keys)
+
+                # Matches start on characters
+                starts = set(len(line[:i].encode('utf-8')) for i in range(len(line) + 1))
+                self.assertTrue(set(s.matches) <= starts)
+                self.assertEquals(s.char_index(s.cursor), len(line.encode('utf-8')[:s.cursor].decode('utf-8')))
+
+                # The row fits and no character is split between styles
+                text, styles = s.render(width)
+                row = text.decode('utf-8')
+                self.assertTrue(sum(widths.get(c, 1) for c in row) < width)
+                pos = 0
+                for c in row:
+                    n = len(c.encode('utf-8'))
+                    self.assertEquals(len(set(styles[pos:pos + n])), 1)
+                    pos += n
+        finally:
+            locale.setlocale(locale.LC_CTYPE, 'C')
+
+    def test_overlapping_run(self):
+        line = b"a" * 100000
+        s = pyshellhop.Shellhop(line)
+        s.feed(b"a" * 1000)
+        self.assertEquals(len(s.matches), 99001)
+        s.feed(b"\x7f")
+        self.assertEquals(len(s.matches), 99002)
+        s.feed(b"\x0e\x0e\r")
+        self.assertEquals(s.cursor, 2)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,200 @@
+/*
+ * Copyright 2017 Rich Lane
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/*
+ * zsh/shellhop: the shellhop widget as a zsh module. It searches $BUFFER
+ * in-process, draws through ZLE's status line and region_highlight, and
+ * sets $CURSOR directly. $SHELLHOP_CASE may be "ignore" or "smart", as for
+ * --ignore-case and --smart-case.
+ *
+ * Built inside the zsh source tree; see "make zsh-module".
+ */
+#include "shellhop.mdh"
+#include "shellhop_zle.pro"
+
+#include "shellhop.h"
+
+static Widget w_shellhop;
+
+/*
+ * Number of characters in the first off bytes of the line, looked up in the
+ * table the engine built. Like ZLE, it counts invalid bytes as one
+ * character each.
+ */
+static int
+char_index(const struct shellhop *s, int off)
+{
+#ifdef MULTIBYTE_SUPPORT
+    return shellhop_char_index(s, off);
+#else
+    return off;
+#endif
+}
+
+/* Flags for the case matching chosen by $SHELLHOP_CASE */
+static int
+case_flags(void)
+{
+    char *mode = getsparam("SHELLHOP_CASE");
+
+    if (mode && !strcmp(mode, "ignore"))
+	return SHELLHOP_IGNORE_CASE;
+    if (mode && !strcmp(mode, "smart"))
+	return SHELLHOP_SMART_CASE;
+    return 0;
+}
+
+/* Show the needle in the status line and highlight the matches */
+static void
+show(const struct shellhop *s)
+{
+    int needle_len, count, current, i;
+    const char *needle = shellhop_needle(s, &needle_len);
+    const int *offsets = shellhop_matches(s, &count);
+    char counter[32] = "";
+    char **rh;
+
+    current = shellhop_current(s);
+    if (count > 0)
+	sprintf(counter, " [%d/%d]", current + 1, count);
+    statusline = zhtricat("(shellhop): ",
+			  metafy((char *)needle, needle_len, META_HEAPDUP),
+			  counter);
+
+    rh = (char **)zshcalloc((count + 1) * sizeof(char *));
+    for (i = 0; i < count; i++) {
+	char buf[64];
+	sprintf(buf, "%d %d %s", char_index(s, offsets[i]),
+		char_index(s, offsets[i] + needle_len),
+		i == current ? "standout" : "underline");
+	rh[i] = ztrdup(buf);
+    }
+    setaparam("region_highlight", rh);
+
+    zlecs = char_index(s, shellhop_cursor(s));
+}
+
+/* Feed one key, as the bytes that were typed */
+static int
+feed_key(struct shellhop *s, ZLE_INT_T c)
+{
+#ifdef MULTIBYTE_SUPPORT
+    char buf[MB_LEN_MAX];
+    mbstate_t mbs;
+    size_t n;
+
+    memset(&mbs, 0, sizeof(mbs));
+    n = wcrtomb(buf, c, &mbs);
+    if (n == MB_INVALID)
+	return SHELLHOP_CONTINUE;
+    return shellhop_feed(s, buf, n);
+#else
+    char b = c;
+    return shellhop_feed(s, &b, 1);
+#endif
+}
+
+/**/
+static int
+shellhop_widget(UNUSED(char **args))
+{
+    int ll, cs, len, status = SHELLHOP_CONTINUE;
+    int orig_cs = zlecs;
+    char *mline = zlegetline(&ll, &cs);
+    char *line = unmetafy(mline, &len);
+    char **saved = getaparam("region_highlight");
+    struct shellhop *s = shellhop_new(line, len);
+
+    shellhop_set_flags(s, case_flags());
+    saved = saved ? zarrdup(saved) : (char **)zshcalloc(sizeof(char *));
+
+    while (status == SHELLHOP_CONTINUE) {
+	ZLE_INT_T c;
+
+	show(s);
+	zrefresh();
+	c = getfullchar(0);
+	if (c == ZLEEOF)
+	    status = SHELLHOP_CANCEL;
+	else
+	    status = feed_key(s, c);
+    }
+
+    zlecs = status == SHELLHOP_ACCEPT ? char_index(s, shellhop_cursor(s))
+				      : orig_cs;
+    statusline = NULL;
+    setaparam("region_highlight", saved);
+
+    shellhop_free(s);
+    zfree(mline, ll + 1);
+    return status == SHELLHOP_ACCEPT ? 0 : 1;
+}
+
+static struct features module_features = {
+    NULL, 0,
+    NULL, 0,
+    NULL, 0,
+    NULL, 0,
+    0
+};
+
+/**/
+int
+setup_(UNUSED(Module m))
+{
+    return 0;
+}
+
+/**/
+int
+features_(Module m, char ***features)
+{
+    *features = featuresarray(m, &module_features);
+    return 0;
+}
+
+/**/
+int
+enables_(Module m, int **enables)
+{
+    return handlefeatures(m, &module_features, enables);
+}
+
+/**/
+int
+boot_(Module m)
+{
+    w_shellhop = addzlefunction("shellhop", shellhop_widget, ZLE_KEEPSUFFIX);
+    if (w_shellhop)
+	return 0;
+    zwarnnam(m->node.nam, "name clash when adding ZLE function `shellhop'");
+    return -1;
+}
+
+/**/
+int
+cleanup_(Module m)
+{
+    deletezlefunction(w_shellhop);
+    return setfeatureenables(m, &module_features, NULL);
+}
+
+/**/
+int
+finish_(UNUSED(Module m))
+{
+    return 0;
+}